@@ -1,6 +1,7 @@
 from transaction.transaction import Transaction
 from eth_account import Account as web3_account  # from web3py dependency.
 from eth_account.messages import encode_defunct
+import copy
 import json
 import hashlib
 
@@ -8,6 +9,15 @@ ADDR_COUNT = 3
 ZERO_ADDRESS = "0x" + "0" * 40
 
 
+class AccountNotFound(Exception):
+    "Raised when an account is not found on the list of accounts."
+    pass
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
 class Account:
     "Holds information about an account."
     """ Address: 64 hexadecimal characters;
@@ -41,6 +51,7 @@ class Account:
         self.nonce = _nonce
         self.balance = _balance
         self.code = _code
+        self.code_hash = code_hash(_code) if _code != "" else ""  # keys the contract cache.
         self.storage = _storage
 
     def set_balance(self, _balance):
@@ -78,8 +89,8 @@ class Account:
     def short_address(self) -> str:
         return f"{self.address[:5]}...{self.address[-3:]}"
 
-    def serialize(self) -> str:
-        account_json = {
+    def to_dict(self) -> dict:
+        return {
             "private_key": self.private_key,
             "address": self.address,
             "nonce": self.nonce,
@@ -87,7 +98,110 @@ class Account:
             "code": self.code,
             "storage": self.storage,
         }
-        return json.dumps(account_json)
+
+    def serialize(self) -> str:
+        return json.dumps(self.to_dict())
+
+
+def account_from_dict(a: dict) -> Account:
+    return Account(
+        _private_key=a["private_key"],
+        _address=a["address"],
+        _nonce=a["nonce"],
+        _balance=a["balance"],
+        _code=a["code"],
+        _storage=a["storage"],
+    )
+
+
+class AccountStore:
+    "Accounts in insertion order, indexed by address."
+
+    def __init__(self, accounts: list[Account] = []):
+        self.accounts = []
+        self.by_address = {}
+        for a in accounts:
+            self.append(a)
+
+    def append(self, account: Account):
+        if account.address in self.by_address:  # replace, keeping the position.
+            i = self.accounts.index(self.by_address[account.address])
+            self.accounts[i] = account
+        else:
+            self.accounts.append(account)
+        self.by_address[account.address] = account
+
+    def get(self, address: str) -> Account:
+        try:
+            return self.by_address[address]
+        except KeyError:
+            raise AccountNotFound()
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.by_address
+
+    def __getitem__(self, i: int) -> Account:
+        return self.accounts[i]
+
+    def __iter__(self):
+        return iter(self.accounts)
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+
+class StorageOverlay(dict):
+    """A contract's storage as seen by a block executed on an AccountOverlay. Variables
+    are shared with the account's storage until first read, then replaced by a copy.
+    Pickles and copies as a plain dict."""
+
+    def __init__(self, storage: dict):
+        super(StorageOverlay, self).__init__(storage)
+        self.copied = set()
+
+    def __getitem__(self, key):
+        value = super(StorageOverlay, self).__getitem__(key)
+        if key not in self.copied:
+            value = copy.deepcopy(value)
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.copied.add(key)
+        super(StorageOverlay, self).__setitem__(key, value)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class AccountOverlay:
+    """A copy-on-write view of an AccountStore, with the same interface. Accounts are
+    copied when first read and their storage variables when a contract first reads
+    them, so executing on the view costs what the transactions touch. New accounts
+    are only added to the view."""
+
+    def __init__(self, accounts: AccountStore):
+        self.base = accounts
+        self.written = AccountStore([])  # copies and new accounts, in the order they were read.
+
+    def append(self, account: Account):
+        self.written.append(account)
+
+    def get(self, address: str) -> Account:
+        if address not in self.written:
+            account = copy.copy(self.base.get(address))
+            account.storage = StorageOverlay(account.storage)
+            self.written.append(account)
+        return self.written.get(address)
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.written or address in self.base
+
+    def __iter__(self):
+        return iter(self.written)
 
 
 def generate_accounts() -> list[Account]:
@@ -0,0 +1,46 @@
+import json
+import sys
+from time import perf_counter
+from account.account import Account
+from block.block import Block, block_from_dict
+from codec.codec import encode_block, decode_block
+
+# Usage: python -m benchmark.codec --txs=1000 --rounds=20
+# Compares the size and encode/decode time of a block as JSON and in the binary encoding.
+
+
+def get_arg(args: list[str], arg: str, default: int) -> int:
+    for a in args:
+        if a.startswith(f"--{arg}="):
+            return int(a.replace(f"--{arg}=", ""))
+    return default
+
+
+def timed(f, rounds: int) -> float:
+    start = perf_counter()
+    for _ in range(rounds):
+        f()
+    return (perf_counter() - start) / rounds
+
+
+if __name__ == "__main__":
+    n_txs = get_arg(sys.argv, "txs", 1_000)
+    rounds = get_arg(sys.argv, "rounds", 20)
+    a = Account(_private_key="0x" + "1".zfill(64))
+    b = Account(_private_key="0x" + "2".zfill(64))
+    txs = [a.send_transaction(to=b.address, amount=1, nonce=n)[0] for n in range(n_txs)]
+    block = Block(_number=1, _timestamp=1.5, _nonce=12345, _prev_hash="ab" * 32, _txs=txs)
+
+    as_json = json.dumps(block.to_dict()).encode()
+    as_binary = encode_block(block)
+    assert decode_block(memoryview(as_binary)).get_block_hash() == block.get_block_hash()
+
+    json_encode = timed(lambda: json.dumps(block.to_dict()).encode(), rounds)
+    binary_encode = timed(lambda: encode_block(block), rounds)
+    json_decode = timed(lambda: block_from_dict(json.loads(as_json)), rounds)
+    binary_decode = timed(lambda: decode_block(memoryview(as_binary)), rounds)
+
+    print(f"Block with {n_txs} txs.")
+    print(f"Size:   JSON {len(as_json)} bytes, binary {len(as_binary)} bytes ({len(as_json) / len(as_binary):.1f}x)")
+    print(f"Encode: JSON {json_encode * 1000:.2f}ms, binary {binary_encode * 1000:.2f}ms")
+    print(f"Decode: JSON {json_decode * 1000:.2f}ms, binary {binary_decode * 1000:.2f}ms")
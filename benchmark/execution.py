@@ -0,0 +1,83 @@
+import copy
+import random
+import sys
+from time import perf_counter
+from account.account import Account, AccountStore
+from transaction.transaction import Transaction
+from execution.execution import execute_serial, execute_parallel
+
+# Usage: python -m benchmark.execution --txs=5000 --accounts=2000 --contracts=0
+# Compares serial and parallel execution of a synthetic block of transfers
+# between random accounts and, with --contracts, calls to looping contracts.
+
+LOOP_CONTRACT = "def constructor():\n\tpass\ndef work(n):\n\tglobal total\n\tfor i in range(n):\n\t\ttotal += i"
+
+
+def get_arg(args: list[str], arg: str, default: int) -> int:
+    for a in args:
+        if a.startswith(f"--{arg}="):
+            return int(a.replace(f"--{arg}=", ""))
+    return default
+
+
+def synthetic_block(
+    n_txs: int, n_accounts: int, n_contracts: int, seed: int = 0
+) -> tuple[AccountStore, list[Transaction]]:
+    rng = random.Random(seed)
+    accounts = [
+        Account(_address="0x" + str(i).zfill(40), _balance=1_000_000) for i in range(n_accounts)
+    ]
+    contracts = [
+        Account(_address="0x" + "c" + str(i).zfill(39), _code=LOOP_CONTRACT, _storage={"total": 0})
+        for i in range(n_contracts)
+    ]
+    # With contracts, account i only deals with contract i % n_contracts and the accounts
+    # sharing it, so there are as many independent groups of transactions as contracts.
+    shards = max(1, n_contracts)
+    nonces = {a.address: 0 for a in accounts}
+    txs = []
+    for _ in range(n_txs):
+        i = rng.randrange(n_accounts)
+        fr = accounts[i].address
+        if contracts and rng.random() < 0.5:
+            to, data = contracts[i % shards].address, {"call": "work(1000)"}
+        else:
+            j = rng.randrange(i % shards, n_accounts, shards)
+            to, data = accounts[j].address, {}
+        txs.append(
+            Transaction(
+                _fr=fr,
+                _to=to,
+                _amount=1,
+                _nonce=nonces[fr],
+                _signature="",
+                _data=data,
+                _gas_price=0,
+            )
+        )
+        nonces[fr] += 1
+    return (AccountStore(accounts + contracts), txs)
+
+
+def run(execute, accounts: AccountStore, txs: list[Transaction]) -> tuple[float, list]:
+    accounts = copy.deepcopy(accounts)
+    start = perf_counter()
+    execute(accounts, txs, [True] * len(txs))  # signatures aren't benchmarked here.
+    elapsed = perf_counter() - start
+    return (elapsed, [(a.address, a.balance, a.nonce, a.storage) for a in accounts])
+
+
+if __name__ == "__main__":
+    n_txs = get_arg(sys.argv, "txs", 5_000)
+    n_accounts = get_arg(sys.argv, "accounts", 2_000)
+    n_contracts = get_arg(sys.argv, "contracts", 0)
+    (accounts, txs) = synthetic_block(n_txs, n_accounts, n_contracts)
+
+    run(execute_parallel, accounts, txs[:100])  # starts the process pool.
+    (serial_time, serial_state) = run(execute_serial, accounts, txs)
+    (parallel_time, parallel_state) = run(execute_parallel, accounts, txs)
+    assert serial_state == parallel_state, "parallel execution diverged from serial."
+
+    print(f"{n_txs} txs, {n_accounts} accounts, {n_contracts} contracts.")
+    print(f"Serial:   {serial_time:.3f}s ({n_txs / serial_time:.0f} tx/s)")
+    print(f"Parallel: {parallel_time:.3f}s ({n_txs / parallel_time:.0f} tx/s)")
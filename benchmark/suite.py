@@ -0,0 +1,282 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+from functools import lru_cache
+from time import perf_counter, sleep
+from account.account import Account, AccountStore, ZERO_ADDRESS
+from block.block import Block, MINING_CHUNK
+from blockchain.blockchain import Blockchain
+from execution.execution import deploy_address
+from merkle.merkle import EMPTY_ROOT
+from node.node import Node
+from relay.relay import compact_block
+from transaction.transaction import Transaction, signature_cache
+
+# Usage: python -m benchmark.suite [--only=mining,signatures] [--repeat=5] [--txs=1000]
+#            [--json={results file}] [--baseline={results file} --tolerance=10]
+# Runs the benchmarks of the hot paths, reporting the median of --repeat runs of each.
+# With --json, results are also written as JSON. With --baseline, they are compared to
+# an earlier results file, and the exit status is 1 if any got worse by more than
+# --tolerance percent.
+#
+# Benchmarks are plain functions registered with @benchmark. Each returns
+# {metric name: value}, so one benchmark can report a metric per input size.
+
+BENCHMARKS = {}  # name -> (function, unit, higher_is_better)
+
+
+def benchmark(name: str, unit: str, higher_is_better: bool = True):
+    def register(f):
+        BENCHMARKS[name] = (f, unit, higher_is_better)
+        return f
+
+    return register
+
+
+def get_arg(args: list[str], arg: str, default: str) -> str:
+    for a in args:
+        if a.startswith(f"--{arg}="):
+            return a.replace(f"--{arg}=", "")
+    return default
+
+
+def private_key(i: int) -> str:
+    return "0x" + str(i + 1).zfill(64)
+
+
+# Signing is slow and the same every run, so transactions are signed once.
+@lru_cache(maxsize=None)
+def signed_transfers(n_txs: int, n_senders: int = 20) -> tuple[list[Account], list[Transaction]]:
+    senders = [Account(_private_key=private_key(i), _balance=10**9) for i in range(n_senders)]
+    txs = []
+    for n in range(n_txs):
+        sender = senders[n % n_senders]
+        recipient = senders[(n + 1) % n_senders]
+        txs.append(sender.send_transaction(to=recipient.address, amount=1, nonce=n // n_senders)[0])
+    return (senders, txs)
+
+
+@lru_cache(maxsize=None)
+def signed_erc20_transfers(n_txs: int) -> tuple[Account, list[Transaction]]:
+    with open("contracts/ERC-20.py", "r") as e:
+        erc20 = e.read()
+    owner = Account(_private_key=private_key(0), _balance=10**9)
+    data = {
+        "code": erc20,
+        "variables": {"supply": 10**9, "balances": {}, "allowances": {}},
+    }
+    (deploy, contract) = owner.send_transaction(to=ZERO_ADDRESS, amount=0, nonce=0, data=data)
+    txs = [deploy]
+    for n in range(n_txs):
+        recipient = "0x" + str(n % 100).zfill(40)
+        call = {"call": f"transfer('{recipient}', 1)"}
+        txs.append(owner.send_transaction(to=contract, amount=0, nonce=n + 1, data=call)[0])
+    return (owner, txs)
+
+
+def fresh_account(a: Account) -> Account:
+    return Account(_address=a.address, _balance=a.balance)
+
+
+# A blockchain whose state is {accounts}, rather than the generated ones.
+def blockchain_with(accounts: list[Account]) -> Blockchain:
+    blockchain = Blockchain(
+        _difficulty=1,
+        _target=(2**256) - 1,
+        _expected_block_time=10,
+        _recalculate_every_x_blocks=10,
+        _xth_last_block_time=0,
+        _blocks=[],
+        _accounts=[],
+    )
+    blockchain.accounts = AccountStore(accounts + [Account(_address=ZERO_ADDRESS)])
+    blockchain.state_root = blockchain.state.update(
+        EMPTY_ROOT, {a.address: a.to_dict() for a in blockchain.accounts}
+    )
+    return blockchain
+
+
+class StopAfterChunks:
+    "Stands in for a node: tells mine_nonce() a peer found the block after {chunks} chunks of nonces."
+
+    def __init__(self, chunks: int):
+        self.chunks = chunks
+        self.checks = 0
+
+    @property
+    def block_found_by_peer(self) -> bool:
+        self.checks += 1
+        return self.checks > self.chunks
+
+
+@benchmark("mining", "hashes/s")
+def bench_mining(args: list[str]) -> dict:
+    chunks = int(get_arg(args, "chunks", "4"))
+    block = Block(_number=1, _prev_hash="0" * 64, _txs=[])
+    start = perf_counter()
+    block.mine_nonce(0, StopAfterChunks(chunks), workers=1)  # no hash is below 0.
+    return {"mining": chunks * MINING_CHUNK / (perf_counter() - start)}
+
+
+@benchmark("signatures", "sigs/s")
+def bench_signatures(args: list[str]) -> dict:
+    (_, txs) = signed_transfers(int(get_arg(args, "txs", "1000")))
+    signature_cache.signers.clear()
+    start = perf_counter()
+    for tx in txs:
+        tx.verify_signature()
+    return {"signatures": len(txs) / (perf_counter() - start)}
+
+
+@benchmark("execute", "tx/s")
+def bench_execute(args: list[str]) -> dict:
+    (senders, txs) = signed_transfers(int(get_arg(args, "txs", "1000")))
+    for tx in txs:  # signatures are benchmarked on their own.
+        tx.verify_signature()
+    blockchain = blockchain_with([fresh_account(a) for a in senders])
+    start = perf_counter()
+    blockchain.execute_block(Block(_number=1, _txs=txs))
+    elapsed = perf_counter() - start
+    assert sum(blockchain.accounts.get(a.address).nonce for a in senders) == len(txs)
+    return {"execute_transfers": len(txs) / elapsed}
+
+
+@benchmark("execute_erc20", "tx/s")
+def bench_execute_erc20(args: list[str]) -> dict:
+    (owner, txs) = signed_erc20_transfers(int(get_arg(args, "txs", "1000")))
+    for tx in txs:
+        tx.verify_signature()
+    blockchain = blockchain_with([fresh_account(owner)])
+    blockchain.execute_block(Block(_number=1, _txs=txs[:1]))  # deploys the contract.
+    start = perf_counter()
+    blockchain.execute_block(Block(_number=2, _txs=txs[1:]))
+    elapsed = perf_counter() - start
+    balances = blockchain.accounts.get(deploy_address(txs[0])).storage["balances"]
+    assert balances[owner.address] == 10**9 - (len(txs) - 1)
+    return {"execute_erc20_transfers": (len(txs) - 1) / elapsed}
+
+
+@benchmark("state", "ms", higher_is_better=False)
+def bench_state(args: list[str]) -> dict:
+    counts = [int(c) for c in get_arg(args, "accounts", "100,1000,10000").split(",")]
+    results = {}
+    with tempfile.TemporaryDirectory() as d:
+        cwd = os.getcwd()
+        os.chdir(d)  # load_state() reads state.json from the working directory.
+        try:
+            for count in counts:
+                accounts = [Account(_address=f"0x{i:040x}", _balance=100) for i in range(count)]
+                blockchain = blockchain_with(accounts)
+                start = perf_counter()
+                state = blockchain.save_state()
+                results[f"save_state[{count}]"] = 1000 * (perf_counter() - start)
+                start = perf_counter()
+                blockchain.load_state(state)
+                results[f"load_state[{count}]"] = 1000 * (perf_counter() - start)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+# Time from sending {message} until the receiver queued the block.
+def propagation_time(sender: Node, receiver: Node, message: dict) -> float:
+    receiver.blockchain.new_blocks = []
+    start = perf_counter()
+    sender.send_to_nodes(message)
+    while receiver.blockchain.new_blocks == []:
+        if perf_counter() - start > 10:
+            raise TimeoutError("Block was not received.")
+        sleep(0.0002)
+    return perf_counter() - start
+
+
+@benchmark("propagation", "ms", higher_is_better=False)
+def bench_propagation(args: list[str]) -> dict:
+    (senders, txs) = signed_transfers(int(get_arg(args, "txs", "1000")))
+    nodes = [Node("127.0.0.1", 0), Node("127.0.0.1", 0)]
+    for n in nodes:
+        n.blockchain = blockchain_with([fresh_account(a) for a in senders])
+        n.start()
+    (sender, receiver) = nodes
+    try:
+        sender.connect_with_node("127.0.0.1", receiver.port)
+        while receiver.all_nodes == []:
+            sleep(0.001)
+        for tx in txs:  # gossiped before the block was found.
+            receiver.blockchain.mempool.add(tx)
+        tip = sender.blockchain.blocks[-1]
+        block = Block(_number=tip.number + 1, _prev_hash=tip.get_block_hash(), _txs=txs)
+        return {
+            "propagation_full_block": 1000 * propagation_time(sender, receiver, {"new_block": block}),
+            "propagation_compact_block": 1000
+            * propagation_time(sender, receiver, {"compact_block": compact_block(block)}),
+        }
+    finally:
+        for n in nodes:
+            n.stop()
+
+
+def run(names: list[str], args: list[str], repeat: int) -> dict:
+    results = {}
+    for name in names:
+        (f, unit, higher_is_better) = BENCHMARKS[name]
+        runs = {}
+        for _ in range(repeat):
+            with contextlib.redirect_stdout(io.StringIO()):  # blockchain and node logs.
+                for metric, value in f(args).items():
+                    runs.setdefault(metric, []).append(value)
+        for metric, values in runs.items():
+            results[metric] = {
+                "value": statistics.median(values),
+                "unit": unit,
+                "higher_is_better": higher_is_better,
+                "runs": values,
+            }
+            print(f"{metric:32} {statistics.median(values):14.2f} {unit}")
+    return results
+
+
+# Metrics that got worse than in {baseline} by more than {tolerance} percent.
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    worse = []
+    for metric, r in results.items():
+        if metric not in baseline:
+            continue
+        before = baseline[metric]["value"]
+        change = 100 * (r["value"] - before) / before if before else 0
+        if not r["higher_is_better"]:
+            change = -change
+        print(f"{metric:32} {before:14.2f} -> {r['value']:.2f} {r['unit']} ({change:+.1f}%)")
+        if change < -tolerance:
+            worse.append(metric)
+    return worse
+
+
+if __name__ == "__main__":
+    names = get_arg(sys.argv, "only", ",".join(BENCHMARKS)).split(",")
+    repeat = int(get_arg(sys.argv, "repeat", "5"))
+    results = run(names, sys.argv, repeat)
+
+    json_path = get_arg(sys.argv, "json", "")
+    if json_path != "":
+        with open(json_path, "w") as f:
+            json.dump(
+                {"python": platform.python_version(), "repeat": repeat, "results": results},
+                f,
+                indent=2,
+            )
+
+    baseline_path = get_arg(sys.argv, "baseline", "")
+    if baseline_path != "":
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)["results"]
+        print(f"Compared to {baseline_path}:")
+        worse = regressions(results, baseline, float(get_arg(sys.argv, "tolerance", "10")))
+        if worse:
+            print(f"Regressions: {', '.join(worse)}")
+            sys.exit(1)
@@ -1,11 +1,212 @@
-from transaction.transaction import Transaction
+from transaction.transaction import Transaction, tx_from_dict
 from time import time
-from node.node import Node
+from typing import TYPE_CHECKING
+from merkle.merkle import merkle_root, merkle_proof, EMPTY_ROOT
+from metrics.metrics import registry
+from time import perf_counter
+import multiprocessing
+import queue
 import hashlib
-import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+if TYPE_CHECKING:  # node.node imports this module.
+    from node.node import Node
+
+# Nonces tried between checks of the stop signal. The timestamp is refreshed as often.
+MINING_CHUNK = 50_000
+
+hashes_tried = registry.counter("simplechain_hashes_total", "Block header hashes tried while mining.")
+hash_rate = registry.gauge("simplechain_hash_rate", "Hashes per second while mining the last block.")
+# Mining worker processes, started on the first block mined with more than one worker.
+_mining_pool = None
+
+
+def target_bound(target: int) -> bytes:
+    """Largest 32-byte digest such that int(digest) < target, or b"" if there is none.
+    Digests of equal length compare byte-wise like their big-endian integers,
+    so the mining loop never has to hex-parse a hash."""
+    t = int(target)
+    if t < target:  # round non integer (float) targets up.
+        t += 1
+    if t <= 0:
+        return b""
+    return min(t - 1, (2**256) - 1).to_bytes(32, "big")
+
+
+def search_nonces(
+    header: str,
+    bound: bytes,
+    start: int = 0,
+    step: int = 1,
+    stopped=lambda: False,
+    tried=hashes_tried.inc,
+) -> tuple[int, float] | None:
+    """Tries nonces start, start + step, start + 2 * step... until the header hashes to
+    at most {bound}. Returns (nonce, timestamp), or None once stopped() is true.
+    The number of nonces tried is reported to tried() after each chunk."""
+    header_state = hashlib.sha256(header.encode())
+    nonce = start
+    while not stopped():
+        timestamp = time()
+        midstate = header_state.copy()
+        midstate.update(f"Timestamp: {timestamp}, Nonce: ".encode())
+        chunk_start = nonce
+        for nonce in range(nonce, nonce + MINING_CHUNK * step, step):
+            h = midstate.copy()
+            h.update(str(nonce).encode())
+            if h.digest() <= bound:
+                tried((nonce - chunk_start) // step + 1)
+                return (nonce, timestamp)
+        tried(MINING_CHUNK)
+        nonce += step
+    return None
+
+
+# Runs in a MiningPool process: searches nonces for each job from {jobs} until one
+# is found or {stop} is set, and puts the result, or None, in {results}.
+def _mining_worker(jobs, results, stop, hashes):
+    def tried(n: int):
+        with hashes.get_lock():
+            hashes.value += n
+
+    while True:
+        (header, bound, start, step) = jobs.get()
+        found = search_nonces(header, bound, start, step, stop.is_set, tried)
+        if found is not None:
+            stop.set()
+        results.put(found)
+
+
+class MiningPool:
+    """Worker processes that mine every block, started once rather than per block.
+    Each block is a job for every worker, sent through its own queue. Workers are
+    spawned, not forked, as the node has network threads running by then."""
+
+    def __init__(self, workers: int):
+        context = multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.stop = context.Event()
+        self.jobs = [context.Queue() for _ in range(workers)]
+        self.results = context.Queue()
+        self.hashes = context.Value("q", 0)  # tried by all workers, for the current job.
+        self.processes = [
+            context.Process(
+                target=_mining_worker, args=(jobs, self.results, self.stop, self.hashes), daemon=True
+            )
+            for jobs in self.jobs
+        ]
+        for p in self.processes:
+            p.start()
+
+    # Worker i tries nonces i, i + workers, i + 2 * workers... Returns (nonce, timestamp),
+    # or None if a peer found the block first. Waits for every worker to stop.
+    def search(self, header: str, bound: bytes, node: "Node") -> tuple[int, float] | None:
+        self.stop.clear()
+        for i, jobs in enumerate(self.jobs):
+            jobs.put((header, bound, i, self.workers))
+        found = None
+        for _ in range(self.workers):
+            # Workers can't see the node, so a block found by a peer is relayed through stop.
+            while True:
+                try:
+                    result = self.results.get(timeout=0.05)
+                    break
+                except queue.Empty:
+                    if node.block_found_by_peer:
+                        self.stop.set()
+            if found is None:
+                found = result  # the first worker to find a nonce wins.
+        with self.hashes.get_lock():
+            hashes_tried.inc(self.hashes.value)
+            self.hashes.value = 0
+        return found
+
+    def close(self):
+        for p in self.processes:
+            p.terminate()
+
+
+# Part of the header that doesn't change while mining. Timestamp and nonce
+# are appended after it, so miners can hash it once and reuse the midstate.
+def header_prefix(number: int, prev_hash: str, tx_root: str, state_root: str) -> str:
+    return f"Block {number}, PrevHash: {prev_hash}, Tx Root: {tx_root}, State Root: {state_root}, "
+
+
+def header_hash(
+    number: int, prev_hash: str, tx_root: str, state_root: str, timestamp: float, nonce: int
+) -> str:
+    return hashlib.sha256(
+        f"{header_prefix(number, prev_hash, tx_root, state_root)}Timestamp: {timestamp}, Nonce: {nonce}".encode()
+    ).hexdigest()
+
+
+class BlockHeader:
+    "Everything a block hash commits to, without the transaction bodies."
+
+    def __init__(
+        self,
+        _number: int,
+        _timestamp: float,
+        _nonce: int,
+        _prev_hash: str,
+        _tx_root: str,  # Merkle root of the block's transaction hashes.
+        _state_root: str,  # root of the account state after executing the block.
+    ):
+        self.number = _number
+        self.timestamp = _timestamp
+        self.nonce = _nonce
+        self.prev_hash = _prev_hash
+        self.tx_root = _tx_root
+        self.state_root = _state_root
+
+    def get_block_hash(self) -> str:
+        return header_hash(
+            self.number,
+            self.prev_hash,
+            self.tx_root,
+            self.state_root,
+            self.timestamp,
+            self.nonce,
+        )
+
+    def to_dict(self) -> dict:
+        return self.__dict__.copy()
+
+
+def header_from_dict(header: dict) -> BlockHeader:
+    return BlockHeader(
+        _number=header["number"],
+        _timestamp=header["timestamp"],
+        _nonce=header["nonce"],
+        _prev_hash=header["prev_hash"],
+        _tx_root=header["tx_root"],
+        _state_root=header["state_root"],
+    )
 
 
 class Block:
+    # The block hash and the Merkle root are computed once. Setting a header field
+    # (e.g. nonce and timestamp after mining) invalidates the hash, and setting txs
+    # both. Transactions aren't changed once they're in a block.
+    __slots__ = (
+        "number",
+        "timestamp",
+        "nonce",
+        "prev_hash",
+        "state_root",
+        "_txs",
+        "_tx_root",
+        "_hash",
+    )
+
+    def __setattr__(self, name, value):
+        if name not in ("_hash", "_tx_root"):
+            object.__setattr__(self, "_hash", None)
+        object.__setattr__(self, name, value)
+
     def __init__(
         self,
         _number: int = 0,
@@ -13,12 +214,14 @@ class Block:
         _nonce: int = 0,
         _prev_hash: str = 0,
         _txs: list[Transaction] = [],
+        _state_root: str = EMPTY_ROOT,  # set by Blockchain.prepare_block() before mining.
         _block_dict: dict = {},
     ):
         self.number = _number
         self.timestamp = _timestamp
         self.nonce = _nonce
         self.prev_hash = _prev_hash
+        self.state_root = _state_root
         self.txs = _txs
 
         if _block_dict != {}:
@@ -27,39 +230,108 @@ class Block:
     def __str__(self) -> str:
         return f"Block {self.number}, Timestamp: {self.timestamp}, Nonce: {self.nonce}, PrevHash: {self.prev_hash[:5]}...{self.prev_hash[-3:]}, {len(self.txs)} txs."
 
+    @property
+    def txs(self) -> list[Transaction]:
+        return self._txs
+
+    @txs.setter
+    def txs(self, txs: list[Transaction]):
+        self._txs = txs
+        self._tx_root = None
+
+    def tx_hashes(self) -> list[str]:
+        return [tx.get_tx_hash() for tx in self.txs]
+
+    def tx_root(self) -> str:
+        if self._tx_root is None:
+            self._tx_root = merkle_root(self.tx_hashes())
+        return self._tx_root
+
+    # Proof that transaction {index} is in this block, see merkle.verify_merkle_proof().
+    def tx_proof(self, index: int) -> list[list[str]]:
+        return merkle_proof(self.tx_hashes(), index)
+
+    def get_header(self) -> str:
+        return header_prefix(self.number, self.prev_hash, self.tx_root(), self.state_root)
+
+    def header(self) -> BlockHeader:
+        return BlockHeader(
+            _number=self.number,
+            _timestamp=self.timestamp,
+            _nonce=self.nonce,
+            _prev_hash=self.prev_hash,
+            _tx_root=self.tx_root(),
+            _state_root=self.state_root,
+        )
+
     def get_block_hash(self) -> str:
         if self.nonce == -1:  # block was quick synced and is not full:
             return (
                 self.prev_hash
             )  # prev_hash here is actually the block's hash, as synced.
-        else:
-            txs_str = "\n".join([tx.get_tx_hash() for tx in self.txs])
-            return hashlib.sha256(
-                f"Block {self.number}, Timestamp: {self.timestamp}, Nonce: {self.nonce}, PrevHash: {self.prev_hash}, Tx Hashes: {txs_str}".encode()
-            ).hexdigest()
+        if self._hash is None:
+            self._hash = header_hash(
+                self.number,
+                self.prev_hash,
+                self.tx_root(),
+                self.state_root,
+                self.timestamp,
+                self.nonce,
+            )
+        return self._hash
 
     # Will try to find a nonce such that the block hash < {target}.
-    def mine_nonce(self, target: int, node: Node):
-        i = 0
-        print(f"Looking for nonce such that SHA256(block {self.number}) < {target}")
-        while not node.block_found_by_peer:
-            self.nonce = i
-            self.timestamp = time()
-            h = self.get_block_hash()
-            if int(h, 16) < target:
-                print(f"Found nonce {i}.")
-                break
-            else:
-                i += 1
+    # With more than one worker, worker i tries nonces i, i + workers, i + 2 * workers...
+    def mine_nonce(self, target: int, node: "Node", workers: int = os.cpu_count() or 1):
+        log.debug("Looking for nonce such that SHA256(block %d) < %s", self.number, target)
+        header = self.get_header()
+        bound = target_bound(target)
+        start = perf_counter()
+        hashes = hashes_tried.value
+        if workers > 1:
+            found = mine_nonce_parallel(header, bound, node, workers)
+        else:
+            found = search_nonces(header, bound, stopped=lambda: node.block_found_by_peer)
+        elapsed = perf_counter() - start
+        if elapsed > 0:
+            hash_rate.set((hashes_tried.value - hashes) / elapsed)
+
+        if found is not None:
+            self.nonce, self.timestamp = found
+            log.info("Found nonce %d for block %d.", self.nonce, self.number)
 
     def to_dict(self) -> dict:
-        d = self.__dict__.copy()
-        d["txs"] = [t.__dict__ for t in d["txs"]]
-        return d
+        return {
+            "number": self.number,
+            "timestamp": self.timestamp,
+            "nonce": self.nonce,
+            "prev_hash": self.prev_hash,
+            "state_root": self.state_root,
+            "txs": [t.to_dict() for t in self.txs],
+        }
 
     def from_dict(self, block: dict):
         self.number = block["number"]
         self.timestamp = block["timestamp"]
         self.nonce = block["nonce"]
         self.prev_hash = block["prev_hash"]
+        self.state_root = block.get("state_root", EMPTY_ROOT)  # older blocks have none.
         self.txs = block["txs"]
+
+
+# Like Block(_block_dict=block), but also turns the transactions into Transaction objects.
+def block_from_dict(block: dict) -> Block:
+    b = Block(_block_dict=block)
+    b.txs = [tx_from_dict(t) for t in b.txs]
+    return b
+
+
+def mine_nonce_parallel(
+    header: str, bound: bytes, node: "Node", workers: int
+) -> tuple[int, float] | None:
+    global _mining_pool
+    if _mining_pool is None or _mining_pool.workers != workers:
+        if _mining_pool is not None:
+            _mining_pool.close()
+        _mining_pool = MiningPool(workers)
+    return _mining_pool.search(header, bound, node)
@@ -1,15 +1,75 @@
 import os
-from block.block import Block
-from account.account import Account, generate_accounts, ZERO_ADDRESS
-from time import time
+from block.block import Block, BlockHeader
+from account.account import (
+    Account,
+    AccountStore,
+    AccountOverlay,
+    AccountNotFound,
+    account_from_dict,
+    generate_accounts,
+)
+from transaction.transaction import Transaction, verify_signatures, signature_cache
+from store.store import BlockStore, BlockNotFound
+from snapshot.snapshot import StateSnapshots
+from mempool.mempool import Mempool
+from contract.contract import contract_cache
+from execution.execution import (
+    execute_serial,
+    execute_parallel,
+    execute_on_copies,
+    commit_accounts,
+    well_formed,
+)
+from validation.validation import StageTimings
+from state.state import StateTrie, StateNotFound
+from merkle.merkle import EMPTY_ROOT
+from metrics.metrics import registry
+from time import time, perf_counter
 import json
+import logging
 
+log = logging.getLogger(__name__)
 
-def get_account(accounts: list[Account], address: str) -> Account:
-    for a in accounts:
-        if a.address == address:
-            return a
-    raise AccountNotFound()
+# With a block store, only this many of the latest blocks are kept in memory.
+RECENT_BLOCKS = 100
+# Blocks whose state stays readable (and provable) after newer blocks change it.
+STATE_HISTORY = 1000
+# Peer blocks timestamped further than this ahead of our clock are rejected.
+MAX_FUTURE_BLOCK_TIME = 60
+
+block_height = registry.gauge("simplechain_block_height", "Number of the last block added.")
+block_execute_seconds = registry.histogram(
+    "simplechain_block_execute_seconds", "Time to execute the transactions of a block."
+)
+
+
+class InvalidState(Exception):
+    "Raised by load_state() when a saved state doesn't match its state root."
+
+
+def get_account(accounts: AccountStore, address: str) -> Account:
+    return accounts.get(address)
+
+
+# Linkage rules for a block (or header) following {prev}.
+def valid_successor(block: Block | BlockHeader, prev: Block | BlockHeader) -> bool:
+    return (
+        block.number == prev.number + 1
+        and block.prev_hash == prev.get_block_hash()
+        and block.timestamp >= prev.timestamp
+    )
+
+
+def next_difficulty(
+    difficulty: float,
+    last_block_time: float,
+    xth_last_block_time: float,
+    recalculate_every_x_blocks: int,
+    expected_block_time: float,
+) -> float:
+    return difficulty * (recalculate_every_x_blocks * expected_block_time) / (
+        last_block_time - xth_last_block_time
+    )
 
 
 class Blockchain:
@@ -22,53 +82,167 @@ class Blockchain:
         _xth_last_block_time: float,  # for quick syncing
         _blocks: list[Block],
         _accounts: list[Account],
+        _parallel_verify: bool = False,  # verify a block's signatures in a process pool.
+        _parallel_execute: bool = False,  # execute independent transactions in a process pool.
+        _block_store: BlockStore = None,  # if given, blocks are persisted there.
+        _snapshots: StateSnapshots = None,  # if given, state is persisted there after each block.
     ):
         self.difficulty = _difficulty
         self.target = _target
         self.expected_block_time = _expected_block_time
         self.recalculate_every_x_blocks = _recalculate_every_x_blocks
         self.xth_last_block_time = _xth_last_block_time
-        self.blocks = _blocks
+        self.blocks = _blocks  # the most recent blocks only, if there's a block store.
+        self.block_store = _block_store
         self.genesis_time = time()
-        self.accounts = _accounts
-        self.new_blocks = []
-        self.pending_txs = []
+        self.accounts = AccountStore(_accounts)
+        self.new_blocks = []  # blocks from peers, imported by append_new_blocks().
+        self.block_timings = StageTimings()  # of import_block().
+        self.mempool = Mempool()
+        self.parallel_verify = _parallel_verify
+        self.parallel_execute = _parallel_execute
+        self.snapshots = _snapshots
+        self.dirty_accounts = set()  # addresses changed since the last snapshot.
+        self.synced = True  # set to False by nodes that must sync from peers first.
+        self.clock = time  # replaced by simulations, which run on their own clock.
+        self.state = StateTrie()
+        self.state_root = EMPTY_ROOT  # root of the current accounts in self.state.
+        self.state_roots = {}  # block number -> state root, for the last STATE_HISTORY blocks.
         self.load_state()
 
     def add_block(self, _block: Block):
         assert int(_block.get_block_hash(), 16) < self.target
         if len(self.blocks) > 0:
-            assert _block.number == self.blocks[-1].number + 1
-            assert _block.prev_hash == self.blocks[-1].get_block_hash()
-            assert _block.timestamp >= self.blocks[-1].timestamp
+            assert valid_successor(_block, self.blocks[-1])
+        assert _block.state_root == self.state_root  # as left by execute_block().
 
         block_time = (
             _block.timestamp - self.blocks[-1].timestamp
             if len(self.blocks) > 0
             else _block.timestamp - self.genesis_time
         )
-        print(
-            f"Block {_block.number} added. Hash: ...{_block.get_block_hash()[-5:]}. Block time: {block_time}"
+        log.info(
+            "Block %d added. Hash: ...%s. Block time: %s",
+            _block.number,
+            _block.get_block_hash()[-5:],
+            block_time,
         )
         self.blocks.append(_block)
+        block_height.set(_block.number)
+        if self.block_store is not None:
+            self.block_store.append(_block)
+            if len(self.blocks) > RECENT_BLOCKS:
+                del self.blocks[0]
+        self.mempool.prune(self.accounts)
+        self.record_state_root(_block.number)
 
         if _block.number % self.recalculate_every_x_blocks == 0 and _block.number > 0:
-            print("Recalculating difficulty.")
+            log.info("Recalculating difficulty.")
             self.recalculate_difficulty()
             self.recalculate_target()
             self.xth_last_block_time = _block.timestamp
 
+        if self.snapshots is not None:
+            self.save_snapshot()
+
+    def record_state_root(self, number: int):
+        self.state_roots[number] = self.state_root
+        if len(self.state_roots) > STATE_HISTORY:
+            del self.state_roots[next(iter(self.state_roots))]
+        if number % STATE_HISTORY == 0:
+            self.state.prune(self.state_roots.values())
+
+    def state_root_at(self, number: int) -> str:
+        if number not in self.state_roots:
+            raise StateNotFound()
+        return self.state_roots[number]
+
+    # State of account {address} after block {number} (see state.account_state()),
+    # or None if it didn't exist yet. Only the last STATE_HISTORY blocks are kept.
+    def get_account_at(self, address: str, number: int) -> dict:
+        return self.state.get(self.state_root_at(number), address)
+
+    # Checks that headers extend our chain, applying the same linkage and target
+    # rules as add_block(), including difficulty recalculations along the way.
+    def validate_headers(self, headers: list[BlockHeader]) -> bool:
+        prev = self.blocks[-1]
+        difficulty = self.difficulty
+        target = self.target
+        xth_last_block_time = self.xth_last_block_time
+        for h in headers:
+            if int(h.get_block_hash(), 16) >= target or not valid_successor(h, prev):
+                return False
+            if h.number % self.recalculate_every_x_blocks == 0 and h.number > 0:
+                difficulty = next_difficulty(
+                    difficulty,
+                    h.timestamp,
+                    xth_last_block_time,
+                    self.recalculate_every_x_blocks,
+                    self.expected_block_time,
+                )
+                target = ((2**256) - 1) / difficulty
+                xth_last_block_time = h.timestamp
+            prev = h
+        return True
+
+    # Returns block {number}, from memory if it's recent, else from the block store.
+    # A block loaded with a state (nonce -1) is a placeholder without transactions.
+    # After a restart, the block store has the real one.
+    def get_block(self, number: int) -> Block:
+        i = number - self.blocks[0].number
+        if 0 <= i < len(self.blocks) and self.blocks[i].number == number:
+            if self.blocks[i].nonce != -1 or self.block_store is None:
+                return self.blocks[i]
+            try:
+                return self.block_store.get_block(number)
+            except BlockNotFound:  # quick synced, the real block was never stored.
+                return self.blocks[i]
+        if self.block_store is None:
+            raise BlockNotFound()
+        return self.block_store.get_block(number)
+
+    def get_block_by_hash(self, block_hash: str) -> Block:
+        for b in reversed(self.blocks):
+            if b.get_block_hash() == block_hash:
+                return b
+        if self.block_store is None:
+            raise BlockNotFound()
+        return self.block_store.get_block_by_hash(block_hash)
+
     def recalculate_difficulty(self):
-        last_block_time = self.blocks[-1].timestamp
-        self.difficulty *= (
-            self.recalculate_every_x_blocks * self.expected_block_time
-        ) / (last_block_time - self.xth_last_block_time)
+        self.difficulty = next_difficulty(
+            self.difficulty,
+            self.blocks[-1].timestamp,
+            self.xth_last_block_time,
+            self.recalculate_every_x_blocks,
+            self.expected_block_time,
+        )
 
     def recalculate_target(self):
         self.target = ((2**256) - 1) / self.difficulty
 
     def save_state(self, write_file=False) -> dict:
-        state = {
+        state = self.state_header()
+        state["accounts"] = [a.to_dict() for a in self.accounts]
+        if write_file:
+            with open("state.json", "w") as s:
+                s.write(json.dumps(state))
+        return state
+
+    # Writes the accounts changed since the last snapshot, or a full base when it's time to compact.
+    def save_snapshot(self):
+        if self.snapshots.needs_compaction():
+            self.snapshots.write_base(self.save_state())
+        else:
+            delta = self.state_header()
+            delta["accounts"] = [
+                get_account(self.accounts, a).to_dict() for a in self.dirty_accounts
+            ]
+            self.snapshots.write_delta(delta)
+        self.dirty_accounts = set()
+
+    def state_header(self) -> dict:
+        return {
             "difficulty": self.difficulty,
             "target": self.target,
             "recalculate_every_x_blocks": self.recalculate_every_x_blocks,
@@ -78,106 +252,191 @@ class Blockchain:
             "last_block_hash": self.blocks[-1].get_block_hash(),
             "genesis_time": self.genesis_time,
             "expected_block_time": self.expected_block_time,
-            "accounts": [a.serialize() for a in self.accounts],
+            "state_root": self.state_root,
         }
-        if write_file:
-            with open("state.json", "w") as s:
-                s.write(json.dumps(state))
-        return state
 
-    # If a state is given in `state.json` or passed as state_dict,
+    # If a state is given in the snapshots, in `state.json` or passed as state_dict,
     # the blockchain syncs to that state by setting all accounts values.
     # Else, it will just generate accounts empty accounts.
     # In both cases, an empty block is added so add_block() can
     # check information from the previous block.
 
     def load_state(self, state_dict: dict = {}):
+        from_snapshots = (
+            state_dict == {} and self.snapshots is not None and self.snapshots.exists()
+        )
+        if from_snapshots:
+            state_dict = self.snapshots.load()
+
         if os.path.isfile("state.json") or state_dict != {}:
-            if os.path.isfile("state.json"):
+            if os.path.isfile("state.json") and not from_snapshots:
                 with open("state.json", "r") as s:
                     state = json.load(s)
             else:
                 state = state_dict
 
-            self.difficulty = state["difficulty"]
-            self.target = state["target"]
-            self.recalculate_every_x_blocks = state["recalculate_every_x_blocks"]
-            self.xth_last_block_time = state["xth_last_block_time"]
-            self.genesis_time = state["genesis_time"]
-            self.expected_block_time = state["expected_block_time"]
-            b = Block(
-                _number=state["last_block_number"],
-                _timestamp=state["last_block_time"],
-                _nonce=-1,
-                _prev_hash=state["last_block_hash"],
-                _txs=[],
+            accounts = AccountStore(
+                [
+                    # Older states hold each account as a JSON string.
+                    account_from_dict(json.loads(a) if isinstance(a, str) else a)
+                    for a in state["accounts"]
+                ]
             )
-            self.blocks.append(b)
-            self.accounts = [
-                Account(
-                    _private_key=a["private_key"],
-                    _nonce=a["nonce"],
-                    _balance=a["balance"],
-                    _code=a["code"],
-                    _storage=a["storage"],
+            if not self.set_state(state, accounts, write_snapshot=not from_snapshots):
+                raise InvalidState(
+                    f"Saved state at block {state['last_block_number']} doesn't match its state root."
                 )
-                for a in [json.loads(s) for s in state["accounts"]]
-            ]
         else:
+            self.accounts = AccountStore(generate_accounts())
+            self.state_root = self.state.update(
+                EMPTY_ROOT, {a.address: a.to_dict() for a in self.accounts}
+            )
             b = Block(
                 _number=0,
                 _timestamp=self.genesis_time,
                 _nonce=-1,
                 _prev_hash="0" * 64,
                 _txs=[],
+                _state_root=self.state_root,
             )
             self.blocks.append(b)
-            self.accounts = generate_accounts()
+            self.record_state_root(0)
+            self.dirty_accounts = set()
+            if self.snapshots is not None:
+                self.snapshots.write_base(self.save_state())
+
+    # Syncs to a state header (as returned by state_header()) and its accounts.
+    # Returns False, leaving the blockchain as is, if the accounts don't match the state root.
+    def set_state(self, header: dict, accounts: AccountStore, write_snapshot=True) -> bool:
+        state = StateTrie()
+        state_root = state.update(EMPTY_ROOT, {a.address: a.to_dict() for a in accounts})
+        if header.get("state_root", state_root) != state_root:  # older states have none.
+            log.warning("Accounts don't match the state root, ignoring the state.")
+            return False
+
+        self.difficulty = header["difficulty"]
+        self.target = header["target"]
+        self.recalculate_every_x_blocks = header["recalculate_every_x_blocks"]
+        self.xth_last_block_time = header["xth_last_block_time"]
+        self.genesis_time = header["genesis_time"]
+        self.expected_block_time = header["expected_block_time"]
+        b = Block(
+            _number=header["last_block_number"],
+            _timestamp=header["last_block_time"],
+            _nonce=-1,
+            _prev_hash=header["last_block_hash"],
+            _txs=[],
+            _state_root=state_root,
+        )
+        self.blocks.append(b)
+        self.accounts = accounts
+        self.state = state
+        self.state_root = state_root
+        self.state_roots = {}
+        self.record_state_root(b.number)
+        self.dirty_accounts = set()
+        if self.snapshots is not None and write_snapshot:
+            self.snapshots.write_base(self.save_state())
+        return True
 
     def execute_block(self, block: Block):
-        accounts = self.accounts
-        for t in block.txs:
-            fr_account = get_account(accounts, t.fr)
-            to_account = get_account(accounts, t.to)
-
-            if t.amount > fr_account.balance:
-                print("Can't process transaction, amount more than balance.")
-                # Raise InsufficientBalance()
-                continue
-
-            if not t.verify_signature():
-                print("Can't verify signature.")
-                continue
-
-            if t.nonce != fr_account.nonce:
-                print(
-                    f"Transaction nonce ({t.nonce}) differs from account nonce ({fr_account.nonce}). "
-                )
-                continue
+        # Signatures don't depend on state, so they are all checked before executing.
+        valid_signatures = verify_signatures(block.txs, self.parallel_verify)
+        start = perf_counter()
+        if self.parallel_execute:
+            changed = execute_parallel(self.accounts, block.txs, valid_signatures)
+        else:
+            changed = execute_serial(self.accounts, block.txs, valid_signatures)
+        block_execute_seconds.observe(perf_counter() - start)
+        self.dirty_accounts |= changed
+        self.state_root = self.state.update(
+            self.state_root, {a: get_account(self.accounts, a).to_dict() for a in changed}
+        )
 
-            fr_account.balance -= t.amount
-            to_account.balance += t.amount
-            fr_account.nonce += 1
+    # Sets the state root of a block we're about to mine: the root after its
+    # transactions, executed on copies of the accounts they touch. Returns the
+    # copies, the addresses changed and the state root, to add the block with
+    # commit_block() once it's mined instead of executing it again.
+    def prepare_block(self, block: Block) -> tuple:
+        valid_signatures = verify_signatures(block.txs, self.parallel_verify)
+        start = perf_counter()
+        (copies, changed) = execute_on_copies(self.accounts, block.txs, valid_signatures)
+        block_execute_seconds.observe(perf_counter() - start)
+        block.state_root = self.state.update(
+            self.state_root, {a: copies.get(a).to_dict() for a in changed}
+        )
+        return (copies, changed, block.state_root)
 
-            if t.to == ZERO_ADDRESS and t.data != {}:  # contract creation
-                deploy_address = (
-                    "0x"
-                    + hashlib.sha256((t.fr + str(t.nonce)).encode()).hexdigest()[:40]
-                )
-                deploy_contract(
-                    t.fr, t.data["code"], t.data["variables"], deploy_address, accounts
-                )
+    # Cheap checks that don't look at transactions beyond their hashes:
+    # linkage to our last block, timestamp and proof of work.
+    def check_header(self, block: Block) -> bool:
+        return (
+            valid_successor(block, self.blocks[-1])
+            and block.timestamp <= self.clock() + MAX_FUTURE_BLOCK_TIME
+            and int(block.get_block_hash(), 16) < self.target
+        )
 
-            elif to_account.code != "" and t.data != {}:  # contract call
-                call_contract(accounts, t.fr, t.to, t.data["call"])
+    # Field types and data shapes of a block's transactions, see well_formed(). Checked
+    # before signatures are recovered or anything is executed.
+    def check_txs(self, block: Block) -> bool:
+        return all(isinstance(t, Transaction) and well_formed(t) for t in block.txs)
+
+    # Executes a block on copies of the accounts it touches. Returns the copies, the
+    # addresses changed and the resulting state root, or None if it can't execute.
+    def execute_block_on_copies(self, block: Block, valid_signatures: list[bool]) -> tuple:
+        start = perf_counter()
+        try:
+            (copies, changed) = execute_on_copies(
+                self.accounts, block.txs, valid_signatures, self.parallel_execute
+            )
+        except AccountNotFound:
+            return None
+        block_execute_seconds.observe(perf_counter() - start)
+        state_root = self.state.update(
+            self.state_root, {a: copies.get(a).to_dict() for a in changed}
+        )
+        return (copies, changed, state_root)
+
+    def commit_block(self, block: Block, copies: AccountOverlay, changed: set[str], state_root: str):
+        commit_accounts(self.accounts, copies, changed)
+        self.dirty_accounts |= changed
+        self.state_root = state_root
+        self.add_block(block)
+
+    # Validates a peer's block in stages, cheapest first, and adds it. Accounts are
+    # only changed once the block passed them all. Returns False if it was rejected.
+    def import_block(self, block: Block) -> bool:
+        timings = self.block_timings
+        if not timings.time("header", self.check_header, block):
+            timings.reject("header")
+            log.warning("Block %d rejected: doesn't extend our chain or bad proof of work.", block.number)
+            return False
+        if not timings.time("transactions", self.check_txs, block):
+            timings.reject("transactions")
+            log.warning("Block %d rejected: malformed transactions.", block.number)
+            return False
+        # Signatures don't depend on state, so they are all checked before executing.
+        valid_signatures = timings.time(
+            "signatures", verify_signatures, block.txs, self.parallel_verify
+        )
+        executed = timings.time("execution", self.execute_block_on_copies, block, valid_signatures)
+        if executed is None or executed[2] != block.state_root:
+            timings.reject("execution")
+            log.warning("Block %d rejected: its state root doesn't match its execution.", block.number)
+            return False
+        timings.time("commit", self.commit_block, block, *executed)
+        return True
 
     def append_new_blocks(self):
         if self.new_blocks:
-            print("Appending blocks found by others.")
-            for block_dict in self.new_blocks:
-                b = Block(_block_dict=block_dict)
-                self.execute_block(b)
-                self.add_block(b)
-            self.new_blocks = []
+            log.debug("Appending blocks found by others.")
+            # Swap the queue first, peers may keep adding to it meanwhile.
+            new_blocks, self.new_blocks = self.new_blocks, []
+            for b in new_blocks:
+                if b.number <= self.blocks[-1].number:  # also queued by a catch-up.
+                    continue
+                if not self.import_block(b):
+                    break  # the blocks after it don't extend our chain either.
+            log.debug("%s %s %s", signature_cache, contract_cache, self.block_timings)
         else:
-            print("No blocks to add.")
+            log.debug("No blocks to add.")
@@ -1,17 +1,15 @@
 from time import time, sleep
-import hashlib
+import logging
 import os
 import sys
-from account.account import Account, ZERO_ADDRESS
-from transaction.transaction import Transaction
 from block.block import Block
 from blockchain.blockchain import Blockchain
+from store.store import BlockStore
+from snapshot.snapshot import StateSnapshots
 from node.node import Node
+from relay.relay import compact_block
 
-
-class AccountNotFound(Exception):
-    "Raised when an account is not found on the list of accounts."
-    pass
+log = logging.getLogger("client")
 
 
 class InsufficientBalance(Exception):
@@ -19,49 +17,6 @@ class InsufficientBalance(Exception):
     pass
 
 
-def deploy_contract(
-    sender: str,
-    code: str,
-    variables: dict,
-    deploy_address: str,
-    accounts: list[Account],
-):
-    storage = variables
-    storage["MSGSENDER"] = sender
-    keys_before = [k for k in storage]
-    # run constructor:
-    to_execute = code + "\nconstructor()"
-    exec(to_execute, storage)
-    storage = {k: storage[k] for k in keys_before if k != "MSGSENDER"}
-    accounts.append(Account(_address=deploy_address, _code=code, _storage=storage))
-
-
-def call_contract(accounts: list[Account], sender: str, address: str, call: str):
-    acct = get_account(accounts, address)
-    to_execute = acct.code + f"\n{call}"
-    acct.storage["MSGSENDER"] = sender
-    keys_before = [k for k in acct.storage]
-    exec(to_execute, acct.storage)
-    acct.storage = {k: acct.storage[k] for k in keys_before if k != "MSGSENDER"}
-
-
-def read_contract(accounts: list[Account], address: str, variable: str = ""):
-    acct = get_account(accounts, address)
-    if variable == "":
-        print(acct.storage)
-    elif variable in acct.storage:
-        print(acct.storage[variable])
-    else:
-        print(f"Variable {variable} not found in contract {address}")
-
-
-def get_account(accounts: list[Account], address: str) -> Account:
-    for a in accounts:
-        if a.address == address:
-            return a
-    raise AccountNotFound()
-
-
 """
     def a(x):
         b += x
@@ -91,20 +46,56 @@ def get_peers_ports(args: list[str]) -> list[int]:
     return []
 
 
+def get_datadir(args: list[str]) -> str:
+    for a in args:
+        if a.startswith("--datadir="):
+            return a.replace("--datadir=", "")
+    return ""
+
+
+def get_metrics_port(args: list[str]) -> int:
+    for a in args:
+        if a.startswith("--metrics-port="):
+            return int(a.replace("--metrics-port=", ""))
+    return -1
+
+
+def get_rpc_port(args: list[str]) -> int:
+    for a in args:
+        if a.startswith("--rpc-port="):
+            return int(a.replace("--rpc-port=", ""))
+    return -1
+
+
+# Per-block and per-message logs are at info and debug level, off by default.
+def get_log_level(args: list[str]) -> str:
+    for a in args:
+        if a.startswith("--log-level="):
+            return a.replace("--log-level=", "").upper()
+    return "WARNING"
+
+
 LOCALHOST = "127.0.0.1"
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=get_log_level(sys.argv), format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
     node = None
     peers = []
     mine = "--mine" in sys.argv
+    parallel_verify = "--parallel-verify" in sys.argv
+    parallel_execute = "--parallel-execute" in sys.argv
+    datadir = get_datadir(sys.argv)
+    block_store = BlockStore(datadir) if datadir != "" else None
+    snapshots = (
+        StateSnapshots(os.path.join(datadir, "state")) if datadir != "" else None
+    )
     if "--networked" in sys.argv:
         node_port = get_node_port(sys.argv)
         peers = get_peers_ports(sys.argv)
         print(f"Creating node on port {node_port} and peers = {peers}")
         node = Node(LOCALHOST, node_port)
-        node.start()
-        for p in peers:
-            node.connect_with_node(LOCALHOST, p)
 
     if peers == []:
         # No peers. Start a new blockchain from scratch.
@@ -116,9 +107,14 @@ if __name__ == "__main__":
             _xth_last_block_time=0,  # init
             _blocks=[],
             _accounts=[],
+            _parallel_verify=parallel_verify,
+            _parallel_execute=parallel_execute,
+            _block_store=block_store,
+            _snapshots=snapshots,
         )
 
         node.blockchain = blockchain
+        node.start()
 
     else:
         print("Peer list detected. Will sync chain.")
@@ -130,9 +126,17 @@ if __name__ == "__main__":
             _xth_last_block_time=time(),  # init
             _blocks=[],
             _accounts=[],
+            _parallel_verify=parallel_verify,
+            _parallel_execute=parallel_execute,
+            _block_store=block_store,
+            _snapshots=snapshots,
         )
         node.blockchain = blockchain
         node.blockchain.synced = False
+        node.start()
+        # Peers are asked for their state as soon as we connect.
+        for p in peers:
+            node.connect_with_node(LOCALHOST, p)
 
         # Wait for a peer to send the blockchain state.
         while not node.blockchain.synced:
@@ -141,6 +145,16 @@ if __name__ == "__main__":
 
         print("Blockchain synced.")
 
+    metrics_port = get_metrics_port(sys.argv)
+    if metrics_port != -1:
+        metrics_port = node.start_metrics(metrics_port)
+        print(f"Serving metrics on http://{LOCALHOST}:{metrics_port}/metrics")
+
+    rpc_port = get_rpc_port(sys.argv)
+    if rpc_port != -1:
+        rpc_port = node.start_rpc(rpc_port)
+        print(f"Serving JSON-RPC on http://{LOCALHOST}:{rpc_port}")
+
     if mine:
         while True:
             block = Block(
@@ -148,26 +162,26 @@ if __name__ == "__main__":
                 _timestamp=0,
                 _nonce=0,
                 _prev_hash=node.blockchain.blocks[-1].get_block_hash(),
-                _txs=node.blockchain.pending_txs,
+                _txs=node.blockchain.mempool.select(node.blockchain.accounts),
             )
+            # The header commits to the state after the block, executed once here.
+            prepared = node.blockchain.prepare_block(block)
 
             block.mine_nonce(node.blockchain.target, node)
 
             if node.block_found_by_peer:
-                # new_block is stored as JSON in call back.
+                # The peer's block was queued by the node's callbacks.
                 node.blockchain.append_new_blocks()
                 node.block_found_by_peer = False
             else:
-                node.blockchain.execute_block(block)
-                node.blockchain.add_block(block)
-                print("broadcasting block to peers: ", block.to_dict())
-                node.send_to_nodes({"new_block": block.to_dict()})
+                node.blockchain.commit_block(block, *prepared)
+                log.info("broadcasting block to peers: %s", block)
+                # Peers have most txs in their mempool already, they ask for the rest.
+                node.send_to_nodes({"compact_block": compact_block(block)})
 
             prev_hash = node.blockchain.blocks[-1].get_block_hash()
-
-            # processed_txs = block.to_dict()['txs']
-            # node.blockchain.pending_txs = [t for t in node.blockchain.pending_txs if t.__dict__ not in processed_txs]
-            node.blockchain.pending_txs = []
+            # Executed txs left the mempool in add_block(), the rest wait for the next block.
+            log.info("%s", node.blockchain.mempool)
 
     else:
         # a = node.blockchain.accounts[0]
@@ -183,9 +197,7 @@ if __name__ == "__main__":
             # print(tx.__dict__)
             # node.send_to_nodes({"new_tx": tx.__dict__})
             # nonce += 1
-            print(
-                f"Watching blockchain. Current block: {node.blockchain.blocks[-1].number}"
-            )
+            log.info("Watching blockchain. Current block: %d", node.blockchain.blocks[-1].number)
             node.blockchain.append_new_blocks()
             sleep(4)
 
@@ -236,8 +248,8 @@ if __name__ == "__main__":
     block.mine_nonce(blockchain.target)
     blockchain.add_block(block)
 
-    read_contract(accounts, deploy_address_erc20, "ticker")
-    read_contract(accounts, deploy_address_erc20, "balances")
+    print(read_contract(accounts, deploy_address_erc20, "ticker"))
+    print(read_contract(accounts, deploy_address_erc20, "balances"))
 """
 
 
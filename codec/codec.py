@@ -0,0 +1,319 @@
+from transaction.transaction import Transaction
+from block.block import Block
+from functools import lru_cache
+import json
+import struct
+
+# Compact binary encoding of transactions and blocks, for p2p messages and the block store.
+#
+# An encoded transaction or block starts with a version byte. Fields follow in order,
+# each as a one-byte tag and a payload: addresses as 20 bytes plus a mask of their
+# uppercase (checksum) letters, hashes and signatures as raw bytes, and numbers as
+# 8-byte integers or doubles. Any other value falls back to a string or JSON, so every
+# field decodes to exactly what was encoded, and hashes and signatures still match.
+# A block's transactions are length-prefixed, so they're sliced out of the buffer
+# as memoryviews rather than copied.
+VERSION = 1
+
+T_INT = 0  # 8-byte signed integer.
+T_FLOAT = 1  # 8-byte double.
+T_STR = 2  # u32 length, UTF-8.
+T_HEX = 3  # lowercase hex string: u16 length, bytes.
+T_HEX_0X = 4  # same, with a "0x" prefix.
+T_ADDRESS = 5  # "0x" + 40 hex digits of any case: 20 bytes, 5-byte uppercase mask.
+T_EMPTY_DICT = 6
+T_JSON = 7  # u32 length, JSON. For dicts, lists, big integers, booleans and None.
+
+U8 = struct.Struct(">B")
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+I64 = struct.Struct(">q")
+F64 = struct.Struct(">d")
+MASK = 5  # bytes in an address case mask.
+
+
+class DecodeError(ValueError):
+    "Raised when bytes are not a valid encoding."
+    pass
+
+
+# Bytes of a lowercase hex string, or None if it isn't one.
+def hex_bytes(digits: str) -> bytes:
+    try:
+        raw = bytes.fromhex(digits)
+    except ValueError:
+        return None
+    return raw if raw.hex() == digits else None
+
+
+@lru_cache(maxsize=100_000)
+def encode_address(address: str) -> bytes:
+    "20 bytes and a 5-byte uppercase mask, or None if {address} isn't 0x + 40 hex digits."
+    if len(address) != 42 or not address.startswith("0x"):
+        return None
+    digits = address[2:]
+    lower = digits.lower()
+    raw = hex_bytes(lower)
+    if raw is None:
+        return None
+    mask = 0 if digits == lower else sum(1 << i for i, c in enumerate(digits) if c != lower[i])
+    return raw + mask.to_bytes(MASK, "big")
+
+
+@lru_cache(maxsize=100_000)
+def decode_address(raw: bytes) -> str:
+    digits = raw[:20].hex()
+    mask = int.from_bytes(raw[20:], "big")
+    if mask:
+        digits = "".join(c.upper() if mask >> i & 1 else c for i, c in enumerate(digits))
+    return "0x" + digits
+
+
+def encode_value(v, out: bytearray):
+    if type(v) is int and -(2**63) <= v < 2**63:
+        out += U8.pack(T_INT) + I64.pack(v)
+    elif type(v) is float:
+        out += U8.pack(T_FLOAT) + F64.pack(v)
+    elif type(v) is str:
+        prefixed = v.startswith("0x")
+        raw = hex_bytes(v[2:] if prefixed else v)
+        address = encode_address(v) if len(v) == 42 else None
+        if address is not None:
+            out += U8.pack(T_ADDRESS) + address
+        elif raw is not None and len(raw) <= 0xFFFF:
+            out += U8.pack(T_HEX_0X if prefixed else T_HEX) + U16.pack(len(raw)) + raw
+        else:
+            data = v.encode()
+            out += U8.pack(T_STR) + U32.pack(len(data)) + data
+    elif type(v) is dict and v == {}:
+        out += U8.pack(T_EMPTY_DICT)
+    else:
+        data = json.dumps(v, separators=(",", ":")).encode()
+        out += U8.pack(T_JSON) + U32.pack(len(data)) + data
+
+
+class Reader:
+    "Decodes values from a memoryview, keeping track of the offset."
+
+    def __init__(self, buf: memoryview):
+        self.buf = buf
+        self.offset = 0
+
+    def take(self, n: int) -> memoryview:
+        if self.offset + n > len(self.buf):
+            raise DecodeError("Truncated value.")
+        view = self.buf[self.offset : self.offset + n]
+        self.offset += n
+        return view
+
+    def unpack(self, s: struct.Struct):
+        return s.unpack(self.take(s.size))[0]
+
+    def value(self):
+        tag = self.unpack(U8)
+        if tag == T_INT:
+            return self.unpack(I64)
+        if tag == T_FLOAT:
+            return self.unpack(F64)
+        if tag == T_STR:
+            return str(self.take(self.unpack(U32)), "utf-8")
+        if tag == T_HEX:
+            return self.take(self.unpack(U16)).hex()
+        if tag == T_HEX_0X:
+            return "0x" + self.take(self.unpack(U16)).hex()
+        if tag == T_ADDRESS:
+            return decode_address(self.take(20 + MASK).tobytes())
+        if tag == T_EMPTY_DICT:
+            return {}
+        if tag == T_JSON:
+            return json.loads(self.take(self.unpack(U32)).tobytes())
+        raise DecodeError(f"Unknown tag {tag}.")
+
+    def version(self):
+        version = self.unpack(U8)
+        if version != VERSION:
+            raise DecodeError(f"Unknown encoding version {version}.")
+
+
+# Most transactions have this fixed layout after the version and format bytes:
+# from and to addresses, amount (number tag, 8 bytes), nonce, gas price (number tag,
+# 8 bytes), whether the signature has a "0x" prefix and the 65-byte signature.
+# The rest of the buffer is the data as JSON, or nothing if data is {}.
+# Other transactions are a sequence of tagged values.
+TX_FIXED = 0
+TX_TAGGED = 1
+FIXED_TX = struct.Struct(">25s25sB8sqB8sB65s")
+FIXED_HEADER = 2  # version and format bytes.
+
+
+def is_int64(v) -> bool:
+    return type(v) is int and -(2**63) <= v < 2**63
+
+
+def is_number(v) -> bool:
+    return is_int64(v) or type(v) is float
+
+
+def encode_number(v) -> tuple[int, bytes]:
+    return (T_INT, I64.pack(v)) if type(v) is int else (T_FLOAT, F64.pack(v))
+
+
+def decode_number(tag: int, raw: bytes):
+    return (I64 if tag == T_INT else F64).unpack(raw)[0]
+
+
+def signature_bytes(signature) -> bytes:
+    if type(signature) is not str:
+        return None
+    raw = hex_bytes(signature[2:] if signature.startswith("0x") else signature)
+    return raw if raw is not None and len(raw) == 65 else None
+
+
+def encode_tx(tx: Transaction) -> bytes:
+    signature = signature_bytes(tx.signature)
+    fr = encode_address(tx.fr) if type(tx.fr) is str else None
+    to = encode_address(tx.to) if type(tx.to) is str else None
+    fixed = (
+        signature is not None
+        and fr is not None
+        and to is not None
+        and is_number(tx.amount)
+        and is_int64(tx.nonce)
+        and is_number(tx.gas_price)
+    )
+    if not fixed:
+        out = bytearray(U8.pack(VERSION) + U8.pack(TX_TAGGED))
+        for v in (tx.fr, tx.to, tx.amount, tx.nonce, tx.signature, tx.data, tx.gas_price):
+            encode_value(v, out)
+        return bytes(out)
+
+    out = U8.pack(VERSION) + U8.pack(TX_FIXED)
+    out += FIXED_TX.pack(
+        fr,
+        to,
+        *encode_number(tx.amount),
+        tx.nonce,
+        *encode_number(tx.gas_price),
+        tx.signature.startswith("0x"),
+        signature,
+    )
+    if tx.data != {}:
+        out += json.dumps(tx.data, separators=(",", ":")).encode()
+    return out
+
+
+def decode_tx(buf: memoryview) -> Transaction:
+    if len(buf) < FIXED_HEADER or buf[0] != VERSION:
+        raise DecodeError("Unknown transaction encoding.")
+    if buf[1] == TX_TAGGED:
+        r = Reader(buf)
+        r.offset = FIXED_HEADER
+        return Transaction(
+            _fr=r.value(),
+            _to=r.value(),
+            _amount=r.value(),
+            _nonce=r.value(),
+            _signature=r.value(),
+            _data=r.value(),
+            _gas_price=r.value(),
+        )
+
+    if len(buf) < FIXED_HEADER + FIXED_TX.size:
+        raise DecodeError("Truncated transaction.")
+    (fr, to, amount_tag, amount, nonce, gas_tag, gas_price, prefixed, signature) = (
+        FIXED_TX.unpack_from(buf, FIXED_HEADER)
+    )
+    data = buf[FIXED_HEADER + FIXED_TX.size :]
+    return Transaction(
+        _fr=decode_address(fr),
+        _to=decode_address(to),
+        _amount=decode_number(amount_tag, amount),
+        _nonce=nonce,
+        _signature=("0x" if prefixed else "") + signature.hex(),
+        _data=json.loads(data.tobytes()) if len(data) > 0 else {},
+        _gas_price=decode_number(gas_tag, gas_price),
+    )
+
+
+def encode_block(block: Block) -> bytes:
+    out = bytearray(U8.pack(VERSION))
+    for v in (block.number, block.timestamp, block.nonce, block.prev_hash, block.state_root):
+        encode_value(v, out)
+    out += U32.pack(len(block.txs))
+    for tx in block.txs:
+        encoded = encode_tx(tx)
+        out += U32.pack(len(encoded)) + encoded
+    return bytes(out)
+
+
+def decode_block(buf: memoryview) -> Block:
+    r = Reader(buf)
+    r.version()
+    block = Block(
+        _number=r.value(),
+        _timestamp=r.value(),
+        _nonce=r.value(),
+        _prev_hash=r.value(),
+        _state_root=r.value(),
+    )
+    txs = []
+    offset = r.offset + U32.size
+    for _ in range(r.unpack(U32)):
+        (length,) = U32.unpack_from(buf, offset)
+        offset += U32.size
+        if offset + length > len(buf):
+            raise DecodeError("Truncated transaction.")
+        txs.append(decode_tx(buf[offset : offset + length]))
+        offset += length
+    block.txs = txs
+    return block
+
+
+# Messages are JSON, except those carrying blocks or transactions, like
+# {"new_block": Block} or {"blocks": [Block, ...]}, which are encoded as:
+# kind, key, whether the value is a list, item count, then each item length-prefixed.
+MSG_JSON = 0
+MSG_BLOCKS = 1
+MSG_TXS = 2
+
+
+def binary_kind(data: dict) -> int:
+    if len(data) != 1:
+        return MSG_JSON
+    value = next(iter(data.values()))
+    items = value if isinstance(value, list) else [value]
+    if items and all(isinstance(i, Block) for i in items):
+        return MSG_BLOCKS
+    if items and all(isinstance(i, Transaction) for i in items):
+        return MSG_TXS
+    return MSG_JSON
+
+
+def encode_message(data: dict) -> bytes:
+    kind = binary_kind(data)
+    if kind == MSG_JSON:
+        return U8.pack(MSG_JSON) + json.dumps(data).encode()
+    (key, value) = next(iter(data.items()))
+    items = value if isinstance(value, list) else [value]
+    encode = encode_block if kind == MSG_BLOCKS else encode_tx
+    key_bytes = key.encode()
+    out = bytearray(U8.pack(kind) + U8.pack(len(key_bytes)) + key_bytes)
+    out += U8.pack(isinstance(value, list)) + U32.pack(len(items))
+    for i in items:
+        encoded = encode(i)
+        out += U32.pack(len(encoded)) + encoded
+    return bytes(out)
+
+
+def decode_message(buf: memoryview) -> dict:
+    r = Reader(buf)
+    kind = r.unpack(U8)
+    if kind == MSG_JSON:
+        return json.loads(r.take(len(buf) - 1).tobytes())
+    if kind not in (MSG_BLOCKS, MSG_TXS):
+        raise DecodeError(f"Unknown message kind {kind}.")
+    key = str(r.take(r.unpack(U8)), "utf-8")
+    is_list = r.unpack(U8)
+    decode = decode_block if kind == MSG_BLOCKS else decode_tx
+    items = [decode(r.take(r.unpack(U32))) for _ in range(r.unpack(U32))]
+    return {key: items if is_list else items[0]}
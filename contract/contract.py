@@ -0,0 +1,484 @@
+from account.account import Account, AccountStore
+from collections import OrderedDict
+from collections.abc import MutableMapping, MutableSequence
+import ast
+import copy
+import itertools
+import json
+import operator
+
+# Most statements a contract call (or constructor) may execute.
+MAX_CALL_GAS = 1_000_000
+# Name of the metering function in a contract's namespace. It's not a valid identifier,
+# so contract code can only reach it through globals(), and ContractGlobals always
+# resolves it to the call's meter, whatever was stored under it.
+GAS_METER = "$gas"
+
+
+class OutOfGas(Exception):
+    "Raised when a contract executes more statements than its gas limit."
+    pass
+
+
+class ContractFailed(Exception):
+    "Raised when a contract call fails and its storage changes were reverted."
+
+    def __init__(self, gas_used: int, reason: str):
+        super().__init__(reason)
+        self.gas_used = gas_used
+
+
+# Called before every statement and comprehension step of a contract. Returns True
+# {limit} + 1 times, then raises StopIteration: a call that used more than {limit}
+# fails, see gas_used(). The meter is the __next__ of a C iterator, so it has no
+# state contract code could change, unlike a Python object's attributes.
+def gas_meter(limit: int):
+    return itertools.repeat(True, limit + 1).__next__
+
+
+def gas_used(meter, limit: int) -> int:
+    return limit + 1 - meter.__self__.__length_hint__()
+
+
+# Charges {gas} at once, for work done in C. Raises OutOfGas if it's more than is left.
+def charge(meter, gas: int):
+    if gas > 0:
+        next(itertools.islice(meter.__self__, gas - 1, None), None)
+    if meter.__self__.__length_hint__() == 0:
+        raise OutOfGas()
+
+
+# Builtins available to contracts. There's no __import__, open or exec, and none that
+# can run without a bound in C, like iter(callable, sentinel) or pow().
+SAFE_BUILTINS = {
+    f.__name__: f
+    for f in [
+        abs, bool, chr, dict, divmod, enumerate, filter, float, frozenset, hex, int,
+        isinstance, len, list, map, ord, repr, reversed, round, set, str, tuple, zip,
+        ArithmeticError, AssertionError, Exception, IndexError, KeyError, TypeError,
+        ValueError, ZeroDivisionError,
+    ]
+}
+# Functions that go through a whole iterable in C. They cost one gas per item.
+# Types like list stay types, for isinstance().
+CONSUMERS = [all, any, max, min, sorted, sum]
+
+
+def metered_consumer(f, meter):
+    def call(*args, **kwargs):
+        if len(args) != 1:  # e.g. max(a, b).
+            return f(*args, **kwargs)
+        result = f(map(operator.itemgetter(0), zip(args[0], meter.__self__)), **kwargs)
+        charge(meter, 0)  # zip stopped early if the meter ran out.
+        return result
+
+    return call
+
+
+# Builtins for a call metered by {meter}. range() charges its length up front, so
+# sum(range(10**8)) runs out of gas instead of running for seconds.
+def contract_builtins(meter) -> dict:
+    def metered_range(*args):
+        r = range(*args)
+        charge(meter, len(r))
+        return r
+
+    builtins = dict(SAFE_BUILTINS, range=metered_range)
+    for f in CONSUMERS:
+        builtins[f.__name__] = metered_consumer(f, meter)
+    return builtins
+
+
+class Meter(ast.NodeTransformer):
+    "Instruments contract code so that every statement and comprehension step costs gas."
+
+    def generic_visit(self, node):
+        super().generic_visit(node)
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list) and value and isinstance(value[0], ast.stmt):
+                metered = []
+                for stmt in value:
+                    metered += [ast.Expr(gas_call()), stmt]
+                setattr(node, field, metered)
+        return node
+
+    def visit_comprehension(self, node):
+        self.generic_visit(node)
+        node.ifs.insert(0, gas_call())
+        return node
+
+
+def gas_call() -> ast.Call:
+    return ast.Call(func=ast.Name(id=GAS_METER, ctx=ast.Load()), args=[], keywords=[])
+
+
+def compile_metered(source: str, filename: str):
+    tree = ast.fix_missing_locations(Meter().visit(ast.parse(source)))
+    return compile(tree, filename, "exec")
+
+
+class ContractCache:
+    "Bounded LRU map of code hash -> compiled contract code."
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.compiled = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # {key} is the code's hash, computed once when the contract is deployed (see Account.code_hash).
+    def get(self, code: str, key: str):
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            self.misses += 1
+            compiled = compile_metered(code, f"<contract {key[:8]}>")
+            self.compiled[key] = compiled
+            if len(self.compiled) > self.max_size:
+                self.compiled.popitem(last=False)
+        else:
+            self.hits += 1
+            self.compiled.move_to_end(key)
+        return compiled
+
+    def __str__(self) -> str:
+        return f"Contract cache: {self.hits} hits, {self.misses} misses, {len(self.compiled)}/{self.max_size} entries."
+
+
+# Contract sources are compiled once, when deployed (or first called after a restart).
+# Running the cached code object only binds the contract's functions to a storage namespace.
+contract_cache = ContractCache(1_000)
+
+
+class Journal:
+    """Undo log of the changes a call makes to storage containers, so a failed call can
+    be reverted without copying storage up front. Also records which storage keys changed."""
+
+    MISSING = object()
+
+    def __init__(self):
+        self.undo_log = []
+        self.saved_lists = set()
+        self.dirty = set()
+
+    def wrap(self, value, root: str):
+        if type(value) is dict:
+            return TrackedDict(value, self, root)
+        if type(value) is list:
+            return TrackedList(value, self, root)
+        return value
+
+    def record_key(self, target: dict, key, root: str):
+        self.undo_log.append((target, key, target.get(key, Journal.MISSING)))
+        self.dirty.add(root)
+
+    def record_list(self, target: list, root: str):
+        if id(target) not in self.saved_lists:  # lists are saved whole, once per call.
+            self.saved_lists.add(id(target))
+            self.undo_log.append((target, None, list(target)))
+        self.dirty.add(root)
+
+    def undo(self):
+        for target, key, old in reversed(self.undo_log):
+            if isinstance(target, list):
+                target[:] = old
+            elif old is Journal.MISSING:
+                target.pop(key, None)
+            else:
+                target[key] = old
+        self.undo_log = []
+
+
+# The plain value to store. Storage containers are stored unwrapped, also when
+# they're nested in a container the contract built.
+def unwrap(value):
+    if isinstance(value, (TrackedDict, TrackedList)):
+        return value.target
+    if type(value) is dict:
+        for k, v in value.items():
+            if type(v) in CONTAINERS:
+                value[k] = unwrap(v)
+    elif type(value) is list:
+        for i, v in enumerate(value):
+            if type(v) in CONTAINERS:
+                value[i] = unwrap(v)
+    return value
+
+
+# A copy that shares nothing with storage, for operations that build a new container.
+def detached(value):
+    return copy.deepcopy(unwrap(value))
+
+
+class TrackedDict(MutableMapping):
+    """A storage dict as seen by a contract, journaling every change. It behaves as a
+    dict, isinstance() included. Copies and merges are plain dicts, detached from storage."""
+
+    def __init__(self, target: dict, journal: Journal, root: str):
+        self.target = target
+        self.journal = journal
+        self.root = root
+
+    @property
+    def __class__(self):
+        return dict
+
+    def __getitem__(self, key):
+        return self.journal.wrap(self.target[key], self.root)
+
+    def __setitem__(self, key, value):
+        self.journal.record_key(self.target, key, self.root)
+        self.target[key] = unwrap(value)
+
+    def __delitem__(self, key):
+        self.journal.record_key(self.target, key, self.root)
+        del self.target[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.target
+
+    def __iter__(self):
+        return iter(self.target)
+
+    def __reversed__(self):
+        return reversed(self.target)
+
+    def __len__(self) -> int:
+        return len(self.target)
+
+    def __eq__(self, other) -> bool:
+        return self.target == unwrap(other)
+
+    def __or__(self, other) -> dict:
+        return detached(self) | detached(other)
+
+    def __ror__(self, other) -> dict:
+        return detached(other) | detached(self)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def copy(self) -> dict:
+        return detached(self)
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo) -> dict:
+        return detached(self)
+
+    def __repr__(self) -> str:
+        return repr(self.target)
+
+
+class TrackedList(MutableSequence):
+    """A storage list as seen by a contract, journaling every change. It behaves as a
+    list, isinstance() included. Copies, slices and concatenations are plain lists,
+    detached from storage."""
+
+    def __init__(self, target: list, journal: Journal, root: str):
+        self.target = target
+        self.journal = journal
+        self.root = root
+
+    @property
+    def __class__(self):
+        return list
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return detached(self.target[i])
+        return self.journal.wrap(self.target[i], self.root)
+
+    def __setitem__(self, i, value):
+        self.journal.record_list(self.target, self.root)
+        self.target[i] = [unwrap(v) for v in value] if isinstance(i, slice) else unwrap(value)
+
+    def __delitem__(self, i):
+        self.journal.record_list(self.target, self.root)
+        del self.target[i]
+
+    def insert(self, i, value):
+        self.journal.record_list(self.target, self.root)
+        self.target.insert(i, unwrap(value))
+
+    def append(self, value):
+        self.journal.record_list(self.target, self.root)
+        self.target.append(unwrap(value))
+
+    def extend(self, values):
+        values = [unwrap(v) for v in values]  # before recording, in case values is self.
+        self.journal.record_list(self.target, self.root)
+        self.target.extend(values)
+
+    def clear(self):
+        self.journal.record_list(self.target, self.root)
+        self.target.clear()
+
+    def sort(self, *, key=None, reverse=False):
+        self.journal.record_list(self.target, self.root)
+        self.target.sort(key=key, reverse=reverse)
+
+    def reverse(self):
+        self.journal.record_list(self.target, self.root)
+        self.target.reverse()
+
+    def __contains__(self, value) -> bool:
+        return unwrap(value) in self.target
+
+    def __len__(self) -> int:
+        return len(self.target)
+
+    def __eq__(self, other) -> bool:
+        return self.target == unwrap(other)
+
+    def __lt__(self, other) -> bool:
+        return self.target < unwrap(other)
+
+    def __le__(self, other) -> bool:
+        return self.target <= unwrap(other)
+
+    def __gt__(self, other) -> bool:
+        return self.target > unwrap(other)
+
+    def __ge__(self, other) -> bool:
+        return self.target >= unwrap(other)
+
+    def __add__(self, other) -> list:
+        return detached(self) + detached(other)
+
+    def __radd__(self, other) -> list:
+        return detached(other) + detached(self)
+
+    def __mul__(self, n: int) -> list:
+        return detached(self) * n
+
+    __rmul__ = __mul__
+
+    def __imul__(self, n: int):
+        self.journal.record_list(self.target, self.root)
+        self.target *= n
+        return self
+
+    def copy(self) -> list:
+        return detached(self)
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo) -> list:
+        return detached(self)
+
+    def __repr__(self) -> str:
+        return repr(self.target)
+
+
+CONTAINERS = (dict, list, TrackedDict, TrackedList)
+
+
+class ContractGlobals(dict):
+    """Namespace a contract call runs in. Contract functions, MSGSENDER and metered
+    builtins live here, apart from the account's storage. Storage variables are read through on first
+    use, and assignments to them land here, so this dict ends up as the write set.
+    Containers read from storage are journaled, so a failed call is undone.
+    Its attributes can't be reassigned, so the gas meter can't be swapped."""
+
+    __slots__ = ("storage", "journal", "meter")
+
+    def __init__(self, storage: dict, sender: str, meter):
+        super().__init__(MSGSENDER=sender, __builtins__=contract_builtins(meter))
+        object.__setattr__(self, "storage", storage)
+        object.__setattr__(self, "journal", Journal())
+        object.__setattr__(self, "meter", meter)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Contract namespaces are read only.")
+
+    def __delattr__(self, name):
+        raise AttributeError("Contract namespaces are read only.")
+
+    def __getitem__(self, key):
+        if key == GAS_METER:
+            return self.meter
+        return super().__getitem__(key)
+
+    def __missing__(self, key):
+        return self.journal.wrap(self.storage[key], key)
+
+    # Writes assigned variables back to storage. Returns the keys that changed.
+    # Raises TypeError, leaving assigned variables unwritten, if a changed variable
+    # can't be encoded as JSON, like state roots encode storage (e.g. a set).
+    def commit(self) -> set[str]:
+        written = {k: unwrap(self[k]) for k in self if k in self.storage}
+        changed = written.keys() | self.journal.dirty
+        json.dumps([written.get(k, self.storage.get(k)) for k in changed], sort_keys=True)
+        self.storage.update(written)
+        return changed
+
+    def revert(self):
+        self.journal.undo()
+
+
+# Runs {call} (e.g. "transfer('0x...', 10)") against the contract code and {storage},
+# metering both. Variables the contract didn't declare in its storage are not kept.
+# Returns the changed storage keys and the gas used. If the contract runs out of gas,
+# raises or leaves storage that isn't JSON, its storage changes are reverted and
+# ContractFailed is raised.
+def run_contract(
+    code: str,
+    code_hash: str,
+    call: str,
+    storage: dict,
+    sender: str,
+    gas_limit: int = MAX_CALL_GAS,
+) -> tuple[set[str], int]:
+    meter = gas_meter(gas_limit)
+    namespace = ContractGlobals(storage, sender, meter)
+    try:
+        exec(contract_cache.get(code, code_hash), namespace)
+        exec(compile_metered(call, "<call>"), namespace)
+        if gas_used(meter, gas_limit) > gas_limit:  # the contract caught StopIteration.
+            raise OutOfGas()
+        changed = namespace.commit()
+    except BaseException as e:  # SystemExit too, which would stop the node.
+        namespace.revert()
+        used = gas_used(meter, gas_limit)
+        reason = "out of gas" if used > gas_limit else repr(e)
+        raise ContractFailed(min(used, gas_limit), reason)
+    return (changed, gas_used(meter, gas_limit))
+
+
+# Returns the gas used. The contract isn't created if its constructor fails.
+def deploy_contract(
+    sender: str,
+    code: str,
+    variables: dict,
+    deploy_address: str,
+    accounts: AccountStore,
+    gas_limit: int = MAX_CALL_GAS,
+) -> int:
+    storage = copy.deepcopy(variables)  # don't share objects with the transaction data.
+    contract = Account(_address=deploy_address, _code=code, _storage=storage)
+    (_, gas_used) = run_contract(
+        code, contract.code_hash, "constructor()", storage, sender, gas_limit
+    )
+    accounts.append(contract)
+    return gas_used
+
+
+# Returns the storage keys the call changed, empty for read-only calls, and the gas used.
+def call_contract(
+    accounts: AccountStore,
+    sender: str,
+    address: str,
+    call: str,
+    gas_limit: int = MAX_CALL_GAS,
+) -> tuple[set[str], int]:
+    acct = accounts.get(address)
+    return run_contract(
+        acct.code, acct.code_hash, call, acct.storage, sender, gas_limit
+    )
+
+
+# The contract's storage, or one of its variables (None if it has no such variable).
+def read_contract(accounts: AccountStore, address: str, variable: str = ""):
+    storage = accounts.get(address).storage
+    return storage if variable == "" else storage.get(variable)
@@ -0,0 +1,236 @@
+from account.account import AccountStore, AccountOverlay, ZERO_ADDRESS
+from transaction.transaction import Transaction
+from contract.contract import (
+    deploy_contract,
+    call_contract,
+    ContractFailed,
+    MAX_CALL_GAS,
+)
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import heapq
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+# Process pool for parallel block execution, created on first use.
+_execute_pool = None
+
+
+# Gas a transaction's contract execution may use: what the sender can pay for, up to MAX_CALL_GAS.
+def call_gas_limit(gas_price: float, balance: float) -> int:
+    if gas_price <= 0:
+        return MAX_CALL_GAS
+    return max(0, min(MAX_CALL_GAS, int(balance // gas_price)))
+
+
+def deploy_address(t: Transaction) -> str:
+    return "0x" + hashlib.sha256((t.fr + str(t.nonce)).encode()).hexdigest()[:40]
+
+
+def is_deployment(t: Transaction) -> bool:
+    return t.to == ZERO_ADDRESS and t.data != {}
+
+
+# Field types and data shape that execution relies on. Signatures and hashes format
+# fields as text, so a relayed transaction could have its amount changed from 1 to
+# "1" and still verify. Deployments need code and variables, contract calls a call.
+def well_formed(t: Transaction) -> bool:
+    if not all(type(v) is str for v in (t.fr, t.to, t.signature)):
+        return False
+    if not all(type(v) is int and v >= 0 for v in (t.amount, t.nonce, t.gas_price)):
+        return False
+    if type(t.data) is not dict or t.data == {}:
+        return t.data == {}
+    if t.to == ZERO_ADDRESS:
+        return (
+            t.data.keys() == {"code", "variables"}
+            and type(t.data["code"]) is str
+            and type(t.data["variables"]) is dict
+        )
+    return t.data.keys() == {"call"} and type(t.data["call"]) is str
+
+
+# Applies one transaction to {accounts}. Returns the addresses it changed.
+def execute_transaction(
+    accounts: AccountStore, t: Transaction, valid_signature: bool
+) -> set[str]:
+    if not well_formed(t):
+        log.info("Can't process transaction, malformed fields or data.")
+        return set()
+    if t.fr not in accounts or t.to not in accounts:
+        log.info("Can't process transaction, unknown sender or recipient.")
+        return set()
+    fr_account = accounts.get(t.fr)
+    to_account = accounts.get(t.to)
+
+    if t.amount > fr_account.balance:
+        log.info("Can't process transaction, amount more than balance.")
+        # Raise InsufficientBalance()
+        return set()
+
+    if not valid_signature:
+        log.info("Can't verify signature.")
+        return set()
+
+    if t.nonce != fr_account.nonce:
+        log.info("Transaction nonce (%s) differs from account nonce (%s).", t.nonce, fr_account.nonce)
+        return set()
+
+    fr_account.balance -= t.amount
+    to_account.balance += t.amount
+    fr_account.nonce += 1
+    changed = {t.fr}
+    if t.amount != 0:
+        changed.add(t.to)
+
+    gas_limit = call_gas_limit(t.gas_price, fr_account.balance)
+    gas_used = 0
+    try:
+        if is_deployment(t):  # contract creation
+            address = deploy_address(t)
+            gas_used = deploy_contract(
+                t.fr, t.data["code"], t.data["variables"], address, accounts, gas_limit
+            )
+            changed.add(address)
+
+        elif to_account.code != "" and t.data != {}:  # contract call
+            (storage_changed, gas_used) = call_contract(
+                accounts, t.fr, t.to, t.data["call"], gas_limit
+            )
+            if storage_changed:  # read-only calls don't need a snapshot.
+                changed.add(t.to)
+    except ContractFailed as e:
+        log.info("Contract execution failed (%s), storage reverted.", e)
+        gas_used = e.gas_used
+    fr_account.balance -= gas_used * t.gas_price
+    return changed
+
+
+# Applies transactions in order. Returns the addresses they changed.
+def execute_serial(
+    accounts: AccountStore, txs: list[Transaction], valid_signatures: list[bool]
+) -> set[str]:
+    changed = set()
+    for t, valid_signature in zip(txs, valid_signatures):
+        changed |= execute_transaction(accounts, t, valid_signature)
+    return changed
+
+
+# Splits transactions into groups that touch disjoint sets of addresses (sender,
+# recipient and deployed contract), keeping block order within each group.
+# Returns the groups as lists of indexes into {txs}, ordered by their first transaction.
+def partition(txs: list[Transaction]) -> list[list[int]]:
+    parent = {}
+
+    def find(a: str) -> str:
+        while parent.setdefault(a, a) != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    for t in txs:
+        addresses = [t.fr, t.to] + ([deploy_address(t)] if is_deployment(t) else [])
+        root = find(addresses[0])
+        for a in addresses[1:]:
+            parent[find(a)] = root
+
+    groups = {}
+    for i, t in enumerate(txs):
+        groups.setdefault(find(t.fr), []).append(i)
+    return list(groups.values())
+
+
+# Spreads groups over {n} batches of about the same number of transactions.
+# Returns each batch's transaction indexes, in block order.
+def batch_groups(groups: list[list[int]], n: int) -> list[list[int]]:
+    batches = [(0, i, []) for i in range(min(n, len(groups)))]
+    for group in sorted(groups, key=len, reverse=True):
+        (size, i, batch) = heapq.heappop(batches)
+        batch += group
+        heapq.heappush(batches, (size + len(group), i, batch))
+    return [sorted(batch) for (_, _, batch) in sorted(batches, key=lambda b: b[1])]
+
+
+def _execute_batch(
+    accounts: list, txs: list[Transaction], valid_signatures: list[bool]
+) -> tuple[list, set[str]]:
+    store = AccountStore(accounts)
+    changed = execute_serial(store, txs, valid_signatures)
+    return ([store.get(a) for a in changed if a in store], changed)
+
+
+# Parallel execution, partitioned statically. Transactions are split into groups by the
+# addresses they name (sender, recipient and deployed contract), and the groups into one
+# batch per worker. A transaction only reads and writes the accounts it names, since
+# contracts can't reach other accounts, so batches never conflict and there's nothing
+# to detect at run time. Batches run in a process pool on copies of their accounts, and
+# the changed accounts are merged back: the outcome is the same as in block order.
+# Shipping accounts to workers costs more than small blocks save, see the benchmarks.
+def execute_parallel(
+    accounts: AccountStore, txs: list[Transaction], valid_signatures: list[bool]
+) -> set[str]:
+    global _execute_pool
+    # Plain transfers take microseconds, less than shipping their accounts to a worker.
+    if all(t.data == {} for t in txs):
+        return execute_serial(accounts, txs, valid_signatures)
+    groups = partition(txs)
+    if len(groups) < 2:
+        return execute_serial(accounts, txs, valid_signatures)
+    if _execute_pool is None:
+        _execute_pool = ProcessPoolExecutor()
+
+    futures = []
+    for batch in batch_groups(groups, max(2, os.cpu_count() or 1)):
+        batch_txs = [txs[i] for i in batch]
+        addresses = {a for t in batch_txs for a in (t.fr, t.to)}
+        futures.append(
+            _execute_pool.submit(
+                _execute_batch,
+                [accounts.get(a) for a in addresses if a in accounts],
+                batch_txs,
+                [valid_signatures[i] for i in batch],
+            )
+        )
+    results = [f.result() for f in futures]
+    changed = set()
+    deployed = {}
+    for updated, batch_changed in results:
+        changed |= batch_changed
+        for account in updated:
+            if account.address in accounts:
+                accounts.get(account.address).__dict__.update(account.__dict__)
+            else:
+                deployed[account.address] = account
+    # New contracts are appended in the order they were deployed, as in serial execution.
+    for t in txs:
+        if is_deployment(t) and deploy_address(t) in deployed:
+            accounts.append(deployed.pop(deploy_address(t)))
+    return changed
+
+
+# Executes transactions on copies of the accounts they touch, leaving {accounts} as is.
+# Returns the copies, as an AccountOverlay, and the addresses changed, see commit_accounts().
+def execute_on_copies(
+    accounts: AccountStore,
+    txs: list[Transaction],
+    valid_signatures: list[bool],
+    parallel: bool = False,
+) -> tuple[AccountOverlay, set[str]]:
+    execute = execute_parallel if parallel else execute_serial
+    copies = AccountOverlay(accounts)
+    return (copies, execute(copies, txs, valid_signatures))
+
+
+# Applies the changes made by execute_on_copies() to {accounts}. Changed accounts are
+# updated in place, and new contracts appended in the order they were deployed.
+def commit_accounts(accounts: AccountStore, copies: AccountOverlay, changed: set[str]):
+    for account in copies:
+        if account.address not in changed:
+            continue
+        account.storage = dict(account.storage)  # no longer a view of the old storage.
+        if account.address in accounts:
+            accounts.get(account.address).__dict__.update(account.__dict__)
+        else:
+            accounts.append(account)
@@ -0,0 +1,150 @@
+from account.account import AccountStore
+from transaction.transaction import Transaction
+from execution.execution import well_formed
+import functools
+import heapq
+import json
+import threading
+
+# Limits on what the mempool holds. Past them, the cheapest transactions are evicted.
+MAX_MEMPOOL_TXS = 5_000
+MAX_MEMPOOL_BYTES = 4 * 1024 * 1024
+# Transactions pulled into a block template.
+MAX_BLOCK_TXS = 1_000
+
+
+def tx_size(tx: Transaction) -> int:
+    return len(json.dumps(tx.to_dict()))
+
+
+# Runs a Mempool method holding its lock.
+def locked(method):
+    @functools.wraps(method)
+    def run(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return run
+
+
+class Mempool:
+    """Pending transactions, indexed by hash and queued per sender by nonce.
+    A sender's transaction with a nonce already in the pool only replaces the old one
+    if it pays a higher gas price. When the pool is full, the last queued transaction
+    of the sender paying the least is evicted, so no gaps are left in nonce queues.
+    The network thread adds transactions while the miner selects and prunes them,
+    so every method holds a lock. Read by_hash and by_sender through methods."""
+
+    def __init__(self, max_txs: int = MAX_MEMPOOL_TXS, max_bytes: int = MAX_MEMPOOL_BYTES):
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.by_hash = {}
+        self.by_sender = {}  # sender -> {nonce: tx}
+        self.size = 0
+        self.lock = threading.RLock()
+
+    # Returns False if the transaction was malformed, a duplicate, underpriced or didn't fit.
+    @locked
+    def add(self, tx: Transaction) -> bool:
+        if not well_formed(tx):  # e.g. a negative gas price, that pays the sender.
+            return False
+        tx_hash = tx.get_tx_hash()
+        if tx_hash in self.by_hash:
+            return False
+        queue = self.by_sender.setdefault(tx.fr, {})
+        if tx.nonce in queue:
+            if tx.gas_price <= queue[tx.nonce].gas_price:
+                return False
+            self.remove(queue[tx.nonce])
+            queue = self.by_sender.setdefault(tx.fr, {})
+
+        queue[tx.nonce] = tx
+        self.by_hash[tx_hash] = tx
+        self.size += tx_size(tx)
+        while len(self.by_hash) > self.max_txs or self.size > self.max_bytes:
+            evicted = self.eviction_candidate()
+            self.remove(evicted)
+            if evicted is tx:
+                return False
+        return True
+
+    def eviction_candidate(self) -> Transaction:
+        return min(
+            (queue[max(queue)] for queue in self.by_sender.values()),
+            key=lambda tx: tx.gas_price,
+        )
+
+    @locked
+    def remove(self, tx: Transaction):
+        del self.by_hash[tx.get_tx_hash()]
+        queue = self.by_sender[tx.fr]
+        del queue[tx.nonce]
+        if queue == {}:
+            del self.by_sender[tx.fr]
+        self.size -= tx_size(tx)
+
+    # Drops transactions whose nonce was already used, e.g. after a block was added.
+    @locked
+    def prune(self, accounts: AccountStore):
+        for sender in list(self.by_sender):
+            if sender not in accounts:
+                continue
+            nonce = accounts.get(sender).nonce
+            for tx in [t for n, t in self.by_sender[sender].items() if n < nonce]:
+                self.remove(tx)
+
+    # Block template: transactions that can execute on top of {accounts}, in nonce
+    # order per sender and by gas price across senders. Transactions to accounts that
+    # don't exist yet, like contracts deployed by the same template, wait for a later
+    # block. Transactions stay in the pool until prune() sees them executed, in case
+    # the template is discarded.
+    @locked
+    def select(self, accounts: AccountStore, max_txs: int = MAX_BLOCK_TXS) -> list[Transaction]:
+        heads = []  # (-gas_price, arrival, tx) for the next executable tx of each sender.
+        balances = {}
+        for sender, queue in self.by_sender.items():
+            if sender not in accounts:
+                continue
+            account = accounts.get(sender)
+            balances[sender] = account.balance
+            if account.nonce in queue:
+                tx = queue[account.nonce]
+                heads.append((-tx.gas_price, len(heads), tx))
+        heapq.heapify(heads)
+
+        txs = []
+        while heads and len(txs) < max_txs:
+            _, i, tx = heapq.heappop(heads)
+            if tx.amount > balances[tx.fr] or tx.to not in accounts:
+                continue  # the rest of this sender's queue can't execute either.
+            balances[tx.fr] -= tx.amount
+            txs.append(tx)
+            next_tx = self.by_sender[tx.fr].get(tx.nonce + 1)
+            if next_tx is not None:
+                heapq.heappush(heads, (-next_tx.gas_price, i, next_tx))
+        return txs
+
+    # (hash, tx) of every transaction, as a list that's safe to iterate.
+    @locked
+    def items(self) -> list[tuple[str, Transaction]]:
+        return list(self.by_hash.items())
+
+    # The nonce after {sender}'s transactions queued from {nonce} on.
+    @locked
+    def next_nonce(self, sender: str, nonce: int) -> int:
+        queue = self.by_sender.get(sender, {})
+        while nonce in queue:
+            nonce += 1
+        return nonce
+
+    @locked
+    def __contains__(self, tx_hash: str) -> bool:
+        return tx_hash in self.by_hash
+
+    @locked
+    def __len__(self) -> int:
+        return len(self.by_hash)
+
+    @locked
+    def __str__(self) -> str:
+        return f"Mempool: {len(self.by_hash)}/{self.max_txs} txs, {self.size}/{self.max_bytes} bytes, {len(self.by_sender)} senders."
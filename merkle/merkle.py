@@ -0,0 +1,46 @@
+import hashlib
+
+# Root of a block without transactions.
+EMPTY_ROOT = "0" * 64
+
+
+def hash_pair(left: str, right: str) -> str:
+    return hashlib.sha256(f"{left}{right}".encode()).hexdigest()
+
+
+# Hashes of each level of the tree, from the leaves up to the root. A node without
+# a sibling is carried up to the next level as is, rather than paired with itself.
+def merkle_levels(leaves: list[str]) -> list[list[str]]:
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [hash_pair(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2 == 1:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_root(leaves: list[str]) -> str:
+    if leaves == []:
+        return EMPTY_ROOT
+    return merkle_levels(leaves)[-1][0]
+
+
+# Sibling hashes from leaf {index} up to the root, as [hash, side] pairs where
+# side tells whether the sibling goes on the "left" or the "right".
+def merkle_proof(leaves: list[str], index: int) -> list[list[str]]:
+    proof = []
+    for level in merkle_levels(leaves)[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append([level[sibling], "left" if sibling < index else "right"])
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf: str, proof: list[list[str]], root: str) -> bool:
+    h = leaf
+    for sibling, side in proof:
+        h = hash_pair(sibling, h) if side == "left" else hash_pair(h, sibling)
+    return h == root
@@ -0,0 +1,116 @@
+import asyncio
+from bisect import bisect_left
+
+# Counters and histograms for the hot paths, rendered in the Prometheus text format.
+# Updating one is an addition or two, cheap enough for mining and execution loops.
+# Metrics are process wide, like the signature and contract caches, and updates
+# aren't locked: a concurrent update can very rarely be lost.
+
+# Histogram buckets, in seconds.
+TIME_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+
+class Counter:
+    "A value that only goes up, like hashes tried or bytes sent."
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n: float = 1):
+        self.value += n
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Gauge:
+    "A value that goes up and down. Either set, or read from {fn} when rendered."
+
+    def __init__(self, name: str, help: str, fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> list[str]:
+        value = self.fn() if self.fn is not None else self.value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    "Observations counted in buckets of their upper bounds, with their count and sum."
+
+    def __init__(self, name: str, help: str, buckets: list[float] = TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf.
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines += [f"{self.name}_sum {self.sum}", f"{self.name}_count {self.count}"]
+        return lines
+
+
+class Registry:
+    "The metrics a process exposes, by name."
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.add(Counter(name, help))
+
+    def gauge(self, name: str, help: str, fn=None) -> Gauge:
+        return self.add(Gauge(name, help, fn))
+
+    def histogram(self, name: str, help: str, buckets: list[float] = TIME_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics.values() for line in m.render()) + "\n"
+
+
+registry = Registry()
+
+
+# Minimal HTTP/1.0 server for Prometheus scrapes: GET /metrics returns registry.render().
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # headers.
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+            (status, body) = ("200 OK", registry.render().encode())
+        else:
+            (status, body) = ("404 Not Found", b"Not found.\n")
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except OSError:
+        pass
+    finally:
+        writer.close()
@@ -1,64 +1,445 @@
-from transaction.transaction import Transaction
-from p2pnetwork.node import Node as p2pNode
+from block.block import Block, header_from_dict
+from merkle.merkle import verify_merkle_proof
+from relay.relay import BlockReconstruction
+from state.state import StateNotFound, verify_state_proof
+from store.store import BlockNotFound
+from sync.sync import StateExport, StateImport, BlockDownload, MAX_HEADERS
+from transport.transport import Transport
+from transaction.transaction import verify_signatures
+from execution.execution import well_formed
+from metrics.metrics import registry, serve_metrics
+from rpc.rpc import RPCServer
 from hexbytes import HexBytes
+import asyncio
+import logging
 
-# p2pNode is the Node implementation as provided by the p2pnetwork package.
+log = logging.getLogger(__name__)
+
+messages_received = registry.counter("simplechain_messages_received_total", "Messages received from peers.")
+mempool_txs = registry.gauge("simplechain_mempool_txs", "Transactions in the mempool.")
+peer_count = registry.gauge("simplechain_peers", "Connected peers.")
+txs_relayed = registry.counter("simplechain_txs_relayed_total", "Transactions sent to peers in new_txs batches.")
+
+# New transactions are relayed to peers in batches, every TX_RELAY_INTERVAL seconds,
+# rather than in a message each.
+TX_RELAY_INTERVAL = 0.5
+MAX_TX_BATCH = 1_000
+
+# Transport is the peer-to-peer layer, with the callbacks of the p2pnetwork package's Node.
 # We have to extend it to do blockchain stuff.
 
 
-class Node(p2pNode):
+class Node(Transport):
     # Python class constructor
     def __init__(self, host, port, id=None, callback=None, max_connections=0):
         super(Node, self).__init__(host, port, id, callback, max_connections)
         self.block_found_by_peer = False
+        self.state_export = None  # latest state served to syncing peers.
+        self.state_import = None  # state being synced from a peer.
+        self.state_peer = None
+        self.headers_peer = None  # peer we're catching up from, headers first.
+        self.block_download = None
+        self.tx_proofs = {}  # tx hash -> header of the block proven to include it, or None.
+        self.account_proofs = {}  # address -> (header, proven account state), or None.
+        self.compact_blocks = {}  # peer -> BlockReconstruction waiting for its missing txs.
+        self.tx_relay = []  # (tx, peer it came from or None) added since the last relay.
+        self.relay_task = None
+        self.metrics_server = None
+        self.rpc_server = None
+
+    # Serves the metrics on http://{host}:{port}/metrics, in the Prometheus text format.
+    # Returns the port, which the OS picks if {port} is 0.
+    def start_metrics(self, port: int) -> int:
+        mempool_txs.fn = lambda: len(self.blockchain.mempool)
+        peer_count.fn = lambda: len(self.all_nodes)
+        self.metrics_server = self.call(asyncio.start_server(serve_metrics, self.host, port))
+        return self.metrics_server.sockets[0].getsockname()[1]
+
+    # Serves the JSON-RPC API (see rpc.rpc) on http://{host}:{port}. Returns the port.
+    def start_rpc(self, port: int) -> int:
+        self.rpc_server = self.call(asyncio.start_server(RPCServer(self).serve, self.host, port))
+        return self.rpc_server.sockets[0].getsockname()[1]
+
+    async def start_server(self):
+        await super(Node, self).start_server()
+        self.relay_task = self.loop.create_task(self.relay_txs_periodically())
+
+    async def close(self):
+        for server in [self.metrics_server, self.rpc_server]:
+            if server is not None:
+                server.close()
+        if self.relay_task is not None:
+            self.relay_task.cancel()
+        await super(Node, self).close()
 
     def outbound_node_connected(self, connected_node):
-        print(f"outbound_node_connected: {connected_node.port}")
+        log.info("outbound_node_connected: %s", connected_node.port)
+        if not self.blockchain.synced and self.state_peer is None:
+            self.request_state(connected_node)
+        elif self.blockchain.synced:
+            self.request_headers(connected_node)
 
     def inbound_node_connected(self, connected_node):
-        print(f"inbound_node_connected: {connected_node.port}")
-        print(f"sending blockchain state to: {connected_node.port}")
-        self.send_to_nodes({"state": self.blockchain.save_state()})
+        log.info("inbound_node_connected: %s", connected_node.port)
 
     def inbound_node_disconnected(self, connected_node):
-        print(f"inbound_node_disconnected: {connected_node.port}")
+        log.info("inbound_node_disconnected: %s", connected_node.port)
+        self.peer_disconnected(connected_node)
 
     def outbound_node_disconnected(self, connected_node):
-        print(f"outbound_node_disconnected: {connected_node.port}")
+        log.info("outbound_node_disconnected: %s", connected_node.port)
+        if connected_node is self.state_peer:  # resume the sync from another peer.
+            self.state_peer = None
+            for n in self.nodes_outbound:
+                if n is not connected_node:
+                    self.request_state(n)
+                    break
+        self.peer_disconnected(connected_node)
 
-    def node_message(self, connected_node, data):
-        # print(f"node_message from {connected_node.port}" + ": " + str(data))
-        print(f"node_message from {connected_node.port}.")
-        # self.block_found_by_peer = True
-        if "state" in data and not self.blockchain.synced:  # Initial sync.
-            print(f"Got initial blockchain state from {connected_node.port}")
-            self.blockchain.load_state(data["state"])
+    def peer_disconnected(self, connected_node):
+        self.compact_blocks.pop(connected_node, None)
+        if connected_node is self.headers_peer:
+            self.headers_peer = None
+        if self.block_download is not None:  # its blocks go to other peers.
+            self.block_download.add(connected_node, [])
+            self.request_blocks()
+
+    # Asks a peer for the next chunk of its state, starting or resuming a sync.
+    def request_state(self, connected_node):
+        if self.state_import is None:
+            self.state_import = StateImport()
+        self.state_peer = connected_node
+        self.send_to_node(connected_node, {"get_state": self.state_import.request()})
+
+    def send_state_chunk(self, connected_node, request: dict):
+        # Keep serving the export a peer started on, so it can resume,
+        # unless the chain moved on and the peer is starting over.
+        tip_hash = self.blockchain.blocks[-1].get_block_hash()
+        if self.state_export is None or (
+            request["id"] != self.state_export.id and self.state_export.id != tip_hash
+        ):
+            self.state_export = StateExport(self.blockchain)
+        offset = request["offset"] if request["id"] == self.state_export.id else 0
+        self.send_to_node(connected_node, {"state_chunk": self.state_export.chunk(offset)})
+
+    def receive_state_chunk(self, connected_node, chunk: dict):
+        if self.state_import is None:  # already synced.
+            return
+        expected = chunk["offset"] == self.state_import.offset
+        if not self.state_import.apply(chunk):
+            if expected:  # corrupted, ask again.
+                self.request_state(connected_node)
+            return
+        if self.state_import.done():
+            log.info("Got blockchain state from %s", connected_node.port)
+            if not self.blockchain.set_state(self.state_import.header, self.state_import.accounts):
+                self.state_import = None  # start over from another peer.
+                self.disconnect_with_node(connected_node)
+                return
+            self.state_import = None
+            self.state_peer = None
             self.blockchain.synced = True
-        elif "new_block" in data:  # Someone else found a block.
-            self.blockchain.new_blocks.append(data["new_block"])
-            print(f"{connected_node.port} found a block: {data['new_block']}")
+            self.request_headers(connected_node)  # blocks found during the sync.
+        else:
+            self.request_state(connected_node)
+
+    # Catch-up: ask a peer for the headers after the last block we know of.
+    def request_headers(self, connected_node):
+        if self.headers_peer is not None or self.block_download is not None:
+            return  # already catching up.
+        self.headers_peer = connected_node
+        start = self.blockchain.blocks[-1].number + 1
+        self.send_to_node(
+            connected_node, {"getheaders": {"from": start, "count": MAX_HEADERS}}
+        )
+
+    def send_headers(self, connected_node, request: dict):
+        headers = []
+        last = min(self.blockchain.blocks[-1].number, request["from"] + request["count"] - 1)
+        for n in range(request["from"], last + 1):
+            try:
+                b = self.blockchain.get_block(n)
+            except BlockNotFound:
+                break
+            if b.nonce == -1:  # quick synced, we don't have the block itself.
+                break
+            headers.append(b.header().to_dict())
+        self.send_to_node(connected_node, {"headers": headers})
+
+    def receive_headers(self, connected_node, headers: list[dict]):
+        if connected_node is not self.headers_peer:
+            return
+        self.headers_peer = None
+        headers = [header_from_dict(h) for h in headers]
+        if headers == []:
+            return  # we're caught up with this peer.
+        if not self.blockchain.validate_headers(headers):
+            log.warning("Invalid headers from %s.", connected_node.port)
+            return
+        log.info("Downloading blocks %d to %d.", headers[0].number, headers[-1].number)
+        self.block_download = BlockDownload(headers)
+        self.headers_peer = connected_node  # asked for more headers once done.
+        self.request_blocks()
+
+    def request_blocks(self):
+        for peer, numbers in self.block_download.assign(self.all_nodes).items():
+            self.send_to_node(peer, {"getblocks": numbers})
+        if self.block_download.stalled():
+            log.warning("No peer sent block %d, stopping the download.", self.block_download.next_number)
+            self.block_download = None
+            self.headers_peer = None
+
+    def send_blocks(self, connected_node, numbers: list[int]):
+        blocks = []
+        for n in numbers:
+            try:
+                blocks.append(self.blockchain.get_block(n))
+            except BlockNotFound:
+                pass
+        self.send_to_node(connected_node, {"blocks": blocks})
+
+    def receive_blocks(self, connected_node, blocks: list[Block]):
+        if self.block_download is None:
+            return
+        self.block_download.add(connected_node, blocks)
+        ready = self.block_download.ready()
+        if ready:
+            # Executed in order by the main thread, like blocks announced by peers.
+            self.blockchain.new_blocks += ready
             self.block_found_by_peer = True
-        elif "new_tx" in data:
-            print(f"{connected_node.port} sent a tx: {data['new_tx']}")
-            tx = Transaction(
-                _fr="",
-                _to="",
-                _amount="",
-                _nonce="",
-                _signature="",
-                _data="",
-                _gas_price="",
-                _tx_dict=data["new_tx"],
+        if self.block_download.done():
+            headers_peer = self.headers_peer
+            self.block_download = None
+            self.headers_peer = None
+            if headers_peer is not None:
+                self.request_headers(headers_peer)  # the peer may have more.
+        else:
+            self.request_blocks()
+
+    # Light clients: ask a peer to prove that block {number} includes a transaction.
+    def request_tx_proof(self, connected_node, number: int, tx_hash: str):
+        self.send_to_node(connected_node, {"get_tx_proof": {"block": number, "tx_hash": tx_hash}})
+
+    def send_tx_proof(self, connected_node, request: dict):
+        self.send_to_node(connected_node, {"tx_proof": self.tx_proof(request["block"], request["tx_hash"])})
+
+    # Header of block {number} and a Merkle proof that it includes the transaction.
+    # The header is None if it doesn't, or if we don't have the block.
+    def tx_proof(self, number: int, tx_hash: str) -> dict:
+        reply = {"tx_hash": tx_hash, "header": None, "proof": []}
+        try:
+            b = self.blockchain.get_block(number)
+            hashes = b.tx_hashes() if b.nonce != -1 else []
+            if tx_hash in hashes:
+                reply["header"] = b.header().to_dict()
+                reply["proof"] = b.tx_proof(hashes.index(tx_hash))
+        except BlockNotFound:
+            pass
+        return reply
+
+    def receive_tx_proof(self, connected_node, tx_proof: dict):
+        header = tx_proof["header"]
+        if header is not None and verify_merkle_proof(
+            tx_proof["tx_hash"], tx_proof["proof"], header["tx_root"]
+        ):
+            self.tx_proofs[tx_proof["tx_hash"]] = header_from_dict(header)
+        else:
+            self.tx_proofs[tx_proof["tx_hash"]] = None
+
+    # Light clients: ask a peer to prove an account's state after block {number}.
+    def request_account_proof(self, connected_node, number: int, address: str):
+        self.send_to_node(
+            connected_node, {"get_account_proof": {"block": number, "address": address}}
+        )
+
+    def send_account_proof(self, connected_node, request: dict):
+        self.send_to_node(
+            connected_node, {"account_proof": self.account_proof(request["block"], request["address"])}
+        )
+
+    # Header of block {number}, and the account's state after it with a proof against
+    # the header's state root. The header is None if we don't have that state.
+    def account_proof(self, number: int, address: str) -> dict:
+        reply = {"address": address, "header": None, "account": None, "proof": {}}
+        try:
+            b = self.blockchain.get_block(number)
+            if b.nonce != -1:
+                root = self.blockchain.state_root_at(b.number)
+                reply["header"] = b.header().to_dict()
+                reply["account"] = self.blockchain.state.get(root, address)
+                reply["proof"] = self.blockchain.state.prove(root, address)
+        except (BlockNotFound, StateNotFound):
+            pass
+        return reply
+
+    def receive_account_proof(self, connected_node, account_proof: dict):
+        header = account_proof["header"]
+        if header is not None and verify_state_proof(
+            account_proof["address"],
+            account_proof["account"],
+            account_proof["proof"],
+            header["state_root"],
+        ):
+            self.account_proofs[account_proof["address"]] = (
+                header_from_dict(header),
+                account_proof["account"],
             )
-            self.blockchain.pending_txs.append(tx)
         else:
-            print(f"received unexpected message. {data}")
-            exit(0)
+            self.account_proofs[account_proof["address"]] = None
 
-    def node_disconnect_with_outbound_node(self, connected_node):
-        print(
-            f"node wants to disconnect with other outbound node: {connected_node.port}"
+    # Verifies transactions from a peer, or from a local client if {source} is None, and
+    # adds them to the mempool. The ones added are relayed with the next batch.
+    # Returns whether each transaction was added.
+    def add_txs(self, txs: list, source=None) -> list[bool]:
+        formed = [well_formed(tx) for tx in txs]
+        # Recovered signers are cached, so this check is free again at block execution.
+        signed = iter(
+            verify_signatures([tx for tx, f in zip(txs, formed) if f], self.blockchain.parallel_verify)
+        )
+        added = []
+        for tx, f in zip(txs, formed):
+            ok = f and next(signed)
+            if not f:
+                log.info("Malformed tx, dropping %s.", tx.get_tx_hash())
+            elif not ok:
+                log.info("Can't verify signature, dropping tx %s.", tx.get_tx_hash())
+            elif not self.blockchain.mempool.add(tx):
+                log.info("Duplicate or underpriced tx, dropping %s.", tx.get_tx_hash())
+                ok = False
+            else:
+                self.tx_relay.append((tx, source))
+            added.append(ok)
+        return added
+
+    # Sends each peer the transactions added since the last relay, except the ones it
+    # sent us, in new_txs batches. Transactions that left the mempool meanwhile
+    # (mined or evicted) aren't sent.
+    def relay_txs(self):
+        (pending, self.tx_relay) = (self.tx_relay, [])
+        pending = [(tx, s) for tx, s in pending if tx.get_tx_hash() in self.blockchain.mempool]
+        for peer in self.all_nodes:
+            txs = [tx for tx, source in pending if source is not peer]
+            for i in range(0, len(txs), MAX_TX_BATCH):
+                self.send_to_node(peer, {"new_txs": txs[i : i + MAX_TX_BATCH]})
+            txs_relayed.inc(len(txs))
+
+    async def relay_txs_periodically(self):
+        while True:
+            await asyncio.sleep(TX_RELAY_INTERVAL)
+            self.relay_txs()
+
+    # Number of the last block we have or have queued.
+    def last_block_number(self) -> int:
+        queued = self.blockchain.new_blocks
+        return queued[-1].number if queued else self.blockchain.blocks[-1].number
+
+    # Someone else found a block.
+    def receive_new_block(self, connected_node, block: Block):
+        if block.number > self.last_block_number() + 1:  # we missed some blocks.
+            self.request_headers(connected_node)
+            return
+        self.blockchain.new_blocks.append(block)
+        self.block_found_by_peer = True
+
+    # A block announced by header and short tx ids. Its transactions are taken from the
+    # mempool, and only those we don't have are requested from the peer.
+    def receive_compact_block(self, connected_node, compact: dict):
+        number = compact["header"]["number"]
+        if number <= self.last_block_number():
+            return  # already have it.
+        if number > self.last_block_number() + 1:
+            self.request_headers(connected_node)
+            return
+        reconstruction = BlockReconstruction(compact, self.blockchain.mempool)
+        missing = reconstruction.missing()
+        log.debug(
+            "Block %d: %d txs from the mempool, %d missing.",
+            number,
+            len(reconstruction.txs) - len(missing),
+            len(missing),
+        )
+        if missing == []:
+            self.add_reconstructed_block(connected_node, reconstruction)
+            return
+        self.compact_blocks[connected_node] = reconstruction
+        self.send_to_node(
+            connected_node,
+            {
+                "get_block_txs": {
+                    "block_hash": reconstruction.header.get_block_hash(),
+                    "indexes": missing,
+                }
+            },
         )
 
+    def send_block_txs(self, connected_node, request: dict):
+        try:
+            b = self.blockchain.get_block_by_hash(request["block_hash"])
+            txs = [b.txs[i] for i in request["indexes"] if 0 <= i < len(b.txs)]
+        except BlockNotFound:
+            txs = []
+        self.send_to_node(connected_node, {"block_txs": txs})
+
+    def receive_block_txs(self, connected_node, txs: list):
+        reconstruction = self.compact_blocks.pop(connected_node, None)
+        if reconstruction is None:
+            return
+        if not reconstruction.fill(txs):
+            log.warning("%s didn't send the missing txs, dropping its block.", connected_node.port)
+            return
+        self.add_reconstructed_block(connected_node, reconstruction)
+
+    def add_reconstructed_block(self, connected_node, reconstruction: BlockReconstruction):
+        block = reconstruction.block()
+        if block is None:
+            log.warning("Reconstructed block doesn't match its header, dropping it.")
+            return
+        self.receive_new_block(connected_node, block)
+
+    def node_message(self, connected_node, data):
+        log.debug("node_message from %s.", connected_node.port)
+        messages_received.inc()
+        # self.block_found_by_peer = True
+        if "get_state" in data:  # A peer is syncing from us.
+            self.send_state_chunk(connected_node, data["get_state"])
+        elif "state_chunk" in data:  # Initial sync.
+            self.receive_state_chunk(connected_node, data["state_chunk"])
+        elif "getheaders" in data:
+            self.send_headers(connected_node, data["getheaders"])
+        elif "headers" in data:
+            self.receive_headers(connected_node, data["headers"])
+        elif "getblocks" in data:
+            self.send_blocks(connected_node, data["getblocks"])
+        elif "blocks" in data:
+            self.receive_blocks(connected_node, data["blocks"])
+        elif "get_tx_proof" in data:
+            self.send_tx_proof(connected_node, data["get_tx_proof"])
+        elif "tx_proof" in data:
+            self.receive_tx_proof(connected_node, data["tx_proof"])
+        elif "get_account_proof" in data:
+            self.send_account_proof(connected_node, data["get_account_proof"])
+        elif "account_proof" in data:
+            self.receive_account_proof(connected_node, data["account_proof"])
+        elif "compact_block" in data:  # Someone else found a block.
+            self.receive_compact_block(connected_node, data["compact_block"])
+        elif "get_block_txs" in data:
+            self.send_block_txs(connected_node, data["get_block_txs"])
+        elif "block_txs" in data:
+            self.receive_block_txs(connected_node, data["block_txs"])
+        elif "new_block" in data:  # Someone else found a block, sent in full.
+            log.info("%s found a block: %s", connected_node.port, data["new_block"])
+            self.receive_new_block(connected_node, data["new_block"])
+        elif "new_txs" in data:  # decoded by the transport.
+            log.debug("%s sent %d txs.", connected_node.port, len(data["new_txs"]))
+            self.add_txs(data["new_txs"], connected_node)
+        elif "new_tx" in data:  # a single tx, from older nodes.
+            self.add_txs([data["new_tx"]], connected_node)
+        else:
+            log.warning("%s sent an unexpected message, disconnecting. %s", connected_node.port, data)
+            self.node_disconnected(connected_node)
+
+    def node_disconnect_with_outbound_node(self, connected_node):
+        log.info("node wants to disconnect with other outbound node: %s", connected_node.port)
+
     def node_request_to_stop(self):
-        print("node is requested to stop!")
+        log.info("node is requested to stop!")
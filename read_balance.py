@@ -1,52 +1,68 @@
 import sys
-from blockchain.blockchain import Blockchain
-from node.node import Node
-from time import time, sleep
+from account.account import generate_accounts
+from block.block import header_from_dict
+from merkle.merkle import verify_merkle_proof
+from rpc.rpc import RPCClient
+from state.state import verify_state_proof
 
 LOCALHOST = "127.0.0.1"
-# Usage: python read_balance.py
+# Usage: python read_balance.py [--tx={tx hash} --block={block number}] [--at={block number}]
+#            [--rpc-port=10100]
+# Reads the balances of accounts 0 and 1 from the node serving JSON-RPC on {rpc port}.
+# With --tx, also asks for a Merkle proof that the block includes the transaction.
+# With --at, also reads both balances as of that block, proven against its state root.
 
 
-def get_arg(args: list[str], arg: str) -> int:
+def get_arg(args: list[str], arg: str, default: int = None) -> int:
     for a in args:
-        if a.startswith(f"--{arg}"):
+        if a.startswith(f"--{arg}="):
             return int(a.replace(f"--{arg}=", ""))
+    return default
 
 
-if __name__ == "__main__":
-    peers = [10000]
-    node_port = 10005
-    node = Node(LOCALHOST, node_port)
-
-    blockchain = Blockchain(
-        _difficulty=1,
-        _target=(2**256) - 1,
-        _expected_block_time=10,
-        _recalculate_every_x_blocks=10,
-        _xth_last_block_time=time(),  # init
-        _blocks=[],
-        _accounts=[],
-    )
-    node.blockchain = blockchain
-    node.blockchain.synced = False
-
-    node.start()
-    for p in peers:
-        node.connect_with_node(LOCALHOST, p)
+def get_str_arg(args: list[str], arg: str) -> str:
+    for a in args:
+        if a.startswith(f"--{arg}="):
+            return a.replace(f"--{arg}=", "")
+    return ""
 
-    # Wait for a peer to send the blockchain state.
-    while not node.blockchain.synced:
-        print("Waiting to sync.")
-        sleep(1)
 
-    print("Blockchain synced.")
+if __name__ == "__main__":
+    rpc = RPCClient(LOCALHOST, get_arg(sys.argv, "rpc-port", 10100))
+    (a, b) = generate_accounts()[:2]
 
-    a = node.blockchain.accounts[0]
-    b = node.blockchain.accounts[1]
-    balance_of_0 = a.balance
-    balance_of_1 = b.balance
+    (number, balance_of_0, balance_of_1) = rpc.batch(
+        [("getBlockNumber", []), ("getBalance", [a.address]), ("getBalance", [b.address])]
+    )
+    print(f"Block {number}.")
     print(f"Balance of {a.short_address()}: {balance_of_0}")
     print(f"Balance of {b.short_address()}: {balance_of_1}")
 
-    sleep(3)
-    node.stop()
+    tx_hash = get_str_arg(sys.argv, "tx")
+    if tx_hash != "":
+        proof = rpc.call("getTxProof", get_arg(sys.argv, "block"), tx_hash)
+        header = proof["header"]
+        if header is None or not verify_merkle_proof(tx_hash, proof["proof"], header["tx_root"]):
+            print(f"Node could not prove tx {tx_hash[:8]}... is in the block.")
+        else:
+            header = header_from_dict(header)
+            print(
+                f"Tx {tx_hash[:8]}... is in block {header.number}, hash ...{header.get_block_hash()[-5:]}."
+            )
+
+    if get_str_arg(sys.argv, "at") != "":
+        at = get_arg(sys.argv, "at")
+        proofs = rpc.batch([("getAccountProof", [at, account.address]) for account in [a, b]])
+        for account, proof in zip([a, b], proofs):
+            header = proof["header"]
+            if header is None or not verify_state_proof(
+                account.address, proof["account"], proof["proof"], header["state_root"]
+            ):
+                print(f"Node could not prove the state of {account.short_address()}.")
+            elif proof["account"] is None:
+                print(f"{account.short_address()} did not exist at block {header['number']}.")
+            else:
+                print(
+                    f"Balance of {account.short_address()} at block {header['number']}: {proof['account']['balance']}"
+                )
+    rpc.close()
@@ -0,0 +1,71 @@
+from block.block import Block, header_from_dict
+from mempool.mempool import Mempool
+from transaction.transaction import Transaction
+import hashlib
+
+# Hex characters of a short transaction id (6 bytes).
+SHORT_ID_CHARS = 12
+
+
+# Short ids are salted with the block hash, so a collision in one block
+# doesn't carry over to the next.
+def short_tx_id(salt: str, tx_hash: str) -> str:
+    return hashlib.sha256(f"{salt}{tx_hash}".encode()).hexdigest()[:SHORT_ID_CHARS]
+
+
+# Announcement of a block to peers that already have most of its transactions.
+def compact_block(block: Block) -> dict:
+    salt = block.get_block_hash()
+    return {
+        "header": block.header().to_dict(),
+        "short_ids": [short_tx_id(salt, h) for h in block.tx_hashes()],
+    }
+
+
+class BlockReconstruction:
+    """Rebuilds a block announced with compact_block() from the mempool. The transactions
+    that aren't there are fetched by index from the announcing peer. If two transactions
+    share a short id, all of them are fetched rather than guessing."""
+
+    def __init__(self, compact: dict, mempool: Mempool):
+        self.header = header_from_dict(compact["header"])
+        self.txs = [None] * len(compact["short_ids"])
+        indexes = {s: i for i, s in enumerate(compact["short_ids"])}
+        if len(indexes) < len(self.txs):
+            return
+        salt = self.header.get_block_hash()
+        for tx_hash, tx in mempool.items():
+            i = indexes.get(short_tx_id(salt, tx_hash))
+            if i is None:
+                continue
+            if self.txs[i] is not None:
+                self.txs = [None] * len(self.txs)
+                return
+            self.txs[i] = tx
+
+    def missing(self) -> list[int]:
+        return [i for i, tx in enumerate(self.txs) if tx is None]
+
+    # Fills in the missing transactions, in the order of missing().
+    # Returns False if there are more or fewer than missing.
+    def fill(self, txs: list[Transaction]) -> bool:
+        missing = self.missing()
+        if len(txs) != len(missing):
+            return False
+        for i, tx in zip(missing, txs):
+            self.txs[i] = tx
+        return True
+
+    # The block, or None if the transactions don't hash to the header's.
+    def block(self) -> Block:
+        b = Block(
+            _number=self.header.number,
+            _timestamp=self.header.timestamp,
+            _nonce=self.header.nonce,
+            _prev_hash=self.header.prev_hash,
+            _txs=self.txs,
+            _state_root=self.header.state_root,
+        )
+        if None in self.txs or b.get_block_hash() != self.header.get_block_hash():
+            return None
+        return b
@@ -0,0 +1,223 @@
+from account.account import AccountNotFound
+from contract.contract import read_contract
+from state.state import StateNotFound
+from store.store import BlockNotFound
+from transaction.transaction import tx_from_dict
+import asyncio
+import http.client
+import inspect
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+# JSON-RPC 2.0 over HTTP/1.1, for local clients like send.py and read_balance.py, which
+# submit transactions and read the chain from a node without syncing it themselves.
+# Reads are served from the node's in-memory state, so they cost about the size of
+# their response. Connections are kept alive between requests, and a request can be
+# a batch: a JSON array of calls, answered with an array of their responses.
+#
+# Methods, with positional or named params. Accounts and blocks that don't exist are null.
+#   sendTransactions(txs)                 hash of each tx added to the mempool, or null.
+#   getBalance(address, block=null)       balance, after {block} if given.
+#   getNonce(address, pending=false)      nonce, or with pending, the next one after the
+#                                         sender's transactions in the mempool.
+#   getStorage(address, variable="")      contract storage, or one of its variables.
+#   getBlock(number)                      block as a dict, with its hash.
+#   getBlockNumber()                      number of the last block.
+#   getTxProof(block, tx_hash)            header and Merkle proof, see Node.tx_proof().
+#   getAccountProof(block, address)       header, account and proof, see Node.account_proof().
+
+MAX_REQUEST_SIZE = 32 * 1024 * 1024
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RPCError(Exception):
+    "Raised by methods, and by RPCClient for error responses. Carries a JSON-RPC error code."
+
+    def __init__(self, code: int, message: str):
+        super(RPCError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class RPCServer:
+    "JSON-RPC methods of a node. Served on the node's network thread, like its peers."
+
+    def __init__(self, node):
+        self.node = node
+        self.methods = {
+            "sendTransactions": self.send_transactions,
+            "getBalance": self.get_balance,
+            "getNonce": self.get_nonce,
+            "getStorage": self.get_storage,
+            "getBlock": self.get_block,
+            "getBlockNumber": self.get_block_number,
+            "getTxProof": node.tx_proof,
+            "getAccountProof": node.account_proof,
+        }
+
+    # Takes a list of transactions as dicts. Returns the hash of each transaction
+    # added to the mempool, and None for the ones that were rejected.
+    def send_transactions(self, txs: list) -> list:
+        try:
+            txs = [tx_from_dict(t) for t in txs]
+        except (KeyError, TypeError):
+            raise RPCError(INVALID_PARAMS, "Transactions must be objects with all fields.")
+        added = self.node.add_txs(txs)
+        return [tx.get_tx_hash() if a else None for tx, a in zip(txs, added)]
+
+    def get_balance(self, address: str, block: int = None):
+        if block is None:
+            try:
+                return self.node.blockchain.accounts.get(address).balance
+            except AccountNotFound:
+                return None
+        try:
+            account = self.node.blockchain.get_account_at(address, block)
+        except StateNotFound:
+            raise RPCError(INVALID_PARAMS, f"No state for block {block}.")
+        return None if account is None else account["balance"]
+
+    def get_nonce(self, address: str, pending: bool = False):
+        try:
+            nonce = self.node.blockchain.accounts.get(address).nonce
+        except AccountNotFound:
+            return None
+        return self.node.blockchain.mempool.next_nonce(address, nonce) if pending else nonce
+
+    def get_storage(self, address: str, variable: str = ""):
+        try:
+            return read_contract(self.node.blockchain.accounts, address, variable)
+        except AccountNotFound:
+            return None
+
+    def get_block(self, number: int):
+        try:
+            b = self.node.blockchain.get_block(number)
+        except BlockNotFound:
+            return None
+        return {**b.to_dict(), "hash": b.get_block_hash()}
+
+    def get_block_number(self) -> int:
+        return self.node.blockchain.blocks[-1].number
+
+    def call(self, request) -> dict:
+        "The response to one call, or None for a notification (a call without an id)."
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return error_response(None, INVALID_REQUEST, "Invalid request.")
+        id = request.get("id")
+        method = self.methods.get(request["method"])
+        params = request.get("params", [])
+        try:
+            if method is None:
+                raise RPCError(METHOD_NOT_FOUND, f"Method {request['method']} not found.")
+            try:
+                args = (
+                    inspect.signature(method).bind(**params)
+                    if isinstance(params, dict)
+                    else inspect.signature(method).bind(*params)
+                )
+            except TypeError as e:
+                raise RPCError(INVALID_PARAMS, str(e))
+            response = {"jsonrpc": "2.0", "id": id, "result": method(*args.args, **args.kwargs)}
+        except RPCError as e:
+            response = error_response(id, e.code, e.message)
+        except Exception as e:  # e.g. params of the wrong type.
+            log.info("RPC call %s failed: %r", request["method"], e)
+            response = error_response(id, INTERNAL_ERROR, f"{type(e).__name__}: {e}")
+        return response if "id" in request else None
+
+    # The response body to a request body, or None if there's nothing to answer.
+    def handle(self, body: bytes):
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return error_response(None, PARSE_ERROR, "Parse error.")
+        if not isinstance(request, list):
+            return self.call(request)
+        if request == []:
+            return error_response(None, INVALID_REQUEST, "Empty batch.")
+        responses = [r for r in (self.call(c) for c in request) if r is not None]
+        return responses if responses != [] else None
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if request_line == b"":
+                    return
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    (name, _, value) = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                size = int(headers.get("content-length", "0"))
+                if request_line.split()[:1] != [b"POST"] or size > MAX_REQUEST_SIZE:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    return
+                response = self.handle(await reader.readexactly(size))
+                body = b"" if response is None else json.dumps(response).encode()
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(
+                    f"HTTP/1.1 {'200 OK' if body else '204 No Content'}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: {'close' if close else 'keep-alive'}\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+                if close:
+                    return
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            log.info("RPC connection closed: %s", e)
+        finally:
+            writer.close()
+
+
+def error_response(id, code: int, message: str) -> dict:
+    return {"jsonrpc": "2.0", "id": id, "error": {"code": code, "message": message}}
+
+
+class RPCClient:
+    "Calls a node's JSON-RPC methods over one kept-alive connection."
+
+    def __init__(self, host: str, port: int, timeout: float = 30):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.ids = 0
+
+    def post(self, request):
+        self.connection.request(
+            "POST", "/", json.dumps(request), {"Content-Type": "application/json"}
+        )
+        response = self.connection.getresponse()
+        body = response.read()
+        return json.loads(body) if body else None
+
+    def call(self, method: str, *params):
+        return self.batch([(method, list(params))])[0]
+
+    # Calls [(method, params)] in one request and returns their results, in order.
+    # Raises RPCError for the first call that failed.
+    def batch(self, calls: list[tuple[str, list]]) -> list:
+        first = self.ids
+        self.ids += len(calls)
+        responses = self.post(
+            [
+                {"jsonrpc": "2.0", "id": first + i, "method": method, "params": params}
+                for i, (method, params) in enumerate(calls)
+            ]
+        )
+        if isinstance(responses, dict):  # the whole batch was rejected.
+            responses = [responses]
+        results = {}
+        for r in responses:
+            if "error" in r:
+                raise RPCError(r["error"]["code"], r["error"]["message"])
+            results[r["id"]] = r["result"]
+        return [results[first + i] for i in range(len(calls))]
+
+    def close(self):
+        self.connection.close()
@@ -1,55 +1,38 @@
 import sys
-from blockchain.blockchain import Blockchain
-from node.node import Node
-from time import time, sleep
+from account.account import generate_accounts
+from rpc.rpc import RPCClient
 
 LOCALHOST = "127.0.0.1"
-# Usage: python send.py --from=0 --to=1 --val=10
+# Usage: python send.py --from=0 --to=1 --val=10 [--nonce={nonce}] [--count=1] [--rpc-port=10100]
+# Sends {count} transactions with consecutive nonces to the node serving JSON-RPC on
+# {rpc port}, in one batch. Nonces start at {nonce}, by default the sender's next one,
+# after its transactions already in the node's mempool. Accounts are the generated
+# ones, so the chain doesn't have to be synced to sign them.
 
 
-def get_arg(args: list[str], arg: str) -> int:
+def get_arg(args: list[str], arg: str, default: int = None) -> int:
     for a in args:
-        if a.startswith(f"--{arg}"):
+        if a.startswith(f"--{arg}="):
             return int(a.replace(f"--{arg}=", ""))
+    return default
 
 
 if __name__ == "__main__":
-    peers = [10000]
-    node_port = 10005
-    node = Node(LOCALHOST, node_port)
-
-    blockchain = Blockchain(
-        _difficulty=1,
-        _target=(2**256) - 1,
-        _expected_block_time=10,
-        _recalculate_every_x_blocks=10,
-        _xth_last_block_time=time(),  # init
-        _blocks=[],
-        _accounts=[],
-    )
-    node.blockchain = blockchain
-    node.blockchain.synced = False
-
-    node.start()
-    for p in peers:
-        node.connect_with_node(LOCALHOST, p)
-
-    # Wait for a peer to send the blockchain state.
-    while not node.blockchain.synced:
-        print("Waiting to sync.")
-        sleep(1)
-
-    print("Blockchain synced.")
-
-    fr = get_arg(sys.argv, "from")
-    to = get_arg(sys.argv, "to")
+    accounts = generate_accounts()
+    a = accounts[get_arg(sys.argv, "from")]
+    b = accounts[get_arg(sys.argv, "to")]
     val = get_arg(sys.argv, "val")
-    a = node.blockchain.accounts[fr]
-    b = node.blockchain.accounts[to]
-
-    (tx, _) = a.send_transaction(to=b.address, amount=val, nonce=a.nonce)
-    node.send_to_nodes({"new_tx": tx.__dict__})
-    print(f"Sent tx: {tx}")
-
-    sleep(3)
-    node.stop()
+    count = get_arg(sys.argv, "count", 1)
+
+    rpc = RPCClient(LOCALHOST, get_arg(sys.argv, "rpc-port", 10100))
+    nonce = get_arg(sys.argv, "nonce")
+    if nonce is None:
+        nonce = rpc.call("getNonce", a.address, True)
+    txs = [a.send_transaction(to=b.address, amount=val, nonce=nonce + i)[0] for i in range(count)]
+    hashes = rpc.call("sendTransactions", [tx.to_dict() for tx in txs])
+    rpc.close()
+    for tx, tx_hash in zip(txs, hashes):
+        if tx_hash is None:
+            print(f"Node rejected tx with nonce {tx.nonce}.")
+        else:
+            print(f"Sent tx {tx_hash[:8]}...: {val} from {a.short_address()} to {b.short_address()}, nonce {tx.nonce}.")
@@ -0,0 +1,352 @@
+import heapq
+import itertools
+import json
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from account.account import Account, AccountStore, ZERO_ADDRESS
+from block.block import Block
+from blockchain.blockchain import Blockchain
+from codec.codec import encode_message, decode_message
+from merkle.merkle import EMPTY_ROOT
+from node.node import Node, TX_RELAY_INTERVAL
+from relay.relay import compact_block
+
+# Usage: python -m simulator.simulator --nodes=4,8 --block-time=2,10 [--duration=600]
+#            [--tx-rate=10] [--accounts=100] [--latency=0.05] [--jitter=0.01]
+#            [--bandwidth=1000000] [--seed=0] [--json={results file}]
+# Simulates a network of nodes for each combination of --nodes and --block-time,
+# one simulation per process, and reports throughput, stale blocks, block propagation
+# and how long a new node takes to sync.
+#
+# Nodes are real Node and Blockchain instances, fully connected by in-memory links.
+# Messages are encoded as on the wire, and arrive after the link's latency, plus
+# jitter, once the link's bandwidth has sent them and the messages queued before them.
+# Time is simulated: events run in order of their simulated time, so results only
+# depend on the parameters and the seed, not on how fast this machine is.
+#
+# Mining is simulated too. Blocks are found at exponentially distributed intervals
+# averaging --block-time, by a node picked at random. The chain has no fork choice,
+# so a block found by a node that hadn't received the last block yet is counted
+# as stale and dropped, as it would be when the longer chain reaches its miner.
+
+
+class SimPeer:
+    "One end of an in-memory link, as the Node at {local} sees the node at the other end."
+
+    def __init__(self, local: "SimNode", remote: "SimNode"):
+        self.local = local
+        self.remote = remote
+        self.port = remote.port  # nodes are numbered, for logs.
+        self.busy_until = 0.0  # when the link is done sending what's queued on it.
+        self.last_arrival = 0.0  # links deliver in order, like TCP.
+        self.reverse = None  # the other end.
+
+    def __str__(self) -> str:
+        return f"Simulated peer {self.port}"
+
+
+class SimNode(Node):
+    "A Node whose messages go through a Network rather than sockets."
+
+    def __init__(self, network: "Network", number: int):
+        super(SimNode, self).__init__("sim", number)
+        self.loop.close()  # the asyncio transport isn't used.
+        self.network = network
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def send_to_node(self, n: SimPeer, data: dict):
+        if n in self.all_nodes:
+            self.network.send(n, data)
+
+    def connect_with_node(self, host, port, reconnect=False) -> bool:
+        return False  # links are made by Network.connect().
+
+    def disconnect_with_node(self, node: SimPeer):
+        self.network.disconnect(node)
+
+
+class Network:
+    "Simulated clock, event queue and links between SimNodes."
+
+    def __init__(self, latency: float, jitter: float, bandwidth: float, seed: int):
+        self.latency = latency  # seconds.
+        self.jitter = jitter  # up to this many seconds are added to the latency.
+        self.bandwidth = bandwidth  # bytes per second, per link and direction.
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.events = []  # (time, sequence, fn, args)
+        self.sequence = itertools.count()  # orders events scheduled for the same time.
+        self.bytes_sent = 0
+        self.on_message = lambda node: None  # called after a node handled a message.
+
+    def at(self, t: float, fn, *args):
+        heapq.heappush(self.events, (t, next(self.sequence), fn, args))
+
+    # Runs events until {until}, or until done() is true.
+    def run(self, until: float, done=lambda: False):
+        while self.events and self.events[0][0] <= until and not done():
+            (self.now, _, fn, args) = heapq.heappop(self.events)
+            fn(*args)
+
+    def connect(self, a: SimNode, b: SimNode):
+        outbound = SimPeer(a, b)
+        inbound = SimPeer(b, a)
+        (outbound.reverse, inbound.reverse) = (inbound, outbound)
+        a.nodes_outbound.append(outbound)
+        b.nodes_inbound.append(inbound)
+        b.inbound_node_connected(inbound)
+        a.outbound_node_connected(outbound)
+
+    def disconnect(self, peer: SimPeer):
+        for p in [peer, peer.reverse]:
+            for peers in [p.local.nodes_inbound, p.local.nodes_outbound]:
+                if p in peers:
+                    peers.remove(p)
+                    if peers is p.local.nodes_inbound:
+                        p.local.inbound_node_disconnected(p)
+                    else:
+                        p.local.outbound_node_disconnected(p)
+
+    def send(self, peer: SimPeer, data: dict):
+        frame = encode_message(data)
+        self.bytes_sent += len(frame)
+        peer.busy_until = max(self.now, peer.busy_until) + len(frame) / self.bandwidth
+        arrival = peer.busy_until + self.latency + self.rng.uniform(0, self.jitter)
+        peer.last_arrival = max(arrival, peer.last_arrival)
+        self.at(peer.last_arrival, self.deliver, peer.reverse, frame)
+
+    def deliver(self, peer: SimPeer, frame: bytes):
+        node = peer.local
+        if peer not in node.all_nodes:  # disconnected meanwhile.
+            return
+        node.node_message(peer, decode_message(memoryview(frame)))
+        self.on_message(node)
+
+
+# A blockchain starting from {accounts}, on the network's clock. Genesis is at time 0,
+# so every node has the same genesis and timestamps only depend on the simulation.
+def sim_blockchain(network: Network, accounts: list[Account], block_time: float) -> Blockchain:
+    blockchain = Blockchain(
+        _difficulty=1,
+        _target=(2**256) - 1,
+        _expected_block_time=block_time,
+        _recalculate_every_x_blocks=10**9,  # every hash meets the target.
+        _xth_last_block_time=0,
+        _blocks=[],
+        _accounts=[],
+    )
+    blockchain.clock = lambda: network.now
+    blockchain.genesis_time = 0.0
+    blockchain.blocks[0].timestamp = 0.0
+    blockchain.accounts = AccountStore(
+        [Account(_address=a.address, _balance=a.balance) for a in accounts]
+        + [Account(_address=ZERO_ADDRESS)]
+    )
+    blockchain.state_root = blockchain.state.update(
+        EMPTY_ROOT, {a.address: a.to_dict() for a in blockchain.accounts}
+    )
+    blockchain.state_roots = {0: blockchain.state_root}
+    return blockchain
+
+
+def percentile(values: list[float], p: float) -> float:
+    if values == []:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Simulation:
+    "One simulated network, see the comments at the top of this module."
+
+    def __init__(
+        self,
+        _nodes: int,
+        _block_time: float,
+        _duration: float,
+        _tx_rate: float,  # transactions submitted per second, to random nodes.
+        _accounts: int,
+        _latency: float,
+        _jitter: float,
+        _bandwidth: float,
+        _seed: int,
+    ):
+        self.block_time = _block_time
+        self.duration = _duration
+        self.tx_rate = _tx_rate
+        self.rng = random.Random(_seed)
+        self.network = Network(_latency, _jitter, _bandwidth, _seed + 1)
+        self.network.on_message = self.message_handled
+        self.accounts = [
+            Account(_private_key="0x" + str(i + 1).zfill(64), _balance=10**9)
+            for i in range(_accounts)
+        ]
+        self.nonces = [0] * _accounts
+        self.nodes = []
+        for i in range(_nodes):
+            self.nodes.append(self.new_node())
+            for peer in self.nodes[:-1]:
+                self.network.connect(self.nodes[-1], peer)
+        self.mined_at = {}  # block hash -> when it was found.
+        self.delays = []  # time for each block to reach each other node.
+        self.best = 0  # highest block found.
+        self.stale = 0
+        self.txs_submitted = 0
+
+    def new_node(self) -> SimNode:
+        node = SimNode(self.network, len(self.nodes))
+        node.blockchain = sim_blockchain(self.network, self.accounts, self.block_time)
+        return node
+
+    def message_handled(self, node: SimNode):
+        if not node.block_found_by_peer:
+            return
+        node.block_found_by_peer = False
+        before = node.blockchain.blocks[-1].number
+        node.blockchain.append_new_blocks()
+        for n in range(before + 1, node.blockchain.blocks[-1].number + 1):
+            found = self.mined_at.get(node.blockchain.get_block(n).get_block_hash())
+            if found is not None:
+                self.delays.append(self.network.now - found)
+
+    def schedule_block(self):
+        t = self.network.now + self.rng.expovariate(1 / self.block_time)
+        if t < self.duration:
+            self.network.at(t, self.find_block, self.rng.choice(self.nodes))
+
+    def find_block(self, node: SimNode):
+        self.schedule_block()
+        blockchain = node.blockchain
+        tip = blockchain.blocks[-1]
+        if tip.number < self.best:  # mining on an old tip.
+            self.stale += 1
+            return
+        block = Block(
+            _number=tip.number + 1,
+            _timestamp=self.network.now,
+            _nonce=0,
+            _prev_hash=tip.get_block_hash(),
+            _txs=blockchain.mempool.select(blockchain.accounts),
+        )
+        blockchain.commit_block(block, *blockchain.prepare_block(block))
+        self.best = block.number
+        self.mined_at[block.get_block_hash()] = self.network.now
+        node.send_to_nodes({"compact_block": compact_block(block)})
+
+    def schedule_tx(self):
+        t = self.network.now + self.rng.expovariate(self.tx_rate)
+        if t < self.duration:
+            self.network.at(t, self.submit_tx)
+
+    def submit_tx(self):
+        self.schedule_tx()
+        i = self.rng.randrange(len(self.accounts))
+        to = self.accounts[self.rng.randrange(len(self.accounts))].address
+        (tx, _) = self.accounts[i].send_transaction(to=to, amount=1, nonce=self.nonces[i])
+        self.nonces[i] += 1
+        self.txs_submitted += 1
+        self.rng.choice(self.nodes).add_txs([tx])  # as send.py does, over RPC.
+
+    # Nodes relay the transactions they added every TX_RELAY_INTERVAL, until the
+    # simulation is over and the last ones have been delivered.
+    def relay_txs(self):
+        for node in self.nodes:
+            node.relay_txs()
+        if self.network.now < self.duration or self.network.events or any(n.tx_relay for n in self.nodes):
+            self.network.at(self.network.now + TX_RELAY_INTERVAL, self.relay_txs)
+
+    # Time for a new node to sync from the first one, once the network is idle.
+    def time_to_sync(self, timeout: float) -> float:
+        node = self.new_node()
+        node.blockchain.synced = False
+        source = self.nodes[0].blockchain
+        start = self.network.now
+        self.network.connect(node, self.nodes[0])
+        self.network.run(
+            start + timeout,
+            lambda: node.blockchain.synced
+            and node.blockchain.blocks[-1].number == source.blocks[-1].number,
+        )
+        return self.network.now - start
+
+    def run(self) -> dict:
+        wall_start = perf_counter()
+        if self.tx_rate > 0:
+            self.schedule_tx()
+            self.network.at(TX_RELAY_INTERVAL, self.relay_txs)
+        self.schedule_block()
+        self.network.run(float("inf"))  # until the last messages arrived.
+        chain = self.nodes[0].blockchain
+        tips = {n.blockchain.blocks[-1].get_block_hash() for n in self.nodes}
+        txs = sum(len(chain.get_block(n).txs) for n in range(1, chain.blocks[-1].number + 1))
+        return {
+            "nodes": len(self.nodes),
+            "block_time": self.block_time,
+            "blocks": chain.blocks[-1].number,
+            "stale_rate": self.stale / max(1, self.stale + chain.blocks[-1].number),
+            "txs_submitted": self.txs_submitted,
+            "txs": txs,
+            "tps": txs / self.duration,
+            "propagation_p50": percentile(self.delays, 50),
+            "propagation_p90": percentile(self.delays, 90),
+            "propagation_p99": percentile(self.delays, 99),
+            "in_sync": len(tips) == 1,
+            "bytes_sent": self.network.bytes_sent,
+            "time_to_sync": self.time_to_sync(timeout=3600),
+            "wall_seconds": perf_counter() - wall_start,
+        }
+
+
+def simulate(kwargs: dict) -> dict:
+    return Simulation(**kwargs).run()
+
+
+def get_arg(args: list[str], arg: str, default: str) -> str:
+    for a in args:
+        if a.startswith(f"--{arg}="):
+            return a.replace(f"--{arg}=", "")
+    return default
+
+
+if __name__ == "__main__":
+    args = sys.argv
+    scenarios = [
+        {
+            "_nodes": nodes,
+            "_block_time": block_time,
+            "_duration": float(get_arg(args, "duration", "600")),
+            "_tx_rate": float(get_arg(args, "tx-rate", "10")),
+            "_accounts": int(get_arg(args, "accounts", "100")),
+            "_latency": float(get_arg(args, "latency", "0.05")),
+            "_jitter": float(get_arg(args, "jitter", "0.01")),
+            "_bandwidth": float(get_arg(args, "bandwidth", "1000000")),
+            "_seed": int(get_arg(args, "seed", "0")),
+        }
+        for nodes in [int(n) for n in get_arg(args, "nodes", "4").split(",")]
+        for block_time in [float(t) for t in get_arg(args, "block-time", "10").split(",")]
+    ]
+    if len(scenarios) == 1:
+        results = [simulate(scenarios[0])]
+    else:
+        with ProcessPoolExecutor() as pool:
+            results = list(pool.map(simulate, scenarios))
+
+    print(f"{'nodes':>5} {'block time':>10} {'blocks':>6} {'stale':>6} {'tps':>7} {'p50':>7} {'p90':>7} {'p99':>7} {'sync':>7}")
+    for r in results:
+        print(
+            f"{r['nodes']:>5} {r['block_time']:>9}s {r['blocks']:>6} {r['stale_rate']:>6.1%} {r['tps']:>7.2f}"
+            + "".join(f" {r[k]:>6.3f}s" for k in ["propagation_p50", "propagation_p90", "propagation_p99", "time_to_sync"])
+            + ("" if r["in_sync"] else "  (nodes disagree on the tip)")
+        )
+
+    json_path = get_arg(args, "json", "")
+    if json_path != "":
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
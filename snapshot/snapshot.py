@@ -0,0 +1,63 @@
+import json
+import os
+
+# Deltas written to the journal before it's folded into a new base.
+COMPACT_EVERY = 100
+
+
+class StateSnapshots:
+    """Incremental snapshots of a blockchain state, in the format of Blockchain.save_state().
+    base.json holds a full state. Every later snapshot is a delta with only the
+    accounts that changed, appended as one JSON line to journal.log.
+    After COMPACT_EVERY deltas, the next snapshot is written as a new base. The journal
+    is emptied after the base is replaced, so deltas up to the base's block left by a
+    crash in between are skipped on load."""
+
+    def __init__(self, directory: str, compact_every: int = COMPACT_EVERY):
+        self.directory = directory
+        self.compact_every = compact_every
+        self.base_path = os.path.join(directory, "base.json")
+        self.journal_path = os.path.join(directory, "journal.log")
+        os.makedirs(directory, exist_ok=True)
+        self.deltas = 0
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, "r") as j:
+                self.deltas = sum(1 for _ in j)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.base_path)
+
+    def needs_compaction(self) -> bool:
+        return not self.exists() or self.deltas >= self.compact_every
+
+    def write_base(self, state: dict):
+        tmp_path = self.base_path + ".tmp"
+        with open(tmp_path, "w") as b:
+            json.dump(state, b, separators=(",", ":"))
+        os.replace(tmp_path, self.base_path)  # atomic, so a crash leaves the old base.
+        open(self.journal_path, "w").close()
+        self.deltas = 0
+
+    def write_delta(self, state: dict):
+        with open(self.journal_path, "a") as j:
+            j.write(json.dumps(state, separators=(",", ":")) + "\n")
+        self.deltas += 1
+
+    # Replays the journal over the base and returns the resulting full state.
+    def load(self) -> dict:
+        with open(self.base_path, "r") as b:
+            state = json.load(b)
+        accounts = {a["address"]: a for a in state["accounts"]}
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, "r") as j:
+                for line in j:
+                    try:
+                        delta = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # torn write at the end of the journal.
+                    if delta["last_block_number"] <= state["last_block_number"]:
+                        continue  # already in the base.
+                    accounts.update({a["address"]: a for a in delta.pop("accounts")})
+                    state.update(delta)
+        state["accounts"] = list(accounts.values())
+        return state
@@ -0,0 +1,154 @@
+from merkle.merkle import EMPTY_ROOT
+import hashlib
+import json
+
+LEAF = 0
+BRANCH = 1
+
+
+class StateNotFound(Exception):
+    "Raised when the state of a block is not kept anymore, or was never known."
+    pass
+
+
+# Key of an account in the trie. Hashing spreads accounts evenly, so paths stay short.
+def state_key(address: str) -> str:
+    return hashlib.sha256(address.encode()).hexdigest()
+
+
+# What the state commits to for an account. Private keys aren't part of the state.
+def account_state(account: dict) -> dict:
+    return {
+        "address": account["address"],
+        "nonce": account["nonce"],
+        "balance": account["balance"],
+        "code": account["code"],
+        "storage": account["storage"],
+    }
+
+
+def encode_account(account: dict) -> str:
+    return json.dumps(account_state(account), sort_keys=True, separators=(",", ":"))
+
+
+def leaf_hash(key: str, value: str) -> str:
+    return hashlib.sha256(f"leaf{key}{value}".encode()).hexdigest()
+
+
+def branch_hash(left: str, right: str) -> str:
+    return hashlib.sha256(f"branch{left}{right}".encode()).hexdigest()
+
+
+def key_bit(key: str, depth: int) -> int:
+    return (int(key[depth // 4], 16) >> (3 - depth % 4)) & 1
+
+
+class StateTrie:
+    """Sparse Merkle tree of accounts, keyed by state_key(address). A subtree holding
+    a single account is just that account's leaf, so paths are about log2(accounts) long,
+    and the shape only depends on which accounts exist: updating a root and building
+    one from scratch give the same root.
+    Nodes are stored by hash and never modified. An update only creates the nodes
+    on the paths to the changed accounts, and every older root remains readable
+    until prune() drops the nodes no kept root uses."""
+
+    def __init__(self):
+        self.nodes = {}  # hash -> (LEAF, key, value) or (BRANCH, left hash, right hash)
+
+    def put_leaf(self, key: str, value: str) -> str:
+        h = leaf_hash(key, value)
+        self.nodes[h] = (LEAF, key, value)
+        return h
+
+    def put_branch(self, left: str, right: str) -> str:
+        h = branch_hash(left, right)
+        self.nodes[h] = (BRANCH, left, right)
+        return h
+
+    # Root after setting {accounts} (address -> dict, as Account.to_dict()) on top of {root}.
+    def update(self, root: str, accounts: dict) -> str:
+        leaves = [(state_key(a), encode_account(account)) for a, account in accounts.items()]
+        return self._update(root, 0, leaves)
+
+    def _update(self, node_hash: str, depth: int, leaves: list[tuple[str, str]]) -> str:
+        if leaves == []:
+            return node_hash
+        if node_hash == EMPTY_ROOT:
+            if len(leaves) == 1:
+                return self.put_leaf(*leaves[0])
+            return self.put_branch(
+                self._update(EMPTY_ROOT, depth + 1, [l for l in leaves if key_bit(l[0], depth) == 0]),
+                self._update(EMPTY_ROOT, depth + 1, [l for l in leaves if key_bit(l[0], depth) == 1]),
+            )
+        node = self.nodes[node_hash]
+        if node[0] == LEAF:  # pushed down next to the new leaves, unless it's replaced.
+            if all(key != node[1] for key, _ in leaves):
+                leaves = leaves + [(node[1], node[2])]
+            return self._update(EMPTY_ROOT, depth, leaves)
+        return self.put_branch(
+            self._update(node[1], depth + 1, [l for l in leaves if key_bit(l[0], depth) == 0]),
+            self._update(node[2], depth + 1, [l for l in leaves if key_bit(l[0], depth) == 1]),
+        )
+
+    # Follows {address}'s path from {root}. Returns the sibling hashes along the way,
+    # and the leaf node the path ends on, if any.
+    def walk(self, root: str, address: str) -> tuple[list[str], tuple]:
+        if root != EMPTY_ROOT and root not in self.nodes:
+            raise StateNotFound()
+        key = state_key(address)
+        siblings = []
+        node_hash = root
+        while node_hash != EMPTY_ROOT:
+            node = self.nodes[node_hash]
+            if node[0] == LEAF:
+                return (siblings, node)
+            bit = key_bit(key, len(siblings))
+            siblings.append(node[2 - bit])
+            node_hash = node[1 + bit]
+        return (siblings, None)
+
+    # The state of account {address} under {root} (see account_state()), or None if it didn't exist.
+    def get(self, root: str, address: str) -> dict:
+        (_, leaf) = self.walk(root, address)
+        if leaf is None or leaf[1] != state_key(address):
+            return None
+        return json.loads(leaf[2])
+
+    # Proof of {address}'s state under {root}, see verify_state_proof(). The leaf is
+    # another account's when {address} doesn't exist, or None if its path ends empty.
+    def prove(self, root: str, address: str) -> dict:
+        (siblings, leaf) = self.walk(root, address)
+        return {"siblings": siblings, "leaf": None if leaf is None else [leaf[1], leaf[2]]}
+
+    # Drops the nodes none of the {roots} reach.
+    def prune(self, roots):
+        reachable = set()
+        stack = [r for r in roots if r != EMPTY_ROOT]
+        while stack:
+            h = stack.pop()
+            if h in reachable:
+                continue
+            reachable.add(h)
+            node = self.nodes[h]
+            if node[0] == BRANCH:
+                stack += [c for c in node[1:] if c != EMPTY_ROOT]
+        self.nodes = {h: self.nodes[h] for h in reachable}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+
+# Checks that under {root}, {address} has the state {account}, or doesn't exist if it's None.
+def verify_state_proof(address: str, account: dict, proof: dict, root: str) -> bool:
+    key = state_key(address)
+    leaf = proof["leaf"]
+    if account is not None:
+        if leaf != [key, encode_account(account)]:
+            return False
+    elif leaf is not None and leaf[0] == key:
+        return False
+    h = EMPTY_ROOT if leaf is None else leaf_hash(*leaf)
+    for depth in reversed(range(len(proof["siblings"]))):
+        sibling = proof["siblings"][depth]
+        h = branch_hash(h, sibling) if key_bit(key, depth) == 0 else branch_hash(sibling, h)
+    return h == root
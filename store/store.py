@@ -0,0 +1,123 @@
+from block.block import Block, block_from_dict
+from codec.codec import encode_block, decode_block
+import json
+import mmap
+import os
+import struct
+
+# Each record is: length of the rest of the record, block number, raw block hash, encoded block.
+# Blocks are in the binary encoding of codec.codec, or JSON in stores written before it.
+RECORD_HEADER = struct.Struct(">IQ32s")
+SEGMENT_SIZE = 32 * 1024 * 1024
+
+
+class BlockNotFound(Exception):
+    "Raised when a block is not in the block store."
+    pass
+
+
+class BlockStore:
+    """Append-only log of blocks, split into segment files of about SEGMENT_SIZE bytes.
+    Blocks are located through a height -> offset and a hash -> height index,
+    rebuilt from the record headers when the store is opened, and read back
+    through memory maps of the segments."""
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.by_number = {}  # number -> (segment, offset, length)
+        self.by_hash = {}  # hash -> number
+        self.maps = {}  # segment -> mmap
+        os.makedirs(directory, exist_ok=True)
+
+        self.segment = 0
+        while os.path.isfile(self.segment_path(self.segment + 1)):
+            self.segment += 1
+        for segment in range(self.segment + 1):
+            self.index_segment(segment)
+        self.file = open(self.segment_path(self.segment), "ab")
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"blk{segment:05d}.dat")
+
+    def index_segment(self, segment: int):
+        path = self.segment_path(segment)
+        if not os.path.isfile(path):
+            return
+        with open(path, "rb") as f:
+            offset = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (length, number, block_hash) = RECORD_HEADER.unpack(header)
+                if offset + 4 + length > os.path.getsize(path):
+                    break  # torn write at the end of the log.
+                self.index(number, block_hash.hex(), segment, offset, 4 + length)
+                offset += 4 + length
+                f.seek(offset)
+        if offset < os.path.getsize(path):
+            os.truncate(path, offset)
+
+    def index(self, number: int, block_hash: str, segment: int, offset: int, length: int):
+        # A later record for the same height replaces the earlier one.
+        self.by_number[number] = (segment, offset, length)
+        self.by_hash[block_hash] = number
+
+    def append(self, block: Block):
+        block_hash = block.get_block_hash()
+        payload = encode_block(block)
+        record = (
+            RECORD_HEADER.pack(
+                RECORD_HEADER.size - 4 + len(payload),
+                block.number,
+                bytes.fromhex(block_hash),
+            )
+            + payload
+        )
+        if self.file.tell() > 0 and self.file.tell() + len(record) > self.segment_size:
+            self.file.close()
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), "ab")
+
+        offset = self.file.tell()
+        self.file.write(record)
+        self.file.flush()
+        self.index(block.number, block_hash, self.segment, offset, len(record))
+
+    def read(self, segment: int, offset: int, length: int) -> memoryview:
+        m = self.maps.get(segment)
+        if m is None or offset + length > len(m):  # the active segment grew.
+            if m is not None:
+                m.close()
+            with open(self.segment_path(segment), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = m
+        return memoryview(m)[offset : offset + length]
+
+    def get_block(self, number: int) -> Block:
+        if number not in self.by_number:
+            raise BlockNotFound()
+        record = self.read(*self.by_number[number])
+        with record:
+            payload = record[RECORD_HEADER.size :]
+            if payload[0] == ord("{"):
+                return block_from_dict(json.loads(payload.tobytes()))
+            return decode_block(payload)
+
+    def get_block_by_hash(self, block_hash: str) -> Block:
+        if block_hash not in self.by_hash:
+            raise BlockNotFound()
+        return self.get_block(self.by_hash[block_hash])
+
+    def __contains__(self, number: int) -> bool:
+        return number in self.by_number
+
+    def __len__(self) -> int:
+        return len(self.by_number)
+
+    def close(self):
+        self.file.close()
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
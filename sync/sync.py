@@ -0,0 +1,134 @@
+from account.account import AccountStore, account_from_dict
+from block.block import Block, BlockHeader
+import hashlib
+import json
+
+# Characters of encoded state per state_chunk message.
+STATE_CHUNK_SIZE = 64 * 1024
+# Headers per headers message, and block bodies per getblocks request.
+MAX_HEADERS = 500
+BLOCKS_PER_REQUEST = 16
+
+
+class StateExport:
+    """A blockchain state frozen for syncing a peer: one JSON line for the state header,
+    then one per account. Peers fetch it in chunks by offset, so an interrupted
+    sync resumes where it stopped as long as the export id (the tip hash) is unchanged."""
+
+    def __init__(self, blockchain):
+        self.id = blockchain.blocks[-1].get_block_hash()
+        lines = [json.dumps(blockchain.state_header())]
+        lines += [json.dumps(a.to_dict()) for a in blockchain.accounts]
+        self.text = "\n".join(lines) + "\n"
+
+    def chunk(self, offset: int, chunk_size: int = STATE_CHUNK_SIZE) -> dict:
+        data = self.text[offset : offset + chunk_size]
+        return {
+            "id": self.id,
+            "offset": offset,
+            "total": len(self.text),
+            "data": data,
+            "checksum": hashlib.sha256(data.encode()).hexdigest(),
+        }
+
+
+class StateImport:
+    """Applies the chunks of a StateExport as they arrive. Only the unfinished
+    last line of the latest chunk is buffered, accounts are decoded right away."""
+
+    def __init__(self, id: str = None):
+        self.id = id
+        self.offset = 0
+        self.total = None
+        self.partial_line = ""
+        self.header = None
+        self.accounts = AccountStore([])
+
+    def request(self) -> dict:
+        return {"id": self.id, "offset": self.offset}
+
+    # Returns False if the chunk doesn't continue this import and was ignored.
+    def apply(self, chunk: dict) -> bool:
+        if chunk["checksum"] != hashlib.sha256(chunk["data"].encode()).hexdigest():
+            return False
+        if chunk["id"] != self.id or chunk["offset"] != self.offset:
+            if chunk["offset"] != 0:
+                return False
+            self.__init__(chunk["id"])  # the peer restarted us on a new export.
+
+        self.total = chunk["total"]
+        self.offset += len(chunk["data"])
+        lines = (self.partial_line + chunk["data"]).split("\n")
+        self.partial_line = lines.pop()
+        for line in lines:
+            if self.header is None:
+                self.header = json.loads(line)
+            else:
+                self.accounts.append(account_from_dict(json.loads(line)))
+        return True
+
+    def done(self) -> bool:
+        return self.total is not None and self.offset >= self.total
+
+
+class BlockDownload:
+    """Fetches the bodies of already validated headers from several peers at once.
+    Each peer has at most one batch of BLOCKS_PER_REQUEST blocks in flight,
+    and bodies are released in chain order as soon as they are contiguous.
+    A peer isn't asked again for blocks it didn't send, e.g. because it's behind,
+    so they go to another peer, in the end the one that sent the headers."""
+
+    def __init__(self, headers: list[BlockHeader]):
+        self.hashes = {h.number: h.get_block_hash() for h in headers}
+        self.next_number = headers[0].number
+        self.last_number = headers[-1].number
+        self.received = {}  # number -> Block, waiting for the blocks before it.
+        self.in_flight = {}  # peer -> numbers requested from it.
+        self.failed = {}  # number -> peers that were asked for it and didn't send it.
+
+    # Hands a batch of blocks nobody is fetching to every idle peer, leaving out the
+    # blocks each peer already failed to send.
+    def assign(self, peers: list) -> dict:
+        fetching = {n for numbers in self.in_flight.values() for n in numbers}
+        missing = [
+            n
+            for n in range(self.next_number, self.last_number + 1)
+            if n not in self.received and n not in fetching
+        ]
+        batches = {}
+        for peer in peers:
+            if peer in self.in_flight:
+                continue
+            batch = [n for n in missing if peer not in self.failed.get(n, ())][:BLOCKS_PER_REQUEST]
+            if batch == []:
+                continue
+            self.in_flight[peer] = batch
+            batches[peer] = batch
+            missing = [n for n in missing if n not in batch]
+        return batches
+
+    # Called with a peer's reply, or with no blocks if the peer is gone.
+    def add(self, peer, blocks: list[Block]):
+        requested = self.in_flight.pop(peer, [])
+        for b in blocks:
+            # The body must match the header we validated.
+            if b.number >= self.next_number and self.hashes.get(b.number) == b.get_block_hash():
+                self.received[b.number] = b
+        for n in requested:
+            if n not in self.received and n >= self.next_number:
+                self.failed.setdefault(n, set()).add(peer)
+
+    # True if nothing is being fetched, but blocks are still missing: every peer
+    # asked for them failed to send them.
+    def stalled(self) -> bool:
+        return self.in_flight == {} and not self.done()
+
+    def ready(self) -> list[Block]:
+        blocks = []
+        while self.next_number in self.received:
+            blocks.append(self.received.pop(self.next_number))
+            self.next_number += 1
+        return blocks
+
+    def done(self) -> bool:
+        return self.next_number > self.last_number
@@ -1,11 +1,66 @@
 import unittest
-from time import time
+from unittest.mock import patch
+from time import time, sleep
 import hashlib
 import os
-from account.account import Account, ZERO_ADDRESS
-from transaction.transaction import Transaction
-from block.block import Block
-from blockchain.blockchain import Blockchain
+import pickle
+import tempfile
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import urllib.request
+from account.account import (
+    Account,
+    AccountStore,
+    AccountOverlay,
+    AccountNotFound,
+    ZERO_ADDRESS,
+    account_from_dict,
+    code_hash,
+)
+from transaction.transaction import Transaction, SignatureCache, signature_cache, tx_from_dict
+from block.block import Block, block_from_dict
+from blockchain.blockchain import Blockchain, InvalidState
+from store.store import BlockStore, BlockNotFound
+from snapshot.snapshot import StateSnapshots
+from sync.sync import StateExport, StateImport, BlockDownload
+from mempool.mempool import Mempool
+from transport.transport import Transport
+from execution.execution import partition, commit_accounts
+from merkle.merkle import merkle_root, merkle_proof, verify_merkle_proof, EMPTY_ROOT
+from state.state import StateTrie, StateNotFound, verify_state_proof
+from relay.relay import BlockReconstruction, compact_block
+from metrics.metrics import Registry
+from rpc.rpc import RPCClient, RPCError, RPCServer, METHOD_NOT_FOUND, INTERNAL_ERROR
+from node.node import Node
+from simulator.simulator import simulate
+from codec.codec import encode_block, decode_block, encode_message, decode_message
+from contract.contract import (
+    ContractCache,
+    ContractFailed,
+    contract_cache,
+    deploy_contract,
+    call_contract,
+)
+
+
+class IdleNode:
+    block_found_by_peer = False
+
+
+def new_blockchain(**kwargs) -> Blockchain:
+    return Blockchain(
+        _difficulty=1,
+        _target=(2**256) - 1,
+        _expected_block_time=10,
+        _recalculate_every_x_blocks=10,
+        _xth_last_block_time=0,
+        _blocks=[],
+        _accounts=[],
+        **kwargs,
+    )
 
 
 class TestBlockchain(unittest.TestCase):
@@ -23,6 +78,791 @@ class TestBlockchain(unittest.TestCase):
         with self.assertRaises(TypeError):
             s.split(2)
 
+    def test_mine_nonce(self):
+        target = ((2**256) - 1) / 1000
+        for workers in [1, 2]:
+            block = Block(_number=1, _prev_hash="0" * 64, _txs=[])
+            block.mine_nonce(target, IdleNode(), workers=workers)
+            self.assertLess(int(block.get_block_hash(), 16), target)
+        workers = {p.pid for p in multiprocessing.active_children()}
+        self.assertGreaterEqual(len(workers), 2)  # still running, waiting for the next block.
+        block = Block(_number=2, _prev_hash=block.get_block_hash(), _txs=[])
+        block.mine_nonce(target, IdleNode(), workers=2)
+        self.assertLess(int(block.get_block_hash(), 16), target)
+        self.assertEqual({p.pid for p in multiprocessing.active_children()}, workers)  # reused.
+
+    def test_account_store(self):
+        contract = Account(_address="0x" + "1" * 40, _code="def f():\n\tpass")
+        accounts = AccountStore([Account(_address=ZERO_ADDRESS)])
+        accounts.append(contract)
+        self.assertIs(accounts.get(contract.address), contract)
+        self.assertEqual([a.address for a in accounts], [ZERO_ADDRESS, contract.address])
+        self.assertIs(accounts[1], contract)
+        with self.assertRaises(AccountNotFound):
+            accounts.get("0x" + "2" * 40)
+
+    def test_account_overlay(self):
+        code = "def constructor():\n\tpass\ndef push(n):\n\towners.append(n)"
+        accounts = AccountStore([])
+        deploy_contract("0xa", code, {"owners": [], "balances": {"0xa": 1}}, "0xc", accounts)
+        storage = accounts.get("0xc").storage
+        copies = AccountOverlay(accounts)
+        self.assertEqual(call_contract(copies, "0xa", "0xc", "push(1)")[0], {"owners"})
+        deploy_contract("0xa", code, {"owners": []}, "0xd", copies)
+        self.assertEqual(storage, {"owners": [], "balances": {"0xa": 1}})  # left as is.
+        self.assertNotIn("0xd", accounts)
+        self.assertEqual(copies.get("0xc").storage.copied, {"owners"})  # balances wasn't read.
+        shipped = pickle.loads(pickle.dumps(copies.get("0xc").storage))  # to parallel workers.
+        self.assertEqual((type(shipped), shipped), (dict, {"owners": [1], "balances": {"0xa": 1}}))
+
+        balances = storage["balances"]
+        commit_accounts(accounts, copies, {"0xc", "0xd"})
+        self.assertEqual(accounts.get("0xc").storage, {"owners": [1], "balances": {"0xa": 1}})
+        self.assertIs(accounts.get("0xc").storage["balances"], balances)
+        self.assertIs(type(accounts.get("0xc").storage), dict)
+        self.assertEqual([a.address for a in accounts], ["0xc", "0xd"])
+
+    def test_parallel_verify_matches_serial(self):
+        results = []
+        for parallel in [False, True]:
+            blockchain = new_blockchain(_parallel_verify=parallel)
+            a, b, c = blockchain.accounts[0], blockchain.accounts[1], blockchain.accounts[2]
+            txs = [
+                a.send_transaction(to=b.address, amount=10, nonce=0)[0],
+                b.send_transaction(to=c.address, amount=5, nonce=0)[0],
+                a.send_transaction(to=c.address, amount=1, nonce=1)[0],
+            ]
+            txs[1].amount = 50  # invalidates the signature.
+            blockchain.execute_block(Block(_number=1, _txs=txs))
+            results.append([(acc.balance, acc.nonce) for acc in blockchain.accounts])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][:3], [(89, 2), (110, 0), (101, 0)])
+
+    def test_signature_cache(self):
+        cache = SignatureCache(2)
+        cache.put(("h1", "s1"), "a1")
+        cache.put(("h2", "s2"), "a2")
+        self.assertEqual(cache.get(("h1", "s1")), "a1")
+        cache.put(("h3", "s3"), "a3")  # evicts h2, the least recently used.
+        self.assertIsNone(cache.get(("h2", "s2")))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        a = Account(_private_key="0x" + "1".zfill(64))
+        (tx, _) = a.send_transaction(to=ZERO_ADDRESS, amount=1, nonce=0)
+        hits = signature_cache.hits
+        self.assertTrue(tx.verify_signature())
+        self.assertTrue(tx.verify_signature())
+        self.assertEqual(signature_cache.hits, hits + 1)
+
+    def test_block_store(self):
+        a = Account(_private_key="0x" + "1".zfill(64))
+        with tempfile.TemporaryDirectory() as d:
+            store = BlockStore(d, segment_size=1024)
+            blocks = []
+            prev_hash = "0" * 64
+            for n in range(1, 6):
+                (tx, _) = a.send_transaction(to=ZERO_ADDRESS, amount=1, nonce=n)
+                b = Block(_number=n, _timestamp=n, _prev_hash=prev_hash, _txs=[tx])
+                store.append(b)
+                blocks.append(b)
+                prev_hash = b.get_block_hash()
+            store.close()
+            self.assertGreater(len(os.listdir(d)), 1)  # rolled over to new segments.
+
+            store = BlockStore(d, segment_size=1024)  # index is rebuilt from disk.
+            self.assertEqual(len(store), 5)
+            for b in blocks:
+                self.assertEqual(store.get_block(b.number).get_block_hash(), b.get_block_hash())
+            self.assertEqual(store.get_block_by_hash(prev_hash).number, 5)
+            self.assertEqual(store.get_block(3).txs[0].verify_signature(), True)
+            with self.assertRaises(BlockNotFound):
+                store.get_block(6)
+            store.close()
+
+    def test_incremental_snapshots(self):
+        with tempfile.TemporaryDirectory() as d:
+            store = BlockStore(os.path.join(d, "blocks"))
+            blockchain = new_blockchain(_snapshots=StateSnapshots(d, compact_every=2), _block_store=store)
+            a, b = blockchain.accounts[0], blockchain.accounts[1]
+            for nonce in range(3):
+                (tx, _) = a.send_transaction(to=b.address, amount=1, nonce=nonce)
+                block = Block(
+                    _number=blockchain.blocks[-1].number + 1,
+                    _timestamp=blockchain.blocks[-1].timestamp,
+                    _prev_hash=blockchain.blocks[-1].get_block_hash(),
+                    _txs=[tx],
+                )
+                blockchain.prepare_block(block)
+                blockchain.execute_block(block)
+                blockchain.add_block(block)
+                with open(os.path.join(d, "journal.log")) as j:
+                    deltas = [json.loads(line) for line in j]
+                # two deltas with the 2 changed accounts, then compaction.
+                self.assertEqual(
+                    [len(delta["accounts"]) for delta in deltas], [[2], [2, 2], []][nonce]
+                )
+                if nonce == 1:
+                    deltas_before_compaction = deltas
+
+            restarted = new_blockchain(_snapshots=StateSnapshots(d, compact_every=2), _block_store=store)
+            self.assertEqual(restarted.save_state(), blockchain.save_state())
+            # The tip is a placeholder in memory, the stored block is served instead.
+            self.assertEqual(restarted.blocks[-1].nonce, -1)
+            self.assertEqual(restarted.get_block(3).get_block_hash(), blockchain.blocks[-1].get_block_hash())
+            self.assertEqual(len(restarted.get_block(3).txs), 1)
+            store.close()
+
+            # A crash after replacing the base but before emptying the journal.
+            with open(os.path.join(d, "journal.log"), "w") as j:
+                j.writelines(json.dumps(delta) + "\n" for delta in deltas_before_compaction)
+            restarted = new_blockchain(_snapshots=StateSnapshots(d, compact_every=2))
+            self.assertEqual(restarted.save_state(), blockchain.save_state())
+
+            with open(os.path.join(d, "base.json"), "w") as b:
+                json.dump(dict(blockchain.save_state(), state_root="0" * 64), b)
+            with self.assertRaises(InvalidState):
+                new_blockchain(_snapshots=StateSnapshots(d, compact_every=2))
+
+    def test_chunked_state_sync(self):
+        source = new_blockchain()
+        export = StateExport(source)
+        state_import = StateImport()
+        chunk = export.chunk(0, chunk_size=100)
+        corrupted = dict(chunk, data=chunk["data"][::-1])
+        self.assertFalse(state_import.apply(corrupted))
+        while not state_import.done():
+            request = state_import.request()
+            self.assertTrue(state_import.apply(export.chunk(request["offset"], 100)))
+        self.assertEqual(len(state_import.partial_line), 0)
+
+        target = new_blockchain()
+        target.set_state(state_import.header, state_import.accounts)
+        self.assertEqual(target.save_state(), source.save_state())
+
+    def test_headers_first_download(self):
+        source = new_blockchain()
+        a, b = source.accounts[0], source.accounts[1]
+        for nonce in range(5):
+            (tx, _) = a.send_transaction(to=b.address, amount=1, nonce=nonce)
+            block = Block(
+                _number=source.blocks[-1].number + 1,
+                _timestamp=source.blocks[-1].timestamp,
+                _prev_hash=source.blocks[-1].get_block_hash(),
+                _txs=[tx],
+            )
+            source.prepare_block(block)
+            source.execute_block(block)
+            source.add_block(block)
+        headers = [b.header() for b in source.blocks[1:]]
+
+        target = new_blockchain()
+        target.blocks = [source.blocks[0]]  # caught up to genesis only.
+        self.assertTrue(target.validate_headers(headers))
+        self.assertFalse(target.validate_headers(headers[1:]))
+
+        download = BlockDownload(headers)
+        batches = download.assign(["p1", "p2"])
+        self.assertEqual(batches["p1"], [1, 2, 3, 4, 5])
+        self.assertNotIn("p2", batches)
+        download.add("p1", [block_from_dict(source.blocks[n].to_dict()) for n in [2, 4]])
+        self.assertEqual(download.ready(), [])  # block 1 is still missing.
+        download.assign(["p2"])
+        download.add("p2", [source.blocks[1], source.blocks[3], source.blocks[5]])
+        self.assertEqual([b.number for b in download.ready()], [1, 2, 3, 4, 5])
+        self.assertTrue(download.done())
+
+        # A peer that's behind answers with no blocks. Its batch goes to the headers peer.
+        download = BlockDownload(headers)
+        self.assertEqual(download.assign(["behind", "source"]), {"behind": [1, 2, 3, 4, 5]})
+        download.add("behind", [])
+        self.assertEqual(download.assign(["behind", "source"]), {"source": [1, 2, 3, 4, 5]})
+        self.assertEqual(download.assign(["behind", "source"]), {})  # not asked again.
+        download.add("source", source.blocks[1:])
+        self.assertEqual(len(download.ready()), 5)
+        download = BlockDownload(headers)
+        download.assign(["behind"])
+        download.add("behind", [])
+        self.assertEqual(download.assign(["behind"]), {})
+        self.assertTrue(download.stalled())  # nobody else to ask.
+
+    def test_mempool(self):
+        blockchain = new_blockchain()
+        a, b = blockchain.accounts[0], blockchain.accounts[1]
+        mempool = Mempool(max_txs=4)
+        a0 = a.send_transaction(to=b.address, amount=1, nonce=0, gas_price=1)[0]
+        a1 = a.send_transaction(to=b.address, amount=1, nonce=1, gas_price=5)[0]
+        a3 = a.send_transaction(to=b.address, amount=1, nonce=3, gas_price=9)[0]
+        b0 = b.send_transaction(to=a.address, amount=1, nonce=0, gas_price=2)[0]
+        self.assertTrue(all(mempool.add(tx) for tx in [a0, a1, a3, b0]))
+        self.assertFalse(mempool.add(a0))  # duplicate.
+        a0_cheap = a.send_transaction(to=b.address, amount=2, nonce=0, gas_price=1)[0]
+        self.assertFalse(mempool.add(a0_cheap))  # doesn't outbid a0.
+
+        # a3 can't execute before a2, and b0 pays more than a0.
+        self.assertEqual(mempool.select(blockchain.accounts), [b0, a0, a1])
+
+        b1 = b.send_transaction(to=a.address, amount=1, nonce=1, gas_price=10)[0]
+        self.assertTrue(mempool.add(b1))  # full, so a3 (a's last tx) is evicted.
+        self.assertNotIn(a3.get_tx_hash(), mempool)
+
+        a.nonce = 1  # as if a0 was executed.
+        mempool.prune(blockchain.accounts)
+        self.assertEqual(len(mempool), 3)
+        self.assertEqual(mempool.select(blockchain.accounts, max_txs=2), [a1, b0])
+
+        # A transaction to an unknown account isn't selected, nor executed if a block has it.
+        c0 = blockchain.accounts[2].send_transaction(to="0x" + "0" * 39 + "1", amount=1, nonce=0)[0]
+        self.assertTrue(mempool.add(c0))
+        self.assertNotIn(c0, mempool.select(blockchain.accounts))
+        tip = blockchain.blocks[-1]
+        block = Block(_number=1, _timestamp=tip.timestamp, _prev_hash=tip.get_block_hash(), _txs=[c0])
+        blockchain.prepare_block(block)
+        blockchain.execute_block(block)
+        self.assertEqual(blockchain.accounts[2].nonce, 0)
+
+        # Malformed transactions are neither admitted nor executed.
+        c = blockchain.accounts[2]
+        restringed = tx_from_dict({**c0.to_dict(), "to": b.address, "amount": "1"})
+        self.assertEqual(restringed.get_tx_hash(), tx_from_dict({**restringed.to_dict(), "amount": 1}).get_tx_hash())
+        malformed = [
+            restringed,  # same hash and signature as with amount 1.
+            c.send_transaction(to=ZERO_ADDRESS, amount=0, nonce=0, data={"x": 1})[0],  # deploy without code.
+            c.send_transaction(to=b.address, amount=0, nonce=0, data={"call": 1})[0],
+            c.send_transaction(to=b.address, amount=-5, nonce=0)[0],  # would take from b.
+        ]
+        for tx in malformed:
+            self.assertFalse(mempool.add(tx))
+        block = Block(_number=1, _timestamp=tip.timestamp, _prev_hash=tip.get_block_hash(), _txs=malformed)
+        blockchain.prepare_block(block)
+        blockchain.execute_block(block)
+        self.assertEqual((c.nonce, b.balance), (0, 100))
+
+    def test_mempool_threads(self):
+        senders = [Account(_private_key="0x" + str(i + 1).zfill(64), _balance=10) for i in range(500)]
+        accounts = AccountStore(senders)
+        txs = [s.send_transaction(to=senders[0].address, amount=0, nonce=n)[0] for s in senders for n in range(2)]
+        mempool = Mempool()
+        adder = threading.Thread(target=lambda: [mempool.add(tx) for tx in txs])
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads often, mid-iteration.
+        try:
+            adder.start()
+            while adder.is_alive():  # as the miner does, while the network thread adds txs.
+                mempool.select(accounts)
+                mempool.prune(accounts)
+                BlockReconstruction({"header": Block(_number=1, _txs=[]).header().to_dict(), "short_ids": []}, mempool)
+            adder.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(len(mempool), len(txs))
+
+    def test_transport(self):
+        events = queue.Queue()
+        callback = lambda event, node, peer, data: events.put((event, node.port, data))
+        a = Transport("127.0.0.1", 0, callback=callback)
+        b = Transport("127.0.0.1", 0, callback=callback)
+        a.start()
+        b.start()
+        try:
+            self.assertTrue(a.connect_with_node("127.0.0.1", b.port))
+            a.send_to_nodes({"n": 1, "payload": "x" * 100_000})  # spans many reads.
+            received = [events.get(timeout=5) for _ in range(3)]
+            self.assertIn(("outbound_node_connected", a.port, {}), received)
+            self.assertIn(("inbound_node_connected", b.port, {}), received)
+            message = [data for event, _, data in received if event == "node_message"]
+            self.assertEqual(message[0]["n"], 1)
+            self.assertEqual(b.nodes_inbound[0].port, a.port)
+        finally:
+            a.stop()
+            b.stop()
+
+    def test_transport_bad_message(self):
+        events = queue.Queue()
+
+        def callback(event, node, peer, data):
+            if event == "node_message" and "bad" in data:
+                data["missing"]  # a handler failing on a malformed message.
+            if event != "node_request_to_stop":
+                events.put((event, node.port, data if event == "node_message" else peer.port))
+
+        a = Transport("127.0.0.1", 0, callback=callback)
+        b = Transport("127.0.0.1", 0, callback=callback)
+        c = Transport("127.0.0.1", 0, callback=callback)
+        for t in (a, b, c):
+            t.start()
+        try:
+            self.assertTrue(a.connect_with_node("127.0.0.1", c.port))
+            self.assertTrue(b.connect_with_node("127.0.0.1", c.port))
+            a.send_to_nodes({"bad": 1})
+            received = [events.get(timeout=5) for _ in range(6)]
+            self.assertIn(("inbound_node_disconnected", c.port, a.port), received)
+            self.assertEqual([p.port for p in c.nodes_inbound], [b.port])
+            b.send_to_nodes({"n": 1})  # c still reads from its other peers.
+            while (event := events.get(timeout=5))[0] != "node_message":
+                pass
+            self.assertEqual(event, ("node_message", c.port, {"n": 1}))
+        finally:
+            for t in (a, b, c):
+                t.stop()
+
+    def test_contract_cache(self):
+        cache = ContractCache(1)
+        self.assertIs(cache.get("a = 1", "h1"), cache.get("a = 1", "h1"))
+        cache.get("a = 2", "h2")  # evicts "a = 1".
+        cache.get("a = 1", "h1")
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        with open("contracts/ERC-20.py", "r") as e:
+            erc20 = e.read()
+        accounts = AccountStore([])
+        variables = {"supply": 100, "balances": {}, "allowances": {}}
+        deploy_contract("0xa", erc20, variables, "0xc", accounts)
+        self.assertEqual(accounts.get("0xc").code_hash, code_hash(erc20))
+        self.assertEqual(account_from_dict(accounts.get("0xc").to_dict()).code_hash, code_hash(erc20))
+        hits = contract_cache.hits
+        with patch("account.account.hashlib.sha256") as sha256:
+            for _ in range(3):
+                call_contract(accounts, "0xa", "0xc", "transfer('0xb', 10)")
+        sha256.assert_not_called()  # the code is hashed once, at deployment.
+        self.assertEqual(contract_cache.hits, hits + 3)  # compiled once, at deployment.
+        storage = accounts.get("0xc").storage
+        self.assertEqual(storage["balances"], {"0xa": 70, "0xb": 30})
+        self.assertEqual(set(storage), {"supply", "balances", "allowances"})
+        self.assertEqual(variables["balances"], {})  # tx data isn't shared with storage.
+
+    def test_contract_write_set(self):
+        code = "def constructor():\n\tpass\ndef set_a(n):\n\tglobal a, b; a = n; b = n\ndef get_a():\n\treturn a"
+        accounts = AccountStore([])
+        deploy_contract("0xa", code, {"a": 0, "m": {}}, "0xc", accounts)
+        storage = accounts.get("0xc").storage
+        self.assertEqual(call_contract(accounts, "0xa", "0xc", "get_a()")[0], set())
+        self.assertEqual(call_contract(accounts, "0xa", "0xc", "set_a(5)")[0], {"a"})
+        self.assertEqual(storage, {"a": 5, "m": {}})  # b was never declared.
+        self.assertEqual(call_contract(accounts, "0xa", "0xc", "m[MSGSENDER] = 1")[0], {"m"})
+        self.assertEqual(storage["m"], {"0xa": 1})
+
+        # Storage must stay JSON, state roots encode it. Other values revert the call.
+        for call in ["set_a({1, 2})", "m['x'] = {1}", "m[1] = 1; m['y'] = 2", "set_a(5); m['z'] = object()"]:
+            with self.assertRaises(ContractFailed):
+                call_contract(accounts, "0xa", "0xc", call)
+            self.assertEqual(storage, {"a": 5, "m": {"0xa": 1}})
+        blockchain = new_blockchain()
+        a = blockchain.accounts[0]
+        blockchain.accounts.append(accounts.get("0xc"))
+        (tx, _) = a.send_transaction(to="0xc", amount=0, nonce=0, data={"call": "set_a({1, 2})"})
+        blockchain.prepare_block(Block(_number=1, _txs=[tx]))  # doesn't raise.
+
+    def test_contract_storage_containers(self):
+        accounts = AccountStore([])
+        variables = {"owners": [], "balances": {"0xa": 1}, "out": {}}
+        deploy_contract("0xa", "def constructor():\n\tpass", variables, "0xc", accounts)
+        storage = accounts.get("0xc").storage
+        checks = {
+            "add": "owners + [1]",
+            "radd": "[0] + owners",
+            "empty": "owners == []",
+            "is_list": "isinstance(owners, list)",
+            "is_dict": "isinstance(balances, dict)",
+            "copy": "balances.copy()",
+            "dict_eq": "balances == {'0xa': 1}",
+            "merge": "balances | {'0xb': 2}",
+            "sliced": "owners[:]",
+        }
+        call = "\n".join(f"out['{k}'] = {v}" for k, v in checks.items())
+        call_contract(accounts, "0xa", "0xc", call)
+        self.assertEqual(
+            storage["out"],
+            {
+                "add": [1],
+                "radd": [0],
+                "empty": True,
+                "is_list": True,
+                "is_dict": True,
+                "copy": {"0xa": 1},
+                "dict_eq": True,
+                "merge": {"0xa": 1, "0xb": 2},
+                "sliced": [],
+            },
+        )
+        json.dumps(storage)  # nothing wrapped was stored.
+
+        # Copies are detached from storage, in-place operations are journaled.
+        call_contract(accounts, "0xa", "0xc", "c = balances.copy()\nc['0xa'] = 5\nowners += [1, 2]\nowners.sort(reverse=True)")
+        self.assertEqual((storage["balances"], storage["owners"]), ({"0xa": 1}, [2, 1]))
+        with self.assertRaises(ContractFailed):
+            call_contract(accounts, "0xa", "0xc", "owners *= 3\nowners.reverse()\nbalances |= {'0xb': 2}\nassert False")
+        self.assertEqual((storage["balances"], storage["owners"]), ({"0xa": 1}, [2, 1]))
+
+    def test_gas_metering(self):
+        code = "def constructor():\n\tpass\ndef spin(n):\n\tm['x'] = 1\n\tfor i in range(n):\n\t\ttry:\n\t\t\tpass\n\t\texcept:\n\t\t\tpass"
+        accounts = AccountStore([])
+        deploy_contract("0xa", code, {"m": {"x": 0}}, "0xc", accounts)
+        (_, gas_used) = call_contract(accounts, "0xa", "0xc", "spin(10)", gas_limit=1000)
+        with self.assertRaises(ContractFailed) as failed:
+            call_contract(accounts, "0xa", "0xc", "m['y'] = 2; spin(10**9)", gas_limit=1000)
+        self.assertEqual(failed.exception.gas_used, 1000)
+        self.assertEqual(accounts.get("0xc").storage, {"m": {"x": 1}})  # y = 2 was reverted.
+        with self.assertRaises(ContractFailed):
+            call_contract(accounts, "0xa", "0xc", "[i for i in range(10**9)]", gas_limit=1000)
+        # Contract code can reach the meter through its functions' globals, but can't
+        # change or replace it, nor stop the node.
+        for bypass in [
+            "spin.__globals__['$gas'].limit = 10**18",
+            "spin.__globals__['$gas'] = lambda: True",
+            "spin.__globals__.update({'$gas': lambda: True})",
+            "spin.__globals__.meter = lambda: True",
+            "import contextlib\nwith contextlib.suppress(BaseException):\n\tspin(10**9)",
+            "raise SystemExit",
+            "exit()",
+        ]:
+            with self.assertRaises(ContractFailed) as failed:
+                call_contract(accounts, "0xa", "0xc", f"{bypass}\nm['y'] = 2\nspin(10**9)", gas_limit=1000)
+            self.assertLessEqual(failed.exception.gas_used, 1000)
+            self.assertEqual(accounts.get("0xc").storage, {"m": {"x": 1}})
+        for c_work in [
+            "m['y'] = sum(range(10**8))",
+            "m['y'] = len(range(10**8))",
+            "m['y'] = max(i for i in m for j in range(10**8))",
+            "m['y'] = sum(map(abs, range(900)))",  # 900 gas for the range, 900 for sum().
+        ]:
+            with self.assertRaises(ContractFailed) as failed:
+                call_contract(accounts, "0xa", "0xc", c_work, gas_limit=1000)
+            self.assertEqual((str(failed.exception), failed.exception.gas_used), ("out of gas", 1000))
+        self.assertEqual(accounts.get("0xc").storage, {"m": {"x": 1}})
+
+        blockchain = new_blockchain()
+        a = blockchain.accounts[0]
+        blockchain.accounts.append(accounts.get("0xc"))
+        (tx, _) = a.send_transaction(to="0xc", amount=0, nonce=0, data={"call": "spin(10)"}, gas_price=2)
+        blockchain.execute_block(Block(_number=1, _txs=[tx]))
+        self.assertEqual(a.balance, 100 - 2 * gas_used)
+
+        # A negative gas price would pay the sender for the gas it uses.
+        (tx, _) = a.send_transaction(to="0xc", amount=0, nonce=1, data={"call": "spin(10)"}, gas_price=-1000)
+        self.assertFalse(Mempool().add(tx))
+        before = a.balance
+        blockchain.execute_block(Block(_number=2, _txs=[tx]))
+        self.assertEqual((a.balance, a.nonce), (before, 1))
+
+    def test_parallel_execute_matches_serial(self):
+        code = "def constructor():\n\tpass\ndef add(n):\n\tglobal total\n\ttotal += n"
+        states = []
+        for parallel in [False, True]:
+            blockchain = new_blockchain(_parallel_execute=parallel)
+            a, b, c = blockchain.accounts[0], blockchain.accounts[1], blockchain.accounts[2]
+            (deploy, contract) = a.send_transaction(
+                to=ZERO_ADDRESS, amount=0, nonce=0, data={"code": code, "variables": {"total": 0}}
+            )
+            txs = [
+                deploy,
+                b.send_transaction(to=c.address, amount=5, nonce=0)[0],
+                a.send_transaction(to=contract, amount=0, nonce=1, data={"call": "add(2)"})[0],
+                c.send_transaction(to=b.address, amount=1, nonce=0)[0],
+                a.send_transaction(to=contract, amount=0, nonce=1, data={"call": "add(9)"})[0],
+            ]
+            self.assertEqual(partition(txs), [[0, 2, 4], [1, 3]])
+            blockchain.execute_block(Block(_number=1, _txs=txs))
+            states.append(blockchain.save_state()["accounts"])
+        self.assertEqual(states[0], states[1])
+        self.assertEqual(states[1][-1]["storage"], {"total": 2})
+
+    def test_merkle_proofs(self):
+        leaves = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(5)]
+        root = merkle_root(leaves)
+        for i, leaf in enumerate(leaves):
+            self.assertTrue(verify_merkle_proof(leaf, merkle_proof(leaves, i), root))
+        self.assertFalse(verify_merkle_proof(leaves[0], merkle_proof(leaves, 1), root))
+
+        a = Account(_private_key="0x" + "1".zfill(64))
+        txs = [a.send_transaction(to=ZERO_ADDRESS, amount=1, nonce=n)[0] for n in range(3)]
+        block = Block(_number=1, _prev_hash="0" * 64, _txs=txs)
+        block_hash = block.get_block_hash()
+        self.assertEqual(block.header().get_block_hash(), block_hash)
+        proof = block.tx_proof(2)
+        self.assertTrue(verify_merkle_proof(txs[2].get_tx_hash(), proof, block.tx_root()))
+        block.txs = txs[:2]  # the cached root follows the transactions.
+        self.assertNotEqual(block.get_block_hash(), block_hash)
+
+    def test_memoized_hashes(self):
+        a = Account(_private_key="0x" + "1".zfill(64))
+        (tx, _) = a.send_transaction(to=ZERO_ADDRESS, amount=1, nonce=0)
+        tx_hash = tx.get_tx_hash()
+        self.assertIs(tx.get_tx_hash(), tx_hash)
+        tx.amount = 2
+        self.assertNotEqual(tx.get_tx_hash(), tx_hash)
+        self.assertFalse(hasattr(tx, "__dict__"))
+
+        block = Block(_number=1, _prev_hash="0" * 64, _txs=[tx])
+        block_hash = block.get_block_hash()
+        self.assertIs(block.get_block_hash(), block_hash)
+        block.nonce = 1  # as when mining finds a nonce.
+        self.assertNotEqual(block.get_block_hash(), block_hash)
+        self.assertEqual(block_from_dict(block.to_dict()).get_block_hash(), block.get_block_hash())
+
+    def test_binary_codec(self):
+        a = Account(_private_key="0x" + "1".zfill(64))
+        txs = [
+            a.send_transaction(to=ZERO_ADDRESS, amount=1, nonce=0)[0],
+            a.send_transaction(to="0x" + "ab" * 20, amount=2.5, nonce=1, data={"call": "f(1)"})[0],
+            Transaction("0xa", "0xb", 1, 2**70, "", "", 1),  # falls back to tagged values.
+        ]
+        block = Block(_number=3, _timestamp=1.25, _nonce=-1, _prev_hash="cd" * 32, _txs=txs)
+        encoded = encode_block(block)
+        self.assertLess(len(encoded), len(json.dumps(block.to_dict())))
+        decoded = decode_block(memoryview(encoded))
+        self.assertEqual(decoded.to_dict(), block.to_dict())
+        self.assertEqual([t.get_tx_hash() for t in decoded.txs], [t.get_tx_hash() for t in txs])
+        self.assertTrue(decoded.txs[1].verify_signature())
+
+        message = decode_message(memoryview(encode_message({"blocks": [block, block]})))
+        self.assertEqual([b.get_block_hash() for b in message["blocks"]], [block.get_block_hash()] * 2)
+        message = decode_message(memoryview(encode_message({"new_tx": txs[0]})))
+        self.assertEqual(message["new_tx"].to_dict(), txs[0].to_dict())
+        self.assertEqual(decode_message(memoryview(encode_message({"blocks": []}))), {"blocks": []})
+
+    def test_state_trie(self):
+        accounts = {f"0x{i:040x}": Account(_address=f"0x{i:040x}", _balance=i).to_dict() for i in range(20)}
+        trie = StateTrie()
+        root = trie.update(EMPTY_ROOT, accounts)
+        for i in range(0, 20, 3):  # updating some accounts gives the same root as rebuilding.
+            accounts[f"0x{i:040x}"]["balance"] += 1
+        updated = trie.update(root, {a: accounts[a] for a in list(accounts)[0:20:3]})
+        self.assertEqual(updated, StateTrie().update(EMPTY_ROOT, accounts))
+        self.assertEqual(trie.get(root, f"0x{3:040x}")["balance"], 3)  # old roots stay readable.
+        self.assertEqual(trie.get(updated, f"0x{3:040x}")["balance"], 4)
+
+        address = f"0x{6:040x}"
+        proof = trie.prove(updated, address)
+        self.assertTrue(verify_state_proof(address, trie.get(updated, address), proof, updated))
+        self.assertFalse(verify_state_proof(address, trie.get(root, address), proof, updated))
+        missing = "0x" + "f" * 40
+        self.assertIsNone(trie.get(updated, missing))
+        self.assertTrue(verify_state_proof(missing, None, trie.prove(updated, missing), updated))
+        trie.prune([updated])
+        with self.assertRaises(StateNotFound):
+            trie.get(root, address)
+
+        blockchain = new_blockchain()
+        a, b = blockchain.accounts[0], blockchain.accounts[1]
+        for nonce in range(2):
+            (tx, _) = a.send_transaction(to=b.address, amount=10, nonce=nonce)
+            block = Block(
+                _number=blockchain.blocks[-1].number + 1,
+                _timestamp=blockchain.blocks[-1].timestamp,
+                _prev_hash=blockchain.blocks[-1].get_block_hash(),
+                _txs=[tx],
+            )
+            prepared = blockchain.prepare_block(block)
+            self.assertEqual(a.balance, 100 - 10 * nonce)  # prepare_block() doesn't change accounts.
+            blockchain.commit_block(block, *prepared)  # as the miner does, without executing again.
+        self.assertEqual(blockchain.get_account_at(b.address, 1)["balance"], 110)
+        self.assertEqual(blockchain.get_account_at(b.address, 2)["balance"], 120)
+        self.assertNotIn("private_key", blockchain.get_account_at(b.address, 0))
+
+        state = blockchain.save_state()
+        state["accounts"][0]["balance"] += 1
+        synced = new_blockchain()
+        self.assertFalse(synced.set_state(state, AccountStore([account_from_dict(a) for a in state["accounts"]])))
+
+    def test_compact_block(self):
+        a = Account(_private_key="0x" + "1".zfill(64))
+        txs = [a.send_transaction(to=ZERO_ADDRESS, amount=1, nonce=n)[0] for n in range(4)]
+        block = Block(_number=1, _prev_hash="0" * 64, _txs=txs)
+        compact = compact_block(block)
+        self.assertLess(len(json.dumps(compact)), len(json.dumps(block.to_dict())) / 2)
+
+        mempool = Mempool()
+        for tx in [txs[0], txs[2], txs[3]]:
+            mempool.add(tx)
+        reconstruction = BlockReconstruction(compact, mempool)
+        self.assertEqual(reconstruction.missing(), [1])
+        self.assertFalse(reconstruction.fill([]))
+        self.assertTrue(reconstruction.fill([txs[1]]))
+        self.assertEqual(reconstruction.block().get_block_hash(), block.get_block_hash())
+
+        reconstruction = BlockReconstruction(compact, Mempool())
+        reconstruction.fill([txs[1], txs[0], txs[2], txs[3]])  # wrong order.
+        self.assertIsNone(reconstruction.block())
+
+    def test_import_block(self):
+        source = new_blockchain()
+        a, b = source.accounts[0], source.accounts[1]
+        blocks = []
+        for nonce in range(2):
+            (tx, _) = a.send_transaction(to=b.address, amount=10, nonce=nonce)
+            block = Block(
+                _number=source.blocks[-1].number + 1,
+                _timestamp=source.blocks[-1].timestamp,
+                _prev_hash=source.blocks[-1].get_block_hash(),
+                _txs=[tx],
+            )
+            source.prepare_block(block)
+            source.execute_block(block)
+            source.add_block(block)
+            blocks.append(block)
+
+        target = new_blockchain()
+        target.blocks = [source.blocks[0]]
+        before = target.save_state()
+        self.assertFalse(target.import_block(blocks[1]))  # skips block 1.
+        forged = block_from_dict(blocks[0].to_dict())
+        forged.state_root = "ab" * 32
+        self.assertFalse(target.import_block(forged))
+        self.assertEqual(target.save_state(), before)  # rejected blocks change nothing.
+        self.assertEqual(target.block_timings.rejected["header"], 1)
+        self.assertEqual(target.block_timings.rejected["execution"], 1)
+
+        # A malformed transaction rejects the block, an unrecoverable signature invalidates
+        # its transaction, and neither raises.
+        tx = blocks[0].txs[0]
+        self.assertFalse(tx_from_dict({**tx.to_dict(), "signature": "0x01"}).verify_signature())
+        for bad in [{"amount": "10"}, {"data": []}, {"signature": 1}]:
+            forged = block_from_dict(blocks[0].to_dict())
+            forged.txs = [tx_from_dict({**tx.to_dict(), **bad})]
+            self.assertFalse(target.import_block(forged))
+        self.assertEqual(target.block_timings.rejected["transactions"], 3)
+        self.assertEqual(target.save_state(), before)
+
+        for block in blocks:
+            self.assertTrue(target.import_block(block))
+        self.assertEqual(target.accounts[1].balance, 120)
+        self.assertEqual(target.state_root, source.state_root)
+        self.assertEqual(target.block_timings.blocks["commit"], 2)
+
+    def test_metrics(self):
+        metrics = Registry()
+        metrics.counter("hashes_total", "Hashes.").inc(5)
+        histogram = metrics.histogram("seconds", "Time.", buckets=[0.1, 1])
+        for v in [0.05, 0.5, 0.5, 2]:
+            histogram.observe(v)
+        text = metrics.render()
+        self.assertIn("hashes_total 5", text)
+        self.assertIn('seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('seconds_bucket{le="1"} 3', text)
+        self.assertIn('seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("seconds_count 4", text)
+
+        node = Node("127.0.0.1", 0)
+        node.blockchain = new_blockchain()
+        node.start()
+        try:
+            port = node.start_metrics(0)
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as r:
+                text = r.read().decode()
+            self.assertIn("simplechain_mempool_txs 0", text)
+            self.assertIn("# TYPE simplechain_block_execute_seconds histogram", text)
+        finally:
+            node.stop()
+
+    def test_simulator(self):
+        scenario = {
+            "_nodes": 3,
+            "_block_time": 5,
+            "_duration": 60,
+            "_tx_rate": 2,
+            "_accounts": 10,
+            "_latency": 0.05,
+            "_jitter": 0.01,
+            "_bandwidth": 10**6,
+            "_seed": 1,
+        }
+        result = simulate(scenario)
+        self.assertTrue(result["in_sync"])
+        self.assertGreater(result["blocks"], 0)
+        self.assertGreater(result["txs"], 0)
+        self.assertGreaterEqual(result["propagation_p50"], 0.05)
+        self.assertLess(result["time_to_sync"], 3600)
+
+        again = simulate(scenario)  # the same seed gives the same run.
+        del result["wall_seconds"], again["wall_seconds"]
+        self.assertEqual(result, again)
+
+    def test_tx_batches(self):
+        a = Account(_private_key="0x" + "1".zfill(64))
+        txs = [a.send_transaction(to=ZERO_ADDRESS, amount=1, nonce=n)[0] for n in range(3)]
+        forged = tx_from_dict({**txs[0].to_dict(), "amount": 1000})
+        restringed = tx_from_dict({**txs[0].to_dict(), "amount": "1"})  # signs the same as txs[0].
+
+        nodes = [Node("127.0.0.1", 0), Node("127.0.0.1", 0)]
+        for n in nodes:
+            n.blockchain = new_blockchain()
+            n.start()
+        try:
+            nodes[0].connect_with_node("127.0.0.1", nodes[1].port)
+            rpc = RPCClient("127.0.0.1", nodes[0].start_rpc(0))
+            hashes = rpc.call("sendTransactions", [tx.to_dict() for tx in [restringed] + txs + [forged]])
+            self.assertEqual(hashes, [None] + [tx.get_tx_hash() for tx in txs] + [None])
+            (again,) = rpc.batch([("sendTransactions", [[txs[0].to_dict()]])])  # same connection.
+            self.assertEqual(again, [None])
+            with self.assertRaises(RPCError):
+                rpc.call("sendTransactions", [{"fr": a.address}])
+            rpc.close()
+
+            mempool = nodes[1].blockchain.mempool
+            for _ in range(50):  # relayed in one batch.
+                if len(mempool) == 3:
+                    break
+                sleep(0.1)
+            self.assertEqual(set(mempool.by_hash), {tx.get_tx_hash() for tx in txs})
+        finally:
+            for n in nodes:
+                n.stop()
+
+        server = RPCServer(nodes[0])
+        responses = server.handle(
+            json.dumps(
+                [
+                    {"jsonrpc": "2.0", "id": 1, "method": "nope"},
+                    {"jsonrpc": "2.0", "method": "sendTransactions", "params": [[]]},  # notification.
+                ]
+            )
+        )
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0]["error"]["code"], METHOD_NOT_FOUND)
+
+    def test_rpc_reads(self):
+        node = Node("127.0.0.1", 0)
+        node.blockchain = new_blockchain()
+        a, b = node.blockchain.accounts[0], node.blockchain.accounts[1]
+        (tx, _) = a.send_transaction(to=b.address, amount=10, nonce=0)
+        tip = node.blockchain.blocks[-1]
+        block = Block(_number=1, _timestamp=tip.timestamp, _prev_hash=tip.get_block_hash(), _txs=[tx])
+        node.blockchain.prepare_block(block)
+        node.blockchain.execute_block(block)
+        node.blockchain.add_block(block)
+        node.blockchain.mempool.add(a.send_transaction(to=b.address, amount=1, nonce=1)[0])
+        node.start()
+        try:
+            rpc = RPCClient("127.0.0.1", node.start_rpc(0))
+            (number, balance, old_balance, nonce, pending, unknown) = rpc.batch(
+                [
+                    ("getBlockNumber", []),
+                    ("getBalance", [b.address]),
+                    ("getBalance", [b.address, 0]),
+                    ("getNonce", [a.address]),
+                    ("getNonce", {"address": a.address, "pending": True}),
+                    ("getStorage", ["0x" + "0" * 39 + "1"]),
+                ]
+            )
+            self.assertEqual((number, balance, old_balance), (1, b.balance, b.balance - 10))
+            self.assertEqual((nonce, pending, unknown), (1, 2, None))
+
+            got = rpc.call("getBlock", 1)  # same connection.
+            self.assertEqual(got["hash"], block.get_block_hash())
+            self.assertEqual(block_from_dict(got).get_block_hash(), block.get_block_hash())
+            self.assertIsNone(rpc.call("getBlock", 5))
+
+            proof = rpc.call("getAccountProof", 1, b.address)
+            self.assertTrue(
+                verify_state_proof(b.address, proof["account"], proof["proof"], proof["header"]["state_root"])
+            )
+            with self.assertRaises(RPCError) as e:
+                rpc.call("getBlock", "one")
+            self.assertEqual(e.exception.code, INTERNAL_ERROR)
+            rpc.close()
+        finally:
+            node.stop()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,18 +1,73 @@
 from eth_account import Account as web3_account  # from web3py dependency.
 from eth_account.messages import encode_defunct
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from metrics.metrics import registry
+from time import perf_counter
 import hashlib
 import json
+import os
 from hexbytes import HexBytes
 
+# Process pool for batch signature verification, created on first use.
+_verify_pool = None
+
+signatures_verified = registry.counter("simplechain_signatures_verified_total", "Transaction signatures checked.")
+verify_seconds = registry.histogram(
+    "simplechain_signature_verify_seconds", "Time to verify a batch of signatures, e.g. a block's or a gossiped tx's."
+)
+
 
 class BadSignatureException(Exception):
     "Raised when a transaction is not signed by the from address"
     pass
 
 
+class SignatureCache:
+    "Bounded LRU map of (tx hash, signature) -> recovered signer address."
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.signers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple[str, str]) -> str:
+        signer = self.signers.get(key)
+        if signer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.signers.move_to_end(key)
+        return signer
+
+    def put(self, key: tuple[str, str], signer: str):
+        self.signers[key] = signer
+        self.signers.move_to_end(key)
+        if len(self.signers) > self.max_size:
+            self.signers.popitem(last=False)
+
+    def __str__(self) -> str:
+        return f"Signature cache: {self.hits} hits, {self.misses} misses, {len(self.signers)}/{self.max_size} entries."
+
+
+# A transaction is usually verified when it's gossiped, when it's mined and
+# again by every peer importing the block, so recovered signers are cached.
+signature_cache = SignatureCache(10_000)
+
+
 class Transaction:
     "Represents a transaction."
 
+    # The hash is computed once, and again only if one of the fields changes.
+    # Fields are replaced rather than changed in place (e.g. data isn't mutated).
+    __slots__ = ("fr", "to", "amount", "nonce", "signature", "data", "gas_price", "_hash")
+
+    def __setattr__(self, name, value):
+        if name != "_hash":
+            object.__setattr__(self, "_hash", None)
+        object.__setattr__(self, name, value)
+
     def __init__(
         self,
         _fr: str,
@@ -24,37 +79,65 @@ class Transaction:
         _gas_price: float,
         **kwargs,
     ):
-        self.fr = _fr
-        self.to = _to
-        self.amount = _amount
-        self.nonce = _nonce
-        self.signature = _signature
-        self.data = _data
-        self.gas_price = _gas_price
+        # There's no hash to invalidate yet, so fields skip __setattr__ (decoding
+        # blocks creates transactions by the thousand).
+        set_field = object.__setattr__
+        set_field(self, "_hash", None)
+        set_field(self, "fr", _fr)
+        set_field(self, "to", _to)
+        set_field(self, "amount", _amount)
+        set_field(self, "nonce", _nonce)
+        set_field(self, "signature", _signature)
+        set_field(self, "data", _data)
+        set_field(self, "gas_price", _gas_price)
 
         if "_tx_dict" in kwargs:
             self.from_dict(kwargs["_tx_dict"])
 
     def verify_signature(self) -> bool:
         try:
-            message = encode_defunct(
-                text=f"{self.fr}{self.to}({self.amount})({self.nonce})({self.gas_price})({json.dumps(self.data)})"
-            )
-            if self.fr != web3_account.recover_message(
-                message, signature=HexBytes(self.signature)
-            ):
+            key = self.signature_cache_key()
+            signer = signature_cache.get(key)
+            if signer is None:
+                signer = self.recover_signer()
+                signature_cache.put(key, signer)
+            if self.fr != signer:
                 raise BadSignatureException
             return True
         except BadSignatureException:
             return False
 
+    # The address that signed the transaction, or "" if the signature can't be
+    # recovered (e.g. it's too short), which is no sender's address.
+    def recover_signer(self) -> str:
+        try:
+            message = encode_defunct(
+                text=f"{self.fr}{self.to}({self.amount})({self.nonce})({self.gas_price})({json.dumps(self.data)})"
+            )
+            return web3_account.recover_message(message, signature=HexBytes(self.signature))
+        except Exception:
+            return ""
+
+    def signature_cache_key(self) -> tuple[str, str]:
+        return (self.get_tx_hash(), self.signature)
+
     def get_tx_hash(self) -> str:
-        return hashlib.sha256(
-            f"{self.fr}{self.to}({self.amount})({self.nonce})({self.gas_price})({self.data})".encode()
-        ).hexdigest()
+        if self._hash is None:
+            self._hash = hashlib.sha256(
+                f"{self.fr}{self.to}({self.amount})({self.nonce})({self.gas_price})({self.data})".encode()
+            ).hexdigest()
+        return self._hash
 
     def to_dict(self) -> dict:
-        return self.__dict__
+        return {
+            "fr": self.fr,
+            "to": self.to,
+            "amount": self.amount,
+            "nonce": self.nonce,
+            "signature": self.signature,
+            "data": self.data,
+            "gas_price": self.gas_price,
+        }
 
     def from_dict(self, tx: dict):
         self.fr = tx["fr"]
@@ -64,3 +147,53 @@ class Transaction:
         self.signature = tx["signature"]
         self.data = tx["data"]
         self.gas_price = tx["gas_price"]
+
+
+def tx_from_dict(tx: dict) -> Transaction:
+    return Transaction(
+        _fr="",
+        _to="",
+        _amount="",
+        _nonce="",
+        _signature="",
+        _data="",
+        _gas_price="",
+        _tx_dict=tx,
+    )
+
+
+def _recover_signer(tx: Transaction) -> str:
+    return tx.recover_signer()
+
+
+# Verifies the signatures of a batch of transactions. Returns one flag per transaction.
+# In parallel mode the secp256k1 recoveries that miss the signature cache
+# are spread over a process pool, and their results cached here.
+def verify_signatures(txs: list[Transaction], parallel: bool = False) -> list[bool]:
+    start = perf_counter()
+    valid = _verify_signatures(txs, parallel)
+    verify_seconds.observe(perf_counter() - start)
+    signatures_verified.inc(len(txs))
+    return valid
+
+
+def _verify_signatures(txs: list[Transaction], parallel: bool) -> list[bool]:
+    global _verify_pool
+    if not parallel or len(txs) < 2:
+        return [tx.verify_signature() for tx in txs]
+
+    keys = [tx.signature_cache_key() for tx in txs]
+    signers = [signature_cache.get(k) for k in keys]
+    missing = [i for i, signer in enumerate(signers) if signer is None]
+    if missing:
+        if _verify_pool is None:
+            _verify_pool = ProcessPoolExecutor()
+        workers = os.cpu_count() or 1
+        chunksize = max(1, len(missing) // (workers * 4))
+        recovered = _verify_pool.map(
+            _recover_signer, [txs[i] for i in missing], chunksize=chunksize
+        )
+        for i, signer in zip(missing, recovered):
+            signature_cache.put(keys[i], signer)
+            signers[i] = signer
+    return [tx.fr == signer for tx, signer in zip(txs, signers)]
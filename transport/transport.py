@@ -0,0 +1,257 @@
+from codec.codec import encode_message, decode_message
+from metrics.metrics import registry
+from time import perf_counter
+import asyncio
+import hashlib
+import logging
+import random
+import struct
+import threading
+
+log = logging.getLogger(__name__)
+
+# Messages are framed as a 4-byte big-endian length, then the message as encoded by
+# codec.encode_message(): binary for blocks and transactions, JSON for the rest.
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 32 * 1024 * 1024
+# Frames queued per peer. Past that, senders wait up to SEND_TIMEOUT seconds for
+# the peer to catch up, and a peer that doesn't is disconnected.
+MAX_QUEUED_FRAMES = 256
+SEND_TIMEOUT = 10
+
+bytes_received = registry.counter("simplechain_peer_bytes_received_total", "Bytes of frames received from peers.")
+bytes_sent = registry.counter("simplechain_peer_bytes_sent_total", "Bytes of frames sent to peers.")
+decode_seconds = registry.histogram("simplechain_message_decode_seconds", "Time to decode a peer message.")
+
+
+def encode_frame(data: dict) -> bytes:
+    payload = encode_message(data)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> dict:
+    (size,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {size} bytes is too large.")
+    payload = await reader.readexactly(size)
+    bytes_received.inc(FRAME_HEADER.size + size)
+    start = perf_counter()
+    data = decode_message(memoryview(payload))
+    decode_seconds.observe(perf_counter() - start)
+    return data
+
+
+class Peer:
+    "A connection to another node, with its own queue of frames to write."
+
+    def __init__(self, main_node, reader, writer, id: str, host: str, port: int, inbound: bool):
+        self.main_node = main_node
+        self.reader = reader
+        self.writer = writer
+        self.id = id
+        self.host = host
+        self.port = port  # the port the peer listens on, also for inbound connections.
+        self.inbound = inbound
+        self.queue = asyncio.Queue(MAX_QUEUED_FRAMES)
+        self.tasks = []
+
+    def __str__(self) -> str:
+        return f"Peer {self.host}:{self.port}"
+
+
+class Transport:
+    """Asyncio replacement for p2pnetwork's Node, with the same callbacks and sending API.
+    All connections are served by one event loop on a single network thread instead of
+    a thread per connection, and callbacks run on that thread. Each peer has a reader
+    task and a writer task draining its bounded frame queue."""
+
+    def __init__(self, host, port, id=None, callback=None, max_connections=0):
+        self.host = host
+        self.port = port
+        self.id = (
+            id
+            if id is not None
+            else hashlib.sha512(f"{host}{port}{random.randint(1, 99999999)}".encode()).hexdigest()
+        )
+        self.callback = callback
+        self.max_connections = max_connections  # inbound connections, 0 for no limit.
+        self.nodes_inbound = []
+        self.nodes_outbound = []
+        self.server = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    @property
+    def all_nodes(self) -> list[Peer]:
+        return self.nodes_inbound + self.nodes_outbound
+
+    def start(self):
+        self.thread.start()
+        self.call(self.start_server())
+
+    def stop(self):
+        self.node_request_to_stop()
+        self.call(self.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    # Runs {coro} on the network thread and waits for its result.
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def on_network_thread(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    async def start_server(self):
+        self.server = await asyncio.start_server(self.accept, self.host, self.port)
+        if self.port == 0:  # the OS picked a free port.
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for peer in self.all_nodes:
+            self.node_disconnected(peer)
+        await self.server.wait_closed()
+
+    def connect_with_node(self, host, port, reconnect=False) -> bool:
+        if host == self.host and port == self.port:
+            return False
+        if any(n.host == host and n.port == port for n in self.nodes_outbound):
+            return True
+        try:
+            self.call(self.connect(host, port))
+            return True
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            log.warning("Could not connect with %s:%s. (%s)", host, port, e)
+            return False
+
+    async def connect(self, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(encode_frame({"id": self.id, "port": self.port}))
+        hello = await read_frame(reader)
+        peer = Peer(self, reader, writer, hello["id"], host, port, inbound=False)
+        self.nodes_outbound.append(peer)
+        self.run_peer(peer)
+        self.outbound_node_connected(peer)
+
+    async def accept(self, reader, writer):
+        try:
+            hello = await read_frame(reader)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            writer.close()
+            return
+        if self.max_connections and len(self.nodes_inbound) >= self.max_connections:
+            log.warning("New connection is closed, reached the maximum connection limit.")
+            writer.close()
+            return
+        writer.write(encode_frame({"id": self.id, "port": self.port}))
+        host = writer.get_extra_info("peername")[0]
+        peer = Peer(self, reader, writer, hello["id"], host, hello["port"], inbound=True)
+        self.nodes_inbound.append(peer)
+        self.run_peer(peer)
+        self.inbound_node_connected(peer)
+
+    def run_peer(self, peer: Peer):
+        peer.tasks = [
+            self.loop.create_task(self.receive(peer)),
+            self.loop.create_task(self.send(peer)),
+        ]
+
+    # A peer whose message can't be decoded or handled, e.g. one missing fields, is
+    # disconnected. The error is logged and the other peers are served as before.
+    async def receive(self, peer: Peer):
+        try:
+            while peer in self.all_nodes:
+                self.node_message(peer, await read_frame(peer.reader))
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            log.info("%s disconnected. (%s)", peer, e)
+            self.node_disconnected(peer)
+        except Exception:
+            log.exception("Could not handle a message from %s, disconnecting.", peer)
+            self.node_disconnected(peer)
+
+    async def send(self, peer: Peer):
+        try:
+            while True:
+                frame = await peer.queue.get()
+                peer.writer.write(frame)
+                bytes_sent.inc(len(frame))
+                await peer.writer.drain()  # waits while the socket buffer is full.
+        except OSError:
+            self.node_disconnected(peer)
+
+    async def enqueue(self, peer: Peer, frame: bytes):
+        try:
+            await asyncio.wait_for(peer.queue.put(frame), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("%s is not keeping up, disconnecting.", peer.port)
+            self.node_disconnected(peer)
+
+    # Thread safe. Other threads wait while the peer's queue is full. Callbacks on
+    # the network thread can't wait, so a peer whose queue is full is disconnected.
+    def send_to_node(self, n: Peer, data: dict):
+        if n not in self.all_nodes:
+            log.warning("Could not send the data, node is not found.")
+            return
+        frame = encode_frame(data)
+        if self.on_network_thread():
+            try:
+                n.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                log.warning("%s is not keeping up, disconnecting.", n.port)
+                self.node_disconnected(n)
+        else:
+            self.call(self.enqueue(n, frame))
+
+    def send_to_nodes(self, data: dict, exclude: list = []):
+        for n in self.all_nodes:
+            if n not in exclude:
+                self.send_to_node(n, data)
+
+    def disconnect_with_node(self, node: Peer):
+        if node in self.nodes_outbound:
+            self.node_disconnect_with_outbound_node(node)
+            self.loop.call_soon_threadsafe(self.node_disconnected, node)
+
+    # Runs on the network thread. Safe to call more than once for the same peer.
+    def node_disconnected(self, node: Peer):
+        if node in self.nodes_inbound:
+            self.nodes_inbound.remove(node)
+            self.inbound_node_disconnected(node)
+        elif node in self.nodes_outbound:
+            self.nodes_outbound.remove(node)
+            self.outbound_node_disconnected(node)
+        else:
+            return
+        for task in node.tasks:
+            if task is not asyncio.current_task(self.loop):
+                task.cancel()
+        node.writer.close()
+
+    def outbound_node_connected(self, node: Peer):
+        if self.callback is not None:
+            self.callback("outbound_node_connected", self, node, {})
+
+    def inbound_node_connected(self, node: Peer):
+        if self.callback is not None:
+            self.callback("inbound_node_connected", self, node, {})
+
+    def inbound_node_disconnected(self, node: Peer):
+        if self.callback is not None:
+            self.callback("inbound_node_disconnected", self, node, {})
+
+    def outbound_node_disconnected(self, node: Peer):
+        if self.callback is not None:
+            self.callback("outbound_node_disconnected", self, node, {})
+
+    def node_message(self, node: Peer, data: dict):
+        if self.callback is not None:
+            self.callback("node_message", self, node, data)
+
+    def node_disconnect_with_outbound_node(self, node: Peer):
+        if self.callback is not None:
+            self.callback("node_disconnect_with_outbound_node", self, node, {})
+
+    def node_request_to_stop(self):
+        if self.callback is not None:
+            self.callback("node_request_to_stop", self, {}, {})
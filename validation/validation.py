@@ -0,0 +1,40 @@
+from metrics.metrics import registry
+from time import perf_counter
+
+# Stages of Blockchain.import_block(), cheapest first.
+STAGES = ["header", "transactions", "signatures", "execution", "commit"]
+
+stage_seconds = {
+    s: registry.histogram(f"simplechain_import_{s}_seconds", f"Time spent in the {s} stage of block imports.")
+    for s in STAGES
+}
+
+
+class StageTimings:
+    "Time spent in each stage of block validation, and the blocks rejected there."
+
+    def __init__(self):
+        self.seconds = {s: 0.0 for s in STAGES}
+        self.blocks = {s: 0 for s in STAGES}
+        self.rejected = {s: 0 for s in STAGES}
+
+    # Runs fn(*args) as part of {stage} and returns its result.
+    def time(self, stage: str, fn, *args):
+        start = perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = perf_counter() - start
+            self.seconds[stage] += elapsed
+            self.blocks[stage] += 1
+            stage_seconds[stage].observe(elapsed)
+
+    def reject(self, stage: str):
+        self.rejected[stage] += 1
+
+    def __str__(self) -> str:
+        stages = ", ".join(
+            f"{s} {1000 * self.seconds[s] / max(1, self.blocks[s]):.2f} ms ({self.rejected[s]} rejected)"
+            for s in STAGES
+        )
+        return f"Block validation, average per block: {stages}."